@@ -0,0 +1,130 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the streamed archives (zip and tar) of the group archive downloads.
+The archives are written chunk by chunk while the response is sent, so neither the archive nor a whole file
+is kept in memory or on the disk.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import tarfile
+import zipfile
+from time import localtime
+from typing import Iterable, Iterator, Optional
+
+
+class ArchiveBuffer:
+    """A write-only stream, which collects the written bytes until they are taken (the output of zipfile)."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        """Takes the written bytes.
+        :return: The bytes, which have been written since the last call.
+        """
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ArchiveWriter:
+    """The basic streamed archive writer."""
+
+    name = "basic"
+    mimetype = "application/octet-stream"
+    """True if the size of every file must be known before its content is written."""
+    requires_size = False
+
+    def add(self, filename: str, size: Optional[int], modified: float, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Adds a file to the archive.
+        :param filename: The name of the file in the archive.
+        :param size: The size of the file or None if it is unknown.
+        :param modified: The timestamp of the last modification of the file.
+        :param chunks: The content of the file.
+        :return: Generator of the bytes of the archive.
+        """
+        raise NotImplementedError()
+
+    def close(self) -> bytes:
+        """Finishes the archive.
+        :return: The last bytes of the archive.
+        """
+        raise NotImplementedError()
+
+
+class ZipWriter(ArchiveWriter):
+    """zip archive with uncompressed (stored) files. The sizes and the checksums of the files are written after
+    their content (data descriptors), so the sizes do not need to be known.
+    """
+
+    name = "zip"
+    mimetype = "application/zip"
+
+    def __init__(self):
+        self._buffer = ArchiveBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, "w", zipfile.ZIP_STORED)
+
+    def add(self, filename: str, size: Optional[int], modified: float, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        info = zipfile.ZipInfo(filename, date_time=localtime(modified)[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        if size is not None:
+            info.file_size = size
+        with self._zip.open(info, "w", force_zip64=size is None) as file:
+            for chunk in chunks:
+                file.write(chunk)
+                yield self._buffer.take()
+        yield self._buffer.take()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._buffer.take()
+
+
+class TarWriter(ArchiveWriter):
+    """tar archive (pax format). The size of every file is written before its content."""
+
+    name = "tar"
+    mimetype = "application/x-tar"
+    requires_size = True
+
+    def __init__(self):
+        self._offset = 0
+
+    def _write(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def add(self, filename: str, size: Optional[int], modified: float, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        info = tarfile.TarInfo(filename)
+        info.size = size
+        info.mtime = int(modified)
+        info.mode = 0o644
+        yield self._write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        written = 0
+        for chunk in chunks:
+            chunk = chunk[:size - written]
+            written += len(chunk)
+            yield self._write(chunk)
+        if written != size:
+            raise ValueError(f"The content of {filename} is shorter than its size.")
+        yield self._write(tarfile.NUL * (-size % tarfile.BLOCKSIZE))
+
+    def close(self) -> bytes:
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        self._offset += len(end)
+        return end + tarfile.NUL * (-self._offset % tarfile.RECORDSIZE)
+
+
+"""All archive writers with their names."""
+archive_writers = {writer.name: writer for writer in (ZipWriter, TarWriter)}
@@ -6,13 +6,12 @@ This module implements the authentication.
 :copyright: (c) 2020 by AdriBloober.
 :license: GNU General Public License v3.0
 """
-from os import remove, rmdir, mkdir
-from os.path import exists
-
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 
-from resources.api.encryption import get_data_directory, hash_key, generate_random_key
+from resources.api.cache import get_hot_cache_key, hot_object_cache
+from resources.api.dedup import release_file_chunks
+from resources.api.encryption import hash_key, generate_random_key
 from resources.api.errors import (
     FileDoesNotExists,
     AccessDenied,
@@ -21,23 +20,24 @@ from resources.api.errors import (
     ActionNeedsAuthenticationToken,
     InvalidAuthenticationToken, GroupDoesNotExists,
 )
+from resources.api.metadata import (
+    get_file,
+    get_file_name,
+    get_key_directory,
+    get_group,
+    remove_file,
+    STORAGE_DEDUP,
+)
+from resources.api.storage import storage
+from resources.api.token_store import create_token_store
 from flask import request
 import base64
 
 from resources.config import config
+from resources.metrics import measure
 
-private_key_file_name = "private.key"
-
-"""All authentication token will saved in this list."""
-authentication_tokens = []
-
-
-def get_group_directory() -> str:
-    """Gets the group directory and create it if it not exists."""
-    group_directory = get_data_directory() + "groups"
-    if not exists(group_directory):
-        mkdir(group_directory)
-    return group_directory
+"""All authentication tokens will be saved (hashed) in this store (see config.TOKEN_STORE)."""
+authentication_tokens = create_token_store()
 
 
 def parse_authentication(key: str, filename: str):
@@ -58,12 +58,11 @@ def authenticate(key: str, filename: str, private_key: str):
     :param filename: The filename of the file.
     :param private_key: The private_key of the file.
     """
-    if not exists(get_data_directory() + key + "/" + filename):
-        raise FileDoesNotExists()
-    if not exists(get_data_directory() + key + "/" + private_key_file_name):
-        raise AccessDenied()
-    with open(get_data_directory() + key + "/" + private_key_file_name) as file:
-        if hash_key(private_key) != file.read():
+    with measure("authentication"):
+        file = get_file(key, filename)
+        if file is None:
+            raise FileDoesNotExists()
+        if file["hashed_private_key"] is None or hash_key(private_key) != file["hashed_private_key"]:
             raise AccessDenied()
 
 
@@ -73,10 +72,15 @@ def delete_file(key: str, filename: str):
     :param filename: The filename of the file.
     :return:
     """
-    key_path = get_data_directory() + hash_key(key)
-    remove(key_path + "/" + filename)
-    remove(key_path + "/" + private_key_file_name)
-    rmdir(key_path)
+    hashed_key = hash_key(key)
+    file = get_file(hashed_key, filename)
+    name = get_file_name(hashed_key, filename)
+    if file is not None and file["storage"] == STORAGE_DEDUP:
+        release_file_chunks(name)
+    remove_file(hashed_key, filename)
+    storage.delete_directory(get_key_directory(hashed_key))
+    if file is not None:
+        hot_object_cache.invalidate(get_hot_cache_key(name, file))
 
 
 def create_authentication_token(key_identifier: str) -> str:
@@ -88,7 +92,7 @@ def create_authentication_token(key_identifier: str) -> str:
         raise AuthenticationKeyNotFound()
     key = RSA.import_key(base64.b64decode(config.KEYS[key_identifier].encode("utf-8")))
     token = generate_random_key(config.RANDOM_AUTHENTICATION_TOKEN_LENGTH)
-    authentication_tokens.append(hash_key(token))
+    authentication_tokens.add(hash_key(token))
     encrypted_token = base64.b64encode(
         PKCS1_OAEP.new(key).encrypt(token.encode("utf-8"))
     ).decode("utf-8")
@@ -100,10 +104,8 @@ def check_token(hashed_token: str) -> bool:
     :param hashed_token: The hashed authentication token.
     :return: True if the token is valid and False if the token is invalid.
     """
-    for token in authentication_tokens:
-        if token == hashed_token:
-            return True
-    return False
+    with measure("authentication"):
+        return authentication_tokens.contains(hashed_token)
 
 
 def run_api_with_authentication_required():
@@ -125,14 +127,16 @@ def delete_authentication_token(token: str):
 
 def authenticate_group(group_name: str, private_key: str):
     """Authenticates group with private_key.
+    Errors: :class:`GroupDoesNotExists`, :class:`AccessDenied`.
     :param group_name: The name of the group.
     :param private_key: The private_key of the group
+    :return: The index row of the group.
     """
-    if not exists(get_group_directory() + "/" + group_name):
-        raise GroupDoesNotExists()
-    with open(
-        get_group_directory() + "/" + group_name + "/" + private_key_file_name, "r"
-    ) as file:
-        if not file.read().replace("\n", "") == hash_key(private_key):
+    with measure("authentication"):
+        group = get_group(group_name)
+        if group is None:
+            raise GroupDoesNotExists()
+        if not group["hashed_private_key"] == hash_key(private_key):
             raise AccessDenied()
+        return group
 
@@ -0,0 +1,225 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the in-process caches.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from collections import OrderedDict
+from sqlite3 import Row
+from threading import Lock
+from time import monotonic
+
+from resources.config import config
+
+
+class LRUCache:
+    """A thread-safe least recently used cache with a maximum amount of entries and a time to live.
+    The cache counts hits, misses and evictions (see :meth:`stats`).
+    """
+
+    def __init__(self, max_size: int, ttl: float = 0):
+        """
+        :param max_size: The maximum amount of entries. If it is 0, the cache is disabled.
+        :param ttl: The time to live of an entry in seconds. If it is 0, the entries never expire.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Gets an entry and marks it as recently used.
+        :param key: The key of the entry.
+        :param default: Returned if the entry does not exists or is expired.
+        :return: The value of the entry or the default.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Sets an entry. If the cache is full, the least recently used entry would be evicted.
+        :param key: The key of the entry.
+        :param value: The value of the entry.
+        """
+        if self.max_size <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes an entry, if it exists.
+        :param key: The key of the entry.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Gets the counters of the cache.
+        :return: dict with the entries, hits, misses and evictions.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ObjectCache:
+    """A thread-safe cache of byte objects with a memory budget.
+    If the budget is exceeded, the least recently used ('lru') or the least frequently used ('lfu') entries
+    are evicted. The cache counts hits, misses, evictions and the resident bytes (see :meth:`stats`).
+    """
+
+    def __init__(self, max_bytes: int, max_object_bytes: int, policy: str = "lru"):
+        """
+        :param max_bytes: The memory budget in bytes. If it is 0, the cache is disabled.
+        :param max_object_bytes: Bigger objects are not cached.
+        :param policy: The eviction policy: 'lru' or 'lfu'.
+        """
+        if policy.lower() not in ("lru", "lfu"):
+            raise ValueError(f"The cache policy {policy} should be 'lru' or 'lfu'.")
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.policy = policy.lower()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+        self._entries = OrderedDict()  # key: [value, size, frequency]
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True if the cache has a memory budget."""
+        return self.max_bytes > 0
+
+    def accepts(self, size: int) -> bool:
+        """Checks if an object of the size can be cached.
+        :param size: The size of the object in bytes.
+        :return: True if the object can be cached.
+        """
+        return self.enabled and size <= min(self.max_object_bytes, self.max_bytes)
+
+    def get(self, key):
+        """Gets an entry and counts the usage.
+        :param key: The key of the entry.
+        :return: The value of the entry or None.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry[2] += 1
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size: int):
+        """Sets an entry. Entries are evicted until the memory budget is kept.
+        :param key: The key of the entry.
+        :param value: The value of the entry.
+        :param size: The size of the value in bytes.
+        """
+        if not self.accepts(size):
+            return
+        with self._lock:
+            self._remove(key)
+            while self._entries and self.resident_bytes + size > self.max_bytes:
+                self._remove(self._select_victim())
+                self.evictions += 1
+            self._entries[key] = [value, size, 1]
+            self.resident_bytes += size
+
+    def _select_victim(self):
+        """Selects the entry to be evicted (the lock must be held).
+        :return: The key of the entry.
+        """
+        if self.policy == "lfu":
+            # On equal frequencies the least recently used entry is evicted (the order of the entries).
+            return min(self._entries, key=lambda key: self._entries[key][2])
+        return next(iter(self._entries))
+
+    def _remove(self, key):
+        """Removes an entry, if it exists (the lock must be held).
+        :param key: The key of the entry.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+
+    def invalidate(self, key):
+        """Removes an entry, if it exists.
+        :param key: The key of the entry.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_prefix(self, prefix: str):
+        """Removes all entries, which keys start with the prefix. Of tuple keys the first element is compared.
+        :param prefix: The prefix of the keys (string).
+        """
+        with self._lock:
+            for key in [key for key in self._entries if (key[0] if isinstance(key, tuple) else key).startswith(prefix)]:
+                self._remove(key)
+
+    def stats(self) -> dict:
+        """Gets the counters of the cache.
+        :return: dict with the entries, hits, misses, evictions, hit ratio and resident bytes.
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "resident_bytes": self.resident_bytes,
+            }
+
+
+def get_hot_cache_key(name: str, index_file: Row) -> tuple:
+    """Gets the key of a file in the :data:`hot_object_cache`. The key contains the checksum and the upload time of
+    the index row, so the entries of a replaced file (e.g. by another process of the prefork mode, which cache is not
+    invalidated) are never served.
+    :param name: The storage name of the encrypted file.
+    :param index_file: The index row of the file.
+    :return: The key (tuple of the name, the checksum and the upload time).
+    """
+    return name, index_file["checksum"], index_file["created"]
+
+
+"""Cache of decrypted files (identified by :func:`get_hot_cache_key`), see config.HOT_CACHE_BYTES."""
+hot_object_cache = ObjectCache(config.HOT_CACHE_BYTES, config.HOT_CACHE_MAX_OBJECT_BYTES, config.HOT_CACHE_POLICY)
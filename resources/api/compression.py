@@ -0,0 +1,257 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the compression of files before their encryption (see config.COMPRESSION_CODEC).
+Compressed files start with a codec header (before the encryption header), so the codec is known without the key.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import bz2
+import lzma
+import struct
+import zlib
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from resources.api.errors import FileTooBig
+from resources.api.storage import storage
+from resources.config import config
+
+"""Every compressed file starts with these bytes (followed by the codec id)."""
+CODEC_HEADER_MAGIC = b"\x89OCDZ\r\n\x1a"
+
+"""The codec name of files, which are not compressed."""
+CODEC_IDENTITY = "identity"
+
+
+class Codec:
+    """The basic compression codec.
+    Every codec has an unique id, which is written into the codec header.
+    """
+
+    id = 0
+    name = "basic"
+    """The Content-Encoding of the compressed content or None if no http client can decode it."""
+    content_encoding = None
+
+    def compressor(self):
+        """Creates a compressor object (with compress and flush).
+        :return: The compressor.
+        """
+        raise NotImplementedError()
+
+    def decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Decompresses the compressed chunks. Every decompressed chunk has at most config.STREAM_CHUNK_BYTES bytes.
+        :param chunks: The compressed chunks.
+        :return: Generator of the decompressed chunks.
+        """
+        raise NotImplementedError()
+
+
+class Gzip(Codec):
+    """gzip (deflate), which can be sent to http clients as 'Content-Encoding: gzip'."""
+
+    id = 1
+    name = "gzip"
+    content_encoding = "gzip"
+
+    def compressor(self):
+        return zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        decompressor = zlib.decompressobj(31)
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk, config.STREAM_CHUNK_BYTES)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+class _StreamCodec(Codec):
+    """Codec of a module with compressor and decompressor classes (lzma and bz2)."""
+
+    def _decompressor(self):
+        raise NotImplementedError()
+
+    def decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        decompressor = self._decompressor()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk, config.STREAM_CHUNK_BYTES)
+            while data:
+                yield data
+                if decompressor.needs_input or decompressor.eof:
+                    break
+                data = decompressor.decompress(b"", config.STREAM_CHUNK_BYTES)
+
+
+class LZMA(_StreamCodec):
+    """xz (lzma), the best compression ratio, but the slowest codec."""
+
+    id = 2
+    name = "lzma"
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=config.COMPRESSION_LEVEL)
+
+    def _decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class BZ2(_StreamCodec):
+    """bzip2."""
+
+    id = 3
+    name = "bz2"
+
+    def compressor(self):
+        return bz2.BZ2Compressor(max(config.COMPRESSION_LEVEL, 1))
+
+    def _decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+"""All codecs with their ids."""
+codecs = {codec.id: codec for codec in (Gzip, LZMA, BZ2)}
+
+
+def get_upload_codec(filename: str) -> Optional[Codec]:
+    """Gets the codec for a new upload (config.COMPRESSION_CODEC). Files with a suffix of
+    config.COMPRESSION_SKIP_SUFFIXES (already compressed files) are not compressed.
+    :param filename: The filename of the upload.
+    :return: The codec or None if the file should not be compressed.
+    """
+    name = config.COMPRESSION_CODEC.lower()
+    if name in ("", "none", CODEC_IDENTITY):
+        return None
+    suffix = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if suffix in [x.lower() for x in config.COMPRESSION_SKIP_SUFFIXES]:
+        return None
+    codec = get_codec(name)
+    if codec is None:
+        raise ValueError(f"The COMPRESSION_CODEC {config.COMPRESSION_CODEC} should be 'none', 'gzip', 'lzma' or 'bz2'.")
+    return codec
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """Gets a codec by its name (e.g. the codec of a file in the index).
+    :param name: The name of the codec.
+    :return: The codec or None for CODEC_IDENTITY and unknown names.
+    """
+    for codec in codecs.values():
+        if codec.name == name:
+            return codec()
+    return None
+
+
+def write_codec_header(file: BinaryIO, codec: Codec):
+    """Writes the codec header.
+    :param file: The file.
+    :param codec: The codec of the file.
+    """
+    file.write(CODEC_HEADER_MAGIC + struct.pack(">B", codec.id))
+
+
+def read_codec_header(file: BinaryIO) -> Optional[Codec]:
+    """Reads the codec header. After reading, the file is positioned after the codec header.
+    :param file: The file (seekable).
+    :return: The codec or None if the file is not compressed.
+    """
+    start = file.tell()
+    if file.read(len(CODEC_HEADER_MAGIC)) != CODEC_HEADER_MAGIC:
+        file.seek(start)
+        return None
+    codec_id = struct.unpack(">B", file.read(1))[0]
+    if codec_id not in codecs:
+        raise ValueError(f"The file was compressed with the unknown codec {codec_id}.")
+    return codecs[codec_id]()
+
+
+def read_codec_name(name: str) -> str:
+    """Reads the name of the codec of a file.
+    :param name: The storage name of the file.
+    :return: The name of the codec or CODEC_IDENTITY.
+    """
+    with storage.open(name) as file:
+        codec = read_codec_header(file)
+    return CODEC_IDENTITY if codec is None else codec.name
+
+
+class CompressingReader:
+    """Reads and compresses a stream. It counts the size of the uncompressed content."""
+
+    def __init__(self, source: BinaryIO, codec: Codec, max_bytes: int):
+        """
+        :param source: The stream with the content.
+        :param codec: The codec.
+        :param max_bytes: The maximum size of the content. If the source is bigger, :class:`FileTooBig` is raised.
+        """
+        self.source = source
+        self.size = 0
+        self.max_bytes = max_bytes
+        self._compressor = codec.compressor()
+        self._eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads compressed bytes. The size is only a hint, the returned bytes can be more.
+        Errors: :class:`FileTooBig`.
+        :param size: The size of the read uncompressed content.
+        :return: The compressed bytes or b"" at the end.
+        """
+        while not self._eof:
+            chunk = self.source.read(size if size > 0 else config.STREAM_CHUNK_BYTES)
+            if not chunk:
+                self._eof = True
+                return self._compressor.flush()
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise FileTooBig()
+            data = self._compressor.compress(chunk)
+            if data:
+                return data
+        return b""
+
+
+class CompressedFile:
+    """Read access to the content of a compressed and encrypted file (same interface as
+    :class:`resources.api.encryption.EncryptedFile`).
+    """
+
+    def __init__(self, encrypted_file, codec: Codec, size: Optional[int]):
+        """
+        :param encrypted_file: The encrypted file (:class:`resources.api.encryption.EncryptedFile`).
+        :param codec: The codec of the file.
+        :param size: The size of the uncompressed content (from the index) or None if it is unknown.
+        """
+        self.encrypted_file = encrypted_file
+        self.codec = codec
+        self.size = size
+        self.encoded_size = encrypted_file.size
+        self.derived_key = encrypted_file.derived_key
+
+    def iter_encoded(self) -> Iterator[bytes]:
+        """Decrypts the compressed content (to be sent with Content-Encoding).
+        :return: Generator of the decrypted, compressed chunks.
+        """
+        return self.encrypted_file.iter_chunks()
+
+    def iter_chunks(self, start: int = 0, stop: int = None) -> Iterator[bytes]:
+        """Decrypts and decompresses the content from start to stop. The content before start must be
+        decompressed too, but it is not sent.
+        :param start: The first byte of the content.
+        :param stop: The end (exclusive) of the content, the whole content by default.
+        :return: Generator of the decompressed chunks.
+        """
+        position = 0
+        for chunk in self.codec.decompress(self.encrypted_file.iter_chunks()):
+            chunk_start = position
+            position += len(chunk)
+            if position <= start:
+                continue
+            if stop is not None and chunk_start >= stop:
+                break
+            yield chunk[max(start - chunk_start, 0):None if stop is None else stop - chunk_start]
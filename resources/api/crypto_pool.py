@@ -0,0 +1,227 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the crypto worker pools (see config.CRYPTO_KDF_PROCESSES and config.CRYPTO_CIPHER_THREADS).
+The key derivations run in worker processes and the AES chunks in worker threads (AES releases the GIL), so a burst
+of uploads does not stall the request threads of the process. Every pool admits a bounded amount of requests
+(see :func:`admit`): an admitted request reserves a place in the pools until its response has been sent, further
+requests are answered with :class:`ServerBusy`. So the jobs of admitted requests never wait for a place.
+The pools are started with :func:`start_crypto_pools` in every serving process (the worker processes of the prefork
+mode have their own pools), before the request and background threads are started, because the processes are
+forked. Processes without started pools run the jobs in the calling thread.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import _exit, getpid, getppid
+from signal import SIG_DFL, SIG_IGN, SIGABRT, SIGHUP, SIGINT, SIGQUIT, SIGTERM, SIGUSR1, SIGUSR2, SIGWINCH, signal
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, List, Optional
+
+from flask import Response, after_this_request, g
+
+from resources.api.errors import ServerBusy
+from resources.config import config
+from resources.logger import logger, LogType
+
+
+class BoundedPool:
+    """A worker pool, which admits a bounded amount of requests (workers + queue size).
+    If the pool has no workers or has not been started in the process, the jobs run in the calling thread.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, create_executor: Callable[[int], Executor]):
+        """
+        :param name: The name of the pool (for the stats).
+        :param workers: The amount of workers (0 disables the pool).
+        :param queue_size: The maximum amount of admitted requests besides the workers.
+        :param create_executor: Creates the executor with the amount of workers.
+        """
+        self.name = name
+        self.workers = workers
+        self.max_admitted = workers + queue_size
+        self.admitted = 0
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._create_executor = create_executor
+        self._executor: Optional[Executor] = None
+        self._pid = None
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True if the pool has workers."""
+        return self.workers > 0
+
+    def start(self):
+        """Creates the executor of the current process and starts its workers. It must be called before other
+        threads are started, because the workers of a process pool are forked.
+        """
+        if not self.enabled:
+            return
+        self._executor = self._create_executor(self.workers)
+        self._pid = getpid()
+        self._executor.submit(int).result()  # starts the workers
+
+    def reserve(self) -> bool:
+        """Reserves a place for the jobs of a request. A full pool is counted as rejection.
+        :return: False if the pool has already admitted the maximum amount of requests.
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.admitted >= self.max_admitted:
+                self.rejected += 1
+                return False
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """Releases the place of a request (see :meth:`reserve`)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.admitted -= 1
+
+    def run(self, function: Callable, *args):
+        """Runs a job in the pool and waits for the result.
+        :param function: The function of the job.
+        :param args: The arguments of the function.
+        :return: The result of the function.
+        """
+        executor = self._executor
+        if executor is None or self._pid != getpid():
+            return function(*args)
+        with self._lock:
+            self.pending += 1
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:  # a worker process died, the pool can not be forked again in a threaded process
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                    logger.log(LogType.ERROR, f"The crypto pool {self.name} is broken, its jobs run in the threads.")
+            return function(*args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self) -> dict:
+        """Gets the counters of the pool.
+        :return: dict with the workers, the admitted requests and the pending, completed and rejected jobs.
+        """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "admitted": self.admitted,
+                "pending": self.pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+def watch_parent_process(parent_pid: int):
+    """Exits the process, when its parent process has exited (the loop of a thread).
+    :param parent_pid: The pid of the parent process.
+    """
+    while getppid() == parent_pid:
+        sleep(1)
+    _exit(0)
+
+
+def init_kdf_process(parent_pid: int):
+    """Initializes a process of the kdf pool. The signal handlers of the server (e.g. of a prefork worker) are reset
+    and the process exits with its parent, so a killed parent leaves no processes with its sockets behind.
+    :param parent_pid: The pid of the parent process.
+    """
+    for signal_number in (SIGTERM, SIGQUIT, SIGHUP, SIGUSR1, SIGUSR2, SIGWINCH, SIGABRT):
+        signal(signal_number, SIG_DFL)
+    signal(SIGINT, SIG_IGN)  # the parent stops the pool
+    Thread(target=watch_parent_process, args=(parent_pid,), daemon=True).start()
+
+
+def create_process_executor(workers: int) -> Executor:
+    """Creates the executor of the key derivations. The processes are forked, because starting a new interpreter
+    would import (and run) the server. The jobs must not reference the server modules, because they are imported
+    (locked) while the server runs (see :meth:`resources.api.kdf.KeyDerivation.get_derivation`).
+    :param workers: The amount of processes.
+    :return: The executor.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context("fork"), initializer=init_kdf_process, initargs=(getpid(),)
+    )
+
+
+def create_thread_executor(workers: int) -> Executor:
+    """Creates the executor of the AES chunks.
+    :param workers: The amount of threads.
+    :return: The executor.
+    """
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crypto-cipher")
+
+
+"""The pool of the key derivations (processes)."""
+kdf_pool = BoundedPool("kdf", config.CRYPTO_KDF_PROCESSES, config.CRYPTO_QUEUE_SIZE, create_process_executor)
+"""The pool of the AES encryption and decryption of chunks (threads)."""
+cipher_pool = BoundedPool("cipher", config.CRYPTO_CIPHER_THREADS, config.CRYPTO_QUEUE_SIZE, create_thread_executor)
+
+
+def start_crypto_pools():
+    """Starts the pools in the current process (before the request and background threads are started)."""
+    kdf_pool.start()
+    cipher_pool.start()
+
+
+class Admission:
+    """The reserved places of an admitted request (see :func:`admit`)."""
+
+    def __init__(self, pools: List[BoundedPool]):
+        """
+        :param pools: The pools, in which a place has been reserved.
+        """
+        self.pools = pools
+        self.responded = False
+
+    def release(self):
+        """Releases the places (only once)."""
+        pools, self.pools = self.pools, []
+        for pool in pools:
+            pool.release()
+
+
+def admit():
+    """Admits a request, which derives keys or encrypts/decrypts content, before its response is started.
+    The request reserves a place in every pool until its response has been sent.
+    Errors: :class:`ServerBusy`, if a pool is full.
+    """
+    reserved = []
+    for pool in (kdf_pool, cipher_pool):
+        if not pool.reserve():
+            Admission(reserved).release()
+            raise ServerBusy()
+        reserved.append(pool)
+    admission = Admission(reserved)
+    g.crypto_admission = admission
+
+    @after_this_request
+    def release_after_response(response: Response) -> Response:
+        admission.responded = True
+        if response.direct_passthrough:  # sent by the wsgi server, which does not call the close callbacks
+            admission.release()
+        else:
+            response.call_on_close(admission.release)
+        return response
+
+
+def release_admission():
+    """Releases the places of the request, if it failed without a response (teardown_request)."""
+    admission = g.pop("crypto_admission", None)
+    if admission is not None and not admission.responded:
+        admission.release()
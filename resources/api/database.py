@@ -0,0 +1,101 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the access to the SQLite databases in the data directory.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import sqlite3
+from os import getpid
+from threading import local
+from typing import List
+
+from resources.api.encryption import get_data_directory
+
+
+class Database:
+    """A SQLite database in the data directory, which can be shared by multiple worker processes.
+    Every thread of every process has its own connection. The connections are in autocommit mode,
+    so multiple statements must be wrapped in :meth:`transaction`.
+    """
+
+    def __init__(self, filename: str, schema: List[str], migrations: List[str] = ()):
+        """
+        :param filename: The filename of the database in the data directory.
+        :param schema: The statements, which create the tables and indexes (must use 'IF NOT EXISTS').
+        :param migrations: The statements, which change the schema of existing databases (e.g. 'ALTER TABLE').
+            They are applied in order and only once, the amount of applied migrations is the user_version of
+            the database. New migrations must be appended.
+        """
+        self.filename = filename
+        self.schema = schema
+        self.migrations = list(migrations)
+        self._local = local()
+
+    @property
+    def path(self) -> str:
+        """The path to the database file."""
+        return get_data_directory() + self.filename
+
+    def connection(self) -> sqlite3.Connection:
+        """Gets the connection of the current thread and process.
+        :return: The connection.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != getpid() or self._local.path != self.path:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                connection.execute(statement)
+            self._migrate(connection)
+            self._local.connection = connection
+            self._local.pid = getpid()
+            self._local.path = self.path
+        return connection
+
+    def _migrate(self, connection: sqlite3.Connection):
+        """Applies the migrations, which are not applied yet.
+        :param connection: The connection.
+        """
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= len(self.migrations):
+            return
+        with _Transaction(connection):
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for statement in self.migrations[version:]:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {len(self.migrations)}")
+
+    def execute(self, statement: str, parameters=()) -> sqlite3.Cursor:
+        """Executes a statement with the connection of the current thread.
+        :param statement: The SQL statement.
+        :param parameters: The parameters of the statement.
+        :return: The cursor.
+        """
+        return self.connection().execute(statement, parameters)
+
+    def transaction(self):
+        """Gets a context manager, which runs the statements in it in one (immediate) transaction.
+        :return: The context manager.
+        """
+        return _Transaction(self.connection())
+
+
+class _Transaction:
+    """Context manager of a transaction (see :meth:`Database.transaction`)."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
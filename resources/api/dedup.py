@@ -0,0 +1,300 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the deduplicated storage (config.STORAGE_MODE 'dedup').
+The content of a file is split in chunks of config.DEDUP_CHUNK_BYTES bytes. Every chunk is encrypted with a key,
+which is derived from the content of the chunk and the server key (convergent encryption), so equal chunks are
+encrypted equally and saved only once in the chunk directory. The chunks are counted in the index and removed,
+when no file references them anymore.
+The file itself is saved as manifest under the usual name. The manifest contains the ids of the chunks (which reveal
+nothing about the content) and the keys of the chunks, which are encrypted with the encrypting key of the file.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import hashlib
+import hmac
+import json
+import struct
+from time import perf_counter, sleep, time
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from Crypto.Cipher import AES
+
+from resources.api.crypto_pool import cipher_pool
+from resources.api.encryption import DerivedKey, decrypt, encrypt, get_derived_key
+from resources.api.kdf import read_header
+from resources.api.errors import FileTooBig
+from resources.api.metadata import chunk_directory_name, metadata_index
+from resources.api.storage import storage
+from resources.config import config
+from resources.logger import logger, LogType
+from resources.metrics import StageTimings
+
+"""The magic bytes at the start of every manifest."""
+MANIFEST_MAGIC = b"\x89OCDM\r\n\x1a"
+
+"""The seconds after which a deletion of chunks is regarded as aborted (e.g. the process was killed in between)."""
+CHUNK_DELETION_TIMEOUT = 60
+
+"""The seconds between the checks, whether a deletion of a referenced chunk has finished."""
+CHUNK_DELETION_POLL_INTERVAL = 0.05
+
+
+def get_chunk_key(chunk: bytes) -> bytes:
+    """Derives the encrypting key of a chunk from the content of the chunk and the server key.
+    :param chunk: The (unencrypted) content of the chunk.
+    :return: The 32 bytes key.
+    """
+    return hmac.new(config.SERVER_KEY.encode("utf-8"), chunk, hashlib.sha256).digest()
+
+
+def get_chunk_id(chunk_key: bytes) -> str:
+    """Gets the id of a chunk. The id is the hash of the key, so the key can not be restored from the id.
+    :param chunk_key: The encrypting key of the chunk.
+    :return: The id (hex digest).
+    """
+    return hashlib.sha256(chunk_key).hexdigest()
+
+
+def get_chunk_name(chunk_id: str) -> str:
+    """Gets the storage name of a chunk.
+    :param chunk_id: The id of the chunk.
+    :return: The name.
+    """
+    return f"{chunk_directory_name}/{chunk_id[:2]}/{chunk_id}"
+
+
+def make_chunk_aes(chunk_key: bytes, position: int = 0):
+    """Creates an AES Object, which encrypts or decrypts a chunk from a position (AES-CTR).
+    :param chunk_key: The encrypting key of the chunk.
+    :param position: The position in the chunk (must be a multiple of 16).
+    :return: AES Object.
+    """
+    return AES.new(chunk_key, AES.MODE_CTR, nonce=b"", initial_value=position // 16)
+
+
+def read_chunk(source: BinaryIO, size: int) -> bytes:
+    """Reads a whole chunk of a stream (streams may return less bytes than requested).
+    :param source: The stream.
+    :param size: The size of the chunk.
+    :return: The chunk (shorter than size only at the end of the stream).
+    """
+    chunk = source.read(size)
+    while chunk and len(chunk) < size:
+        rest = source.read(size - len(chunk))
+        if not rest:
+            break
+        chunk += rest
+    return chunk
+
+
+def acquire_chunk(chunk: bytes, timings: StageTimings) -> Tuple[str, bytes]:
+    """Adds a reference to a chunk. If the chunk is not saved yet, it will be encrypted and saved.
+    The reference is added before the chunk is saved, so the chunk can not be removed in between.
+    If the chunk is being deleted (see :func:`release_chunks`), the deletion is awaited and the chunk is saved again.
+    :param chunk: The (unencrypted) content of the chunk.
+    :param timings: The timings of the upload.
+    :return: The id and the encrypting key of the chunk.
+    """
+    chunk_key = get_chunk_key(chunk)
+    chunk_id = get_chunk_id(chunk_key)
+    metadata_index.execute(
+        "INSERT INTO chunks (id, size, refcount) VALUES (?, ?, 1) "
+        "ON CONFLICT(id) DO UPDATE SET refcount = refcount + 1",
+        (chunk_id, len(chunk)),
+    )
+    wait_for_chunk_deletion(chunk_id)
+    name = get_chunk_name(chunk_id)
+    if storage.stat(name) is None:
+        began = perf_counter()
+        encrypted_chunk = cipher_pool.run(make_chunk_aes(chunk_key).encrypt, chunk)
+        encrypted = perf_counter()
+        storage.write(name, encrypted_chunk)
+        timings.add("encryption", encrypted - began)
+        timings.add("disk_write", perf_counter() - encrypted)
+    return chunk_id, chunk_key
+
+
+def wait_for_chunk_deletion(chunk_id: str):
+    """Waits until a running deletion of a chunk has finished (or is regarded as aborted).
+    :param chunk_id: The id of the chunk.
+    """
+    while True:
+        row = metadata_index.execute("SELECT deleting FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+        if row is None or row["deleting"] is None or row["deleting"] < time() - CHUNK_DELETION_TIMEOUT:
+            return
+        sleep(CHUNK_DELETION_POLL_INTERVAL)
+
+
+def release_chunks(chunk_ids: List[str]):
+    """Removes references to chunks. Chunks without references are removed (garbage collection).
+    The unused chunks are marked as deleting in a transaction and deleted from the storage after it, so the index is
+    not locked during the deletion. Chunks, which are referenced again in between, are saved again by
+    :func:`acquire_chunk` after the deletion. Chunks, which can not be deleted, are kept for the next release.
+    :param chunk_ids: The ids of the chunks (one id per reference).
+    """
+    if not chunk_ids:
+        return
+    with metadata_index.transaction() as connection:
+        connection.executemany(
+            "UPDATE chunks SET refcount = refcount - 1 WHERE id = ?", [(chunk_id,) for chunk_id in chunk_ids]
+        )
+        unused = [
+            (row["id"],)
+            for row in connection.execute(
+                "SELECT id FROM chunks WHERE refcount <= 0 AND (deleting IS NULL OR deleting < ?)",
+                (time() - CHUNK_DELETION_TIMEOUT,),
+            )
+        ]
+        connection.executemany("UPDATE chunks SET deleting = ? WHERE id = ?", [(time(), *row) for row in unused])
+    deleted, failed = [], []
+    for row in unused:
+        try:
+            storage.delete(get_chunk_name(row[0]))
+            deleted.append(row)
+        except Exception as e:
+            logger.log(LogType.ERROR, f"The chunk {row[0]} could not be deleted: {e!r}")
+            failed.append(row)
+    with metadata_index.transaction() as connection:
+        connection.executemany("DELETE FROM chunks WHERE id = ? AND refcount <= 0", deleted)
+        connection.executemany("UPDATE chunks SET deleting = NULL WHERE id = ?", deleted + failed)
+
+
+def encrypt_dedup_stream(
+    source: BinaryIO, destination: BinaryIO, key: str, max_bytes: int, derived_key: DerivedKey = None
+) -> int:
+    """Saves the chunks of the source stream and writes the manifest into the destination.
+    If it fails, the references of the saved chunks are removed.
+    Errors: :class:`FileTooBig`.
+    :param source: The stream with the content.
+    :param destination: The file, which the manifest is written to.
+    :param key: The encrypting key of the file.
+    :param max_bytes: The maximum size of the content. If the source is bigger, the upload will be aborted.
+    :param derived_key: The already derived key of the file (see :func:`resources.api.encryption.derive_upload_key`).
+    :return: The size of the content.
+    """
+    timings = StageTimings()
+    chunks = []  # (id, key, length)
+    content_size = 0
+    try:
+        while True:
+            chunk = read_chunk(source, config.DEDUP_CHUNK_BYTES)
+            if not chunk:
+                break
+            content_size += len(chunk)
+            if content_size > max_bytes:
+                raise FileTooBig()
+            chunks.append((*acquire_chunk(chunk, timings), len(chunk)))
+        chunk_ids = json.dumps([chunk_id for chunk_id, _, _ in chunks]).encode("utf-8")
+        manifest = json.dumps(
+            {"size": content_size, "chunks": [[chunk_key.hex(), length] for _, chunk_key, length in chunks]}
+        )
+        destination.write(MANIFEST_MAGIC + struct.pack(">I", len(chunk_ids)) + chunk_ids)
+        destination.write(encrypt(manifest.encode("utf-8"), key, derived_key))
+    except BaseException:
+        release_chunks([chunk_id for chunk_id, _, _ in chunks])
+        raise
+    timings.observe()
+    return content_size
+
+
+def read_manifest_chunk_ids(file: BinaryIO) -> Optional[List[str]]:
+    """Reads the ids of the chunks of a manifest (the encrypting key is not required).
+    :param file: The file (opened in binary mode).
+    :return: List of the ids or None if the file is no manifest.
+    """
+    if file.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+        return None
+    length = struct.unpack(">I", file.read(4))[0]
+    return json.loads(file.read(length).decode("utf-8"))
+
+
+def read_chunk_ids(name: str) -> Optional[List[str]]:
+    """Reads the ids of the chunks of a stored manifest.
+    :param name: The storage name of the file.
+    :return: List of the ids or None if the file is no manifest.
+    """
+    with storage.open(name) as file:
+        return read_manifest_chunk_ids(file)
+
+
+def release_file_chunks(name: str):
+    """Removes the references of a manifest to its chunks (before the manifest is removed).
+    :param name: The storage name of the manifest.
+    """
+    release_chunks(read_chunk_ids(name) or [])
+
+
+class DedupFile:
+    """Read access to the content of a deduplicated file (same interface as
+    :class:`resources.api.encryption.EncryptedFile`).
+    """
+
+    def __init__(self, file: BinaryIO, key: str, derived_key: DerivedKey = None):
+        """Reads and decrypts the manifest.
+        :param file: The manifest (opened in binary mode).
+        :param key: The encrypting key of the file.
+        :param derived_key: An already derived key of the key
+            (see :func:`resources.api.encryption.get_derived_key`).
+        """
+        self.file = file
+        self.timings = StageTimings()
+        if file.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            raise ValueError("The file is no manifest of a deduplicated file.")
+        length = struct.unpack(">I", file.read(4))[0]
+        self.chunk_ids = json.loads(file.read(length).decode("utf-8"))
+        start = file.tell()
+        self.derived_key = get_derived_key(key, read_header(file), derived_key)
+        file.seek(start)
+        manifest = json.loads(decrypt(file.read(), key, self.derived_key).decode("utf-8"))
+        self.size = manifest["size"]
+        self.chunks = [(bytes.fromhex(chunk_key), length) for chunk_key, length in manifest["chunks"]]
+
+    def iter_chunks(self, start: int = 0, stop: int = None) -> Iterator[bytes]:
+        """Decrypts the content from start to stop in chunks of at most config.STREAM_CHUNK_BYTES bytes.
+        :param start: The first byte of the content.
+        :param stop: The end (exclusive) of the content, the size of the content by default.
+        :return: Generator of the decrypted chunks.
+        """
+        if stop is None or stop > self.size:
+            stop = self.size
+        position = 0
+        try:
+            for chunk_id, (chunk_key, length) in zip(self.chunk_ids, self.chunks):
+                if position >= stop:
+                    break
+                chunk_start = max(start - position, 0)
+                chunk_stop = min(stop - position, length)
+                position += length
+                if chunk_start < chunk_stop:
+                    yield from self._iter_chunk(chunk_id, chunk_key, chunk_start, chunk_stop)
+        finally:
+            self.timings.observe()
+
+    def _iter_chunk(self, chunk_id: str, chunk_key: bytes, start: int, stop: int) -> Iterator[bytes]:
+        """Decrypts a part of a chunk.
+        :param chunk_id: The id of the chunk.
+        :param chunk_key: The encrypting key of the chunk.
+        :param start: The first byte in the chunk.
+        :param stop: The end (exclusive) in the chunk.
+        :return: Generator of the decrypted parts.
+        """
+        skip = start % 16
+        aes = make_chunk_aes(chunk_key, start - skip)
+        with storage.open(get_chunk_name(chunk_id)) as file:
+            file.seek(start - skip)
+            remaining = stop - start + skip
+            while remaining > 0:
+                began = perf_counter()
+                data = file.read(min(config.STREAM_CHUNK_BYTES, remaining))
+                read = perf_counter()
+                if not data:
+                    break
+                remaining -= len(data)
+                decrypted = cipher_pool.run(aes.decrypt, data)[skip:]
+                skip = 0
+                self.timings.add("disk_read", read - began)
+                self.timings.add("decryption", perf_counter() - read)
+                yield decrypted
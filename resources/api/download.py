@@ -7,18 +7,331 @@ This module implements the api downloading in deleting.
 :license: GNU General Public License v3.0
 """
 
-from io import BytesIO
-from os.path import exists
+from datetime import datetime, timezone
+from mimetypes import guess_type
+from sqlite3 import Row
+from typing import BinaryIO, Iterable, Optional, Tuple
 
-from flask import send_file, request, jsonify
+from flask import Response, after_this_request, request, jsonify
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 
 from resources.api.authentication import parse_authentication, delete_file
-from resources.api.encryption import hash_key, decrypt
-from resources.api.errors import FileDoesNotExists
+from resources.api.cache import get_hot_cache_key, hot_object_cache
+from resources.api.crypto_pool import admit
+from resources.api.compression import CODEC_IDENTITY, Codec, CompressedFile, get_codec, read_codec_header
+from resources.api.encryption import hash_key, DerivedKey, EncryptedFile
+from resources.api.errors import FileDoesNotExists, RangeNotSatisfiable, RawDownloadsDisabled
+from resources.api.kdf import read_header
+from resources.api.dedup import DedupFile
+from resources.api.metadata import count_download, get_file, get_file_name, is_file_expired, STORAGE_DEDUP
+from resources.api.storage import storage
 from resources.app import app
 from resources.config import config
 
 
+"""The ETag variant of the encrypted files (see :func:`make_raw_response`)."""
+ETAG_RAW = "raw"
+
+
+def get_etag(index_file: Row, variant: str) -> str:
+    """Gets the ETag of a representation of a file. The ETag is derived from the checksum of the encrypted
+    file, which is saved in the index at the upload, so no file has to be read for it. The checksum of files of a
+    rebuilt index is unknown, so their ETag is weak (prefixed with 'W/') and derived from the upload time.
+    :param index_file: The index row of the file.
+    :param variant: The representation: CODEC_IDENTITY (decrypted), a content encoding or ETAG_RAW.
+    :return: The ETag (without quotes).
+    """
+    if not index_file["checksum"]:
+        return f"W/{int(index_file['created'] * 1000000)}-{variant}"
+    return f"{index_file['checksum']}-{variant}"
+
+
+def is_weak_etag(etag: Optional[str]) -> bool:
+    """Checks if an ETag of :func:`get_etag` is weak.
+    :param etag: The ETag.
+    :return: True if the ETag is weak.
+    """
+    return etag is not None and etag.startswith("W/")
+
+
+def is_not_modified(etag: Optional[str], last_modified: datetime) -> bool:
+    """Checks the If-None-Match and If-Modified-Since headers of the request.
+    :param etag: The ETag of the file.
+    :param last_modified: The last modification of the file.
+    :return: True if the client has the current version of the file.
+    """
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def set_cache_headers(response: Response, etag: Optional[str], last_modified: datetime):
+    """Sets the validators (ETag and Last-Modified) and the Cache-Control header (config.CACHE_CONTROL).
+    :param response: The response.
+    :param etag: The ETag of the file.
+    :param last_modified: The last modification of the file.
+    """
+    if is_weak_etag(etag):
+        response.set_etag(etag[len("W/"):], weak=True)
+    elif etag is not None:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    if config.CACHE_CONTROL:
+        response.headers["Cache-Control"] = config.CACHE_CONTROL
+
+
+def make_not_modified_response(etag: Optional[str], last_modified: datetime, compressed: bool) -> Response:
+    """Creates the '304 Not Modified' response.
+    :param etag: The ETag of the file.
+    :param last_modified: The last modification of the file.
+    :param compressed: True if the file is compressed (the representation depends on Accept-Encoding).
+    :return: The flask response.
+    """
+    response = Response(status=304)
+    set_cache_headers(response, etag, last_modified)
+    if compressed:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def check_download(file: Row):
+    """Checks the expiration and the download limit of a file before it is downloaded. Every GET request of a file
+    with a download limit is counted as download (also conditional and range requests) and its response must not be
+    stored by caches.
+    Errors: :class:`FileDoesNotExists`, if the file has expired or all of its downloads have been used.
+    :param file: The index row of the file.
+    """
+    if is_file_expired(file):
+        raise FileDoesNotExists()
+    if file["max_downloads"] is None:
+        return
+    if request.method == "GET" and not count_download(file):
+        raise FileDoesNotExists()
+
+    @after_this_request
+    def disable_caching(response: Response) -> Response:
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+
+def get_requested_range(
+    content_length: int, last_modified: datetime, etag: Optional[str] = None
+) -> Optional[Tuple[int, int]]:
+    """Gets the requested byte range of the request (Range and If-Range headers).
+    Multiple ranges, other units and outdated If-Range validators are answered with the whole content.
+    Errors: :class:`RangeNotSatisfiable`.
+    :param content_length: The length of the whole content.
+    :param last_modified: The last modification of the file.
+    :param etag: The ETag of the file (a weak ETag never matches If-Range).
+    :return: None for the whole content or the start and the stop (exclusive) of the range.
+    """
+    requested_range = request.range
+    if requested_range is None or requested_range.units != "bytes" or len(requested_range.ranges) != 1:
+        return None
+    if "If-Range" in request.headers:
+        if_range = request.if_range
+        if if_range.etag is not None:
+            if request.headers["If-Range"].lstrip().startswith("W/") or is_weak_etag(etag) or if_range.etag != etag:
+                return None  # If-Range requires the strong comparison
+        elif if_range.date is None or if_range.date.replace(tzinfo=timezone.utc) != last_modified:
+            return None
+    start, stop = requested_range.ranges[0]
+    if start < 0:  # suffix range (e.g. 'bytes=-500')
+        start = max(content_length + start, 0)
+    if stop is None or stop > content_length:
+        stop = content_length
+    if start >= stop:
+        raise RangeNotSatisfiable(content_length)
+    return start, stop
+
+
+def make_content_response(
+    chunks: Iterable[bytes],
+    content_length: Optional[int],
+    byte_range: Optional[Tuple[int, int]],
+    filename: str,
+    last_modified: datetime,
+    etag: Optional[str],
+) -> Response:
+    """Creates the response of a (decrypted) file or of a byte range of the file.
+    :param chunks: The chunks of the response body (the whole file or the byte range).
+    :param content_length: The length of the whole file or None if it is unknown.
+    :param byte_range: The sent byte range or None if the whole file is sent.
+    :param filename: The name of the file (used for the mimetype).
+    :param last_modified: The last modification of the file.
+    :param etag: The ETag of the file.
+    :return: The flask response.
+    """
+    mimetype = guess_type(filename)[0] or "application/octet-stream"
+    response = Response(chunks, mimetype=mimetype)
+    if byte_range is None:
+        response.content_length = content_length
+    else:
+        start, stop = byte_range
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{content_length}"
+        response.content_length = stop - start
+    set_cache_headers(response, etag, last_modified)
+    response.accept_ranges = "bytes"
+    return response
+
+
+def open_content(file: BinaryIO, key: str, index_file: Row, derived_key: DerivedKey = None):
+    """Opens the content of a file of the index.
+    :param file: The file (opened in binary mode).
+    :param key: The decrypting key of the file.
+    :param index_file: The index row of the file.
+    :param derived_key: An already derived key of the key (e.g. of another file of the same group).
+    :return: :class:`EncryptedFile`, :class:`DedupFile` or :class:`CompressedFile`.
+    """
+    if index_file["storage"] == STORAGE_DEDUP:
+        return DedupFile(file, key, derived_key)
+    codec = read_codec_header(file)
+    encrypted_file = EncryptedFile(file, key, derived_key)
+    if codec is None:
+        return encrypted_file
+    return CompressedFile(encrypted_file, codec, index_file["size"])
+
+
+def accepts_content_encoding(codec: Codec) -> bool:
+    """Checks if the compressed content can be sent without decompression (Content-Encoding).
+    Byte ranges are always answered with the decompressed content.
+    :param codec: The codec of the content.
+    :return: True if the client accepts the encoding of the content.
+    """
+    encoding = codec.content_encoding
+    return encoding is not None and request.accept_encodings[encoding] > 0 and request.range is None
+
+
+def make_download_response(name: str, key: str, filename: str, index_file: Row) -> Response:
+    """Creates a streamed response of a decrypted file.
+    The file is decrypted chunk by chunk while the response is sent, so the memory usage per download
+    is bounded by config.STREAM_CHUNK_BYTES. If a byte range is requested, only the range is decrypted
+    and sent with '206 Partial Content'. Small files are served from and stored in the :data:`hot_object_cache`.
+    Compressed files are sent compressed to clients, which accept the encoding, and decompressed to other clients.
+    Requests with current validators (If-None-Match or If-Modified-Since) are answered with '304 Not Modified'
+    before the key derivation. Clients, which accept the encoding of a compressed file, are not served from the
+    :data:`hot_object_cache` (it holds the decompressed content), so the ETag always matches the sent content.
+    Errors: :class:`FileDoesNotExists`, :class:`RangeNotSatisfiable`, :class:`ServerBusy`.
+    :param name: The storage name of the encrypted file.
+    :param key: The decrypting key of the file.
+    :param filename: The name of the file (used for the mimetype).
+    :param index_file: The index row of the file.
+    :return: The flask response.
+    """
+    codec = get_codec(index_file["codec"])
+    encoded = codec is not None and accepts_content_encoding(codec)
+    etag = get_etag(index_file, codec.content_encoding if encoded else CODEC_IDENTITY)
+    cache_key = get_hot_cache_key(name, index_file)
+    cached = None if encoded else hot_object_cache.get(cache_key)
+    if cached is not None:
+        content, last_modified = cached
+        if is_not_modified(etag, last_modified):
+            return make_not_modified_response(etag, last_modified, codec is not None)
+        byte_range = get_requested_range(len(content), last_modified, etag)
+        start, stop = byte_range or (0, len(content))
+        response = make_content_response(
+            [content[start:stop]], len(content), byte_range, filename, last_modified, etag
+        )
+        if codec is not None:
+            response.vary.add("Accept-Encoding")
+        return response
+
+    stored = storage.stat(name)
+    if stored is None:
+        raise FileDoesNotExists()
+    last_modified = datetime.fromtimestamp(int(stored.modified), timezone.utc)
+    if is_not_modified(etag, last_modified):
+        return make_not_modified_response(etag, last_modified, codec is not None)
+    admit()
+    file = storage.open(name)
+    try:
+        content = open_content(file, key, index_file)
+        if encoded and isinstance(content, CompressedFile):
+            response = make_content_response(
+                content.iter_encoded(), content.encoded_size, None, filename, last_modified, etag
+            )
+            response.content_encoding = content.codec.content_encoding
+            response.vary.add("Accept-Encoding")
+            response.call_on_close(file.close)
+            return response
+        if content.size is not None and hot_object_cache.accepts(content.size):
+            data = b"".join(content.iter_chunks())
+            file.close()
+            hot_object_cache.set(cache_key, (data, last_modified), len(data))
+            byte_range = get_requested_range(len(data), last_modified, etag)
+            start, stop = byte_range or (0, len(data))
+            response = make_content_response([data[start:stop]], len(data), byte_range, filename, last_modified, etag)
+            if codec is not None:
+                response.vary.add("Accept-Encoding")
+            return response
+        byte_range = None if content.size is None else get_requested_range(content.size, last_modified, etag)
+    except BaseException:
+        file.close()
+        raise
+
+    start, stop = byte_range or (0, content.size)
+    response = make_content_response(
+        content.iter_chunks(start, stop), content.size, byte_range, filename, last_modified, etag
+    )
+    if isinstance(content, CompressedFile):
+        response.vary.add("Accept-Encoding")
+        if content.size is None:  # the size of compressed files is unknown after a rebuild of the index
+            response.accept_ranges = "none"
+    response.call_on_close(file.close)
+    return response
+
+
+def make_raw_response(name: str, index_file: Row) -> Response:
+    """Creates the response of the stored (encrypted) file for clients, which decrypt the file themselves.
+    The stored file is the response body, so it is handed to the wsgi server as file (wsgi.file_wrapper), which can
+    send it with sendfile without copying it through python (e.g. gunicorn in the prefork mode).
+    The headers describe the body: X-OpenCDN-Codec (the compression codec), X-OpenCDN-KDF and
+    X-OpenCDN-KDF-Parameters (the key derivation, password: the server key, salt: the key of the file),
+    X-OpenCDN-Cipher and X-OpenCDN-Content-Offset (the start of the encrypted content after the headers).
+    Errors: :class:`RawDownloadsDisabled`, :class:`FileDoesNotExists`, :class:`RangeNotSatisfiable`.
+    :param name: The storage name of the encrypted file.
+    :param index_file: The index row of the file.
+    :return: The flask response.
+    """
+    if not config.RAW_DOWNLOADS_ENABLED or index_file["storage"] == STORAGE_DEDUP:
+        raise RawDownloadsDisabled()
+    stored = storage.stat(name)
+    if stored is None:
+        raise FileDoesNotExists()
+    etag = get_etag(index_file, ETAG_RAW)
+    last_modified = datetime.fromtimestamp(int(stored.modified), timezone.utc)
+    if is_not_modified(etag, last_modified):
+        return make_not_modified_response(etag, last_modified, False)
+    with storage.open(name) as file:
+        codec = read_codec_header(file)
+        kdf = read_header(file)
+        content_offset = file.tell()
+    file = storage.open(name)  # a new file, so the position of the file descriptor is 0 (for sendfile)
+    try:
+        response = Response(
+            wrap_file(request.environ, file, config.STREAM_CHUNK_BYTES),
+            mimetype="application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.content_length = stored.size
+        set_cache_headers(response, etag, last_modified)
+        response.headers["X-OpenCDN-Codec"] = CODEC_IDENTITY if codec is None else codec.name
+        response.headers["X-OpenCDN-KDF"] = kdf.name
+        response.headers["X-OpenCDN-KDF-Parameters"] = ", ".join(
+            f"{key}={value}" for key, value in kdf.get_parameters().items()
+        )
+        response.headers["X-OpenCDN-Cipher"] = "aes-256-cfb8"
+        response.headers["X-OpenCDN-Content-Offset"] = str(content_offset)
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=stored.size)
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise RangeNotSatisfiable(stored.size)
+    except BaseException:
+        file.close()
+        raise
+
+
 @app.flask.route("/<string:key>/<string:filename>", methods=["GET", "DELETE"])
 def download(key: str, filename: str):
     """The flask download method for downloading and deleting.
@@ -27,8 +340,12 @@ def download(key: str, filename: str):
     Requires: /<key>/<filename>
             key: The decrypting key and identifier for the file.
             filename: The name of the file.
-    Errors: :class:`FileDoesNotExists`.
-    Return: error or the file.
+    Optional: Range and If-Range headers to download a single byte range of the file.
+              If-None-Match and If-Modified-Since headers for conditional requests ('304 Not Modified').
+              ?raw=1 to download the encrypted file for client side decryption (see :func:`make_raw_response`).
+    Errors: :class:`FileDoesNotExists` (also if the file has expired or all of its downloads have been used),
+            :class:`RangeNotSatisfiable`, :class:`RawDownloadsDisabled`.
+    Return: error or the file (or the byte range of the file).
 
     Deleting: (DELETE)
     ============
@@ -42,17 +359,14 @@ def download(key: str, filename: str):
     if "/" in key or "/" in filename or ".." in key or ".." in filename:
         raise FileDoesNotExists()
     hashed_key = hash_key(key)
-    filepath = f"{config.DATA_DIRECTORY}{hashed_key}/{filename}"
-    if not exists(filepath):
+    file = get_file(hashed_key, filename)
+    if file is None:
         raise FileDoesNotExists()
-    if request.method == "GET":
-        with open(filepath, "rb") as file:
-            content = file.read()
-        decrypted_content = decrypt(content, key)
-        file = BytesIO()
-        file.write(decrypted_content)
-        file.seek(0)
-        return send_file(file, attachment_filename=filename)
+    if request.method in ("GET", "HEAD"):
+        check_download(file)
+        if "raw" in request.args:
+            return make_raw_response(get_file_name(hashed_key, filename), file)
+        return make_download_response(get_file_name(hashed_key, filename), key, filename, file)
     elif request.method == "DELETE":
         parse_authentication(key, filename)
         delete_file(key, filename)
@@ -10,11 +10,28 @@ This module implements the encryption.
 import hashlib
 import string
 import random
+from io import BytesIO
+from time import perf_counter
+from typing import BinaryIO, Iterator, Optional
 
 from Crypto.Cipher import AES
-from pbkdf2 import PBKDF2
 
+from resources.api.cache import LRUCache
+from resources.api.crypto_pool import cipher_pool, kdf_pool
+from resources.api.errors import FileTooBig
+from resources.api.kdf import (
+    KeyDerivation,
+    LegacyPBKDF2,
+    get_default_key_derivation,
+    read_header,
+    write_header,
+)
 from resources.config import config
+from resources.metrics import StageTimings, measure
+
+"""Cache of the derived AES key material. The entries are identified by the KDF and the hashed key,
+never by the raw key."""
+derived_key_cache = LRUCache(config.DERIVED_KEY_CACHE_SIZE, config.DERIVED_KEY_CACHE_TTL)
 
 
 def generate_random_key(length: int) -> str:
@@ -38,38 +55,243 @@ def hash_key(key: str) -> str:
     return h.hexdigest()
 
 
-def make_aes(key: bytes):
+def derive_key(key: bytes, kdf: KeyDerivation) -> bytes:
+    """Derives the AES key material (32 bytes key and 16 bytes iv) from the key.
+    The derived material is cached in :data:`derived_key_cache` under the KDF and the hashed key.
+    The key is derived in the :data:`kdf_pool`.
+    :param key: The encrypting key.
+    :param kdf: The key derivation function.
+    :return: The 48 bytes key material.
+    """
+    identifier = (kdf.id, kdf.pack_parameters(), hash_key(key.decode("utf-8")))
+    material = derived_key_cache.get(identifier)
+    if material is None:
+        with measure("kdf"):
+            material = kdf_pool.run(kdf.get_derivation(config.SERVER_KEY.encode("utf-8"), key, 48))
+        derived_key_cache.set(identifier, material)
+    return material
+
+
+class DerivedKey:
+    """The derived AES key material of an encrypting key with the KDF for new files (see :func:`derive_upload_key`).
+    Files, which are encrypted with the same key (e.g. a batch upload into a group), can share it, so the key is
+    derived only once.
+    """
+
+    def __init__(self, kdf: KeyDerivation, material: bytes):
+        """
+        :param kdf: The key derivation function.
+        :param material: The 48 bytes key material.
+        """
+        self.kdf = kdf
+        self.material = material
+
+    def make_aes(self):
+        """Creates a new aes object with the key material.
+        :return: AES Object.
+        """
+        return AES.new(self.material[:32], AES.MODE_CFB, iv=self.material[32:])
+
+    def matches(self, kdf: KeyDerivation) -> bool:
+        """Checks if the key has been derived with the KDF (and its parameters).
+        :param kdf: The KDF of a file.
+        :return: True if the key material can be used for the file.
+        """
+        return self.kdf.id == kdf.id and self.kdf.pack_parameters() == kdf.pack_parameters()
+
+
+def derive_upload_key(key: str) -> DerivedKey:
+    """Derives the key material of new files with the default KDF.
+    :param key: The encrypting key (string).
+    :return: The derived key.
+    """
+    kdf = get_default_key_derivation()
+    return DerivedKey(kdf, derive_key(key.encode("utf-8"), kdf))
+
+
+def get_derived_key(key: str, kdf: KeyDerivation, derived_key: DerivedKey = None) -> DerivedKey:
+    """Gets the derived key of a file. An already derived key of the same key is reused, if it has been
+    derived with the KDF of the file (e.g. for all files of a group archive).
+    :param key: The encrypting key (string).
+    :param kdf: The KDF of the file.
+    :param derived_key: The already derived key or None.
+    :return: The derived key.
+    """
+    if derived_key is not None and derived_key.matches(kdf):
+        return derived_key
+    return DerivedKey(kdf, derive_key(key.encode("utf-8"), kdf))
+
+
+def make_aes(key: bytes, kdf: KeyDerivation = None):
     """Creates a new aes object with the key.
     :param key: The encrypting key.
+    :param kdf: The key derivation function (the legacy KDF by default).
     :return: AES Object.
     """
-    b = PBKDF2(config.SERVER_KEY, key).read(48)
+    if kdf is None:
+        kdf = LegacyPBKDF2()
+    b = derive_key(key, kdf)
     return AES.new(b[:32], AES.MODE_CFB, iv=b[32:])
 
 
-def encrypt(content: bytes, key: str) -> bytes:
+def encrypt(content: bytes, key: str, derived_key: DerivedKey = None) -> bytes:
     """Encrypts the content with the key (AES File encryption).
+    The encrypted content starts with the file header of the default KDF.
     :param content: The content to be encrypted.
     :param key: The key (string).
+    :param derived_key: The already derived key (see :func:`derive_upload_key`), derived from the key by default.
     :return: The encrypted content.
     """
-    aes = make_aes(key.encode("utf-8"))
+    if derived_key is None:
+        derived_key = derive_upload_key(key)
+    aes = derived_key.make_aes()
+    output = BytesIO()
+    write_header(output, derived_key.kdf)
     content_length = 16 - (len(content) % 16)
     content += bytes([content_length]) * content_length
-    return aes.encrypt(content)
+    with measure("encryption"):
+        output.write(cipher_pool.run(aes.encrypt, content))
+    return output.getvalue()
+
+
+def encrypt_stream(
+    source: BinaryIO, destination: BinaryIO, key: str, max_bytes: Optional[int], derived_key: DerivedKey = None
+) -> int:
+    """Encrypts the source stream chunk by chunk into the destination (AES File encryption).
+    The destination starts with the file header of the default KDF.
+    Errors: :class:`FileTooBig`.
+    :param source: The stream with the content to be encrypted.
+    :param destination: The file, which the encrypted content is written to.
+    :param key: The key (string).
+    :param max_bytes: The maximum size of the content. If the source is bigger, the encryption will be aborted.
+        None means no limit (e.g. if the source checks the size).
+    :param derived_key: The already derived key (see :func:`derive_upload_key`), derived from the key by default.
+    :return: The size of the (unencrypted) content.
+    """
+    if derived_key is None:
+        derived_key = derive_upload_key(key)
+    aes = derived_key.make_aes()
+    write_header(destination, derived_key.kdf)
+    timings = StageTimings()
+    content_size = 0
+    while True:
+        chunk = source.read(config.STREAM_CHUNK_BYTES)
+        if not chunk:
+            break
+        content_size += len(chunk)
+        if max_bytes is not None and content_size > max_bytes:
+            raise FileTooBig()
+        began = perf_counter()
+        encrypted_chunk = cipher_pool.run(aes.encrypt, chunk)
+        encrypted = perf_counter()
+        destination.write(encrypted_chunk)
+        timings.add("encryption", encrypted - began)
+        timings.add("disk_write", perf_counter() - encrypted)
+    padding_length = 16 - (content_size % 16)
+    destination.write(aes.encrypt(bytes([padding_length]) * padding_length))
+    timings.observe()
+    return content_size
 
 
-def decrypt(content: bytes, key: str) -> bytes:
-    """Decrypts the content.
+def decrypt(content: bytes, key: str, derived_key: DerivedKey = None) -> bytes:
+    """Decrypts the content. The KDF is taken from the file header (legacy files have no header).
     :param content: The encrypted content.
     :param key: The key (string).
+    :param derived_key: An already derived key of the key (see :func:`get_derived_key`).
     :return: The decrypted content.
     """
-    aes = make_aes(key.encode("utf-8"))
-    decrypted_content = aes.decrypt(content)
+    file = BytesIO(content)
+    aes = get_derived_key(key, read_header(file), derived_key).make_aes()
+    with measure("decryption"):
+        decrypted_content = cipher_pool.run(aes.decrypt, file.read())
     return decrypted_content[: -decrypted_content[-1]]
 
 
+class EncryptedFile:
+    """Read access to the decrypted content of an encrypted file.
+    AES-CFB (with 8 bit segments) can be decrypted from every position of the file, because the iv of a position
+    is the previous 16 bytes of the encrypted content. So ranges of the content can be decrypted without decrypting
+    the whole file.
+    """
+
+    def __init__(self, file: BinaryIO, key: str, derived_key: DerivedKey = None):
+        """Reads the header of the file, derives the key and reads the padding to get the size of the content.
+        :param file: The encrypted file (opened in binary mode and seekable).
+        :param key: The key (string).
+        :param derived_key: An already derived key of the key (see :func:`get_derived_key`).
+        """
+        self.file = file
+        self.timings = StageTimings()
+        self.kdf = read_header(file)
+        self.offset = file.tell()
+        self.derived_key = get_derived_key(key, self.kdf, derived_key)
+        self._aes_key = self.derived_key.material[:32]
+        self._iv = self.derived_key.material[32:]
+        file.seek(0, 2)
+        encrypted_size = file.tell() - self.offset
+        if encrypted_size == 0:
+            self.size = 0
+        else:
+            padding = self._make_aes(encrypted_size - 1).decrypt(self._read(encrypted_size - 1, 1))
+            self.size = max(encrypted_size - padding[0], 0)
+
+    def _read(self, position: int, length: int) -> bytes:
+        """Reads encrypted bytes.
+        :param position: The position in the encrypted content (after the header).
+        :param length: The amount of bytes.
+        :return: The encrypted bytes.
+        """
+        self.file.seek(self.offset + position)
+        return self.file.read(length)
+
+    def _make_aes(self, position: int):
+        """Creates an AES Object, which decrypts the encrypted content from the position.
+        :param position: The position in the encrypted content (after the header).
+        :return: AES Object.
+        """
+        previous_start = max(position - 16, 0)
+        iv = (self._iv + self._read(previous_start, position - previous_start))[-16:]
+        return AES.new(self._aes_key, AES.MODE_CFB, iv=iv)
+
+    def iter_chunks(self, start: int = 0, stop: int = None) -> Iterator[bytes]:
+        """Decrypts the content from start to stop in config.STREAM_CHUNK_BYTES big chunks.
+        :param start: The first byte of the content.
+        :param stop: The end (exclusive) of the content, the size of the content by default.
+        :return: Generator of the decrypted chunks.
+        """
+        if stop is None or stop > self.size:
+            stop = self.size
+        if start >= stop:
+            return
+        aes = self._make_aes(start)
+        self.file.seek(self.offset + start)
+        remaining = stop - start
+        try:
+            while remaining > 0:
+                began = perf_counter()
+                chunk = self.file.read(min(config.STREAM_CHUNK_BYTES, remaining))
+                read = perf_counter()
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                decrypted_chunk = cipher_pool.run(aes.decrypt, chunk)
+                self.timings.add("disk_read", read - began)
+                self.timings.add("decryption", perf_counter() - read)
+                yield decrypted_chunk
+        finally:
+            self.timings.observe()
+
+
+def decrypt_stream(file: BinaryIO, key: str) -> Iterator[bytes]:
+    """Decrypts an encrypted file chunk by chunk. The KDF is taken from the file header (legacy files have no header).
+    The key is derived before the generator is returned, so derivation errors are raised by this call.
+    :param file: The encrypted file (opened in binary mode).
+    :param key: The key (string).
+    :return: Generator of the decrypted chunks (without padding).
+    """
+    return EncryptedFile(file, key).iter_chunks()
+
+
 def get_data_directory() -> str:
     """Gets the data directory.
     :return: The data directory with a '/' at the end.
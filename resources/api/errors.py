@@ -24,6 +24,10 @@ class BasicError(Exception):
             "description": self.description,
         }
 
+    def get_headers(self) -> dict:
+        """Gets additional headers of the error response."""
+        return {}
+
 
 class NoFileInRequest(BasicError):
     id = 1
@@ -128,3 +132,62 @@ class FileAlreadyExists(BasicError):
     name = "file_already_exists"
     description = "The file already exists."
     http_return = 400
+
+
+class RangeNotSatisfiable(BasicError):
+    id = 16
+    name = "range_not_satisfiable"
+    description = "The requested range is not satisfiable."
+    http_return = 416
+
+    def __init__(self, content_length: int):
+        super().__init__()
+        self.content_length = content_length
+
+    def get_headers(self) -> dict:
+        return {"Content-Range": f"bytes */{self.content_length}"}
+
+
+class MetricsDisabled(BasicError):
+    id = 17
+    name = "metrics_disabled"
+    description = "The metrics are disabled on this server."
+    http_return = 404
+
+
+class ProfilerDisabled(BasicError):
+    id = 18
+    name = "profiler_disabled"
+    description = "The profiler is disabled on this server."
+    http_return = 404
+
+
+class ProfilerBusy(BasicError):
+    id = 19
+    name = "profiler_busy"
+    description = "The profiler is already running."
+    http_return = 409
+
+
+class RawDownloadsDisabled(BasicError):
+    id = 20
+    name = "raw_downloads_disabled"
+    description = "Raw downloads are disabled on this server or not available for this file."
+    http_return = 404
+
+
+class TooManyFiles(BasicError):
+    id = 21
+    name = "too_many_files"
+    description = f"The request contains too many files: {config.BATCH_UPLOAD_MAX_FILES} files are maximum."
+    http_return = 400
+
+
+class ServerBusy(BasicError):
+    id = 22
+    name = "server_busy"
+    description = "The server is busy, retry later."
+    http_return = 503
+
+    def get_headers(self) -> dict:
+        return {"Retry-After": str(config.CRYPTO_RETRY_AFTER)}
@@ -0,0 +1,106 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the removal of expired files (uploads with 'expires_in' or 'max_downloads').
+The expirations are saved in the metadata index, which has an index of the expiration times, so the sweeper only
+reads the expired files and does not walk the storage. The files are removed in batches of
+config.EXPIRATION_SWEEP_BATCH files with a pause after every batch, so the requests are not slowed down.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from sqlite3 import Row
+from threading import Lock, Thread
+from time import sleep, time
+
+from resources.api.cache import get_hot_cache_key, hot_object_cache
+from resources.api.dedup import release_file_chunks
+from resources.api.metadata import (
+    get_file_name,
+    get_key_directory,
+    list_expired_files,
+    remove_expired_file,
+    NO_GROUP,
+    STORAGE_DEDUP,
+)
+from resources.api.storage import storage
+from resources.config import config
+from resources.logger import logger, LogType
+
+"""The pause in seconds of the sweeper after every batch."""
+BATCH_PAUSE = 0.1
+
+
+def remove_file_content(file: Row):
+    """Removes the stored content of a file, which has been removed from the index.
+    :param file: The index row of the file.
+    """
+    name = get_file_name(file["hashed_key"], file["filename"], file["group_name"])
+    if file["storage"] == STORAGE_DEDUP and storage.stat(name) is not None:
+        release_file_chunks(name)
+    if file["group_name"] == NO_GROUP:
+        storage.delete_directory(get_key_directory(file["hashed_key"]))
+    else:
+        storage.delete(name)
+    hot_object_cache.invalidate(get_hot_cache_key(name, file))
+
+
+def remove_expired_files(now: float, limit: int) -> int:
+    """Removes a batch of expired files. The oldest expirations are removed first.
+    :param now: The current timestamp.
+    :param limit: The maximum amount of files.
+    :return: The amount of removed files.
+    """
+    removed = 0
+    for file in list_expired_files(now, limit):
+        if remove_expired_file(file):  # the file could have been removed or replaced in between
+            remove_file_content(file)
+            removed += 1
+    return removed
+
+
+class ExpirationSweeper:
+    """The background thread, which removes expired files every config.EXPIRATION_SWEEP_INTERVAL seconds.
+    The thread should only run in one process.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._started = False
+
+    def sweep(self) -> int:
+        """Removes all expired files in batches.
+        :return: The amount of removed files.
+        """
+        removed = 0
+        while True:
+            batch = remove_expired_files(time(), config.EXPIRATION_SWEEP_BATCH)
+            removed += batch
+            if batch < config.EXPIRATION_SWEEP_BATCH:
+                return removed
+            sleep(BATCH_PAUSE)
+
+    def start(self):
+        """Starts the sweeper thread (if config.EXPIRATION_SWEEP_INTERVAL is enabled)."""
+        if config.EXPIRATION_SWEEP_INTERVAL <= 0:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        Thread(target=self._run_sweeper, name="expiration-sweeper", daemon=True).start()
+
+    def _run_sweeper(self):
+        """The loop of the sweeper thread."""
+        while True:
+            try:
+                removed = self.sweep()
+                if removed > 0:
+                    logger.log(LogType.INFO, f"Removed {removed} expired files.")
+            except Exception as e:
+                logger.log(LogType.ERROR, f"The removal of expired files failed: {e!r}")
+            sleep(config.EXPIRATION_SWEEP_INTERVAL)
+
+
+expiration_sweeper = ExpirationSweeper()
@@ -6,23 +6,23 @@ This module implements the api group management.
 :copyright: (c) 2020 by AdriBloober.
 :license: GNU General Public License v3.0
 """
-import shutil
-from io import BytesIO
-from os import mkdir, listdir, remove
-from os.path import exists
+from typing import Iterator
 
-from flask import request, jsonify, send_file
+from flask import Response, request, jsonify
 
 from resources.app import app
+from resources.api.archive import ArchiveWriter, archive_writers
 from resources.api.authentication import (
-    get_group_directory,
     authenticate_group,
     run_api_with_authentication_required,
 )
+from resources.api.cache import get_hot_cache_key, hot_object_cache
+from resources.api.crypto_pool import admit
+from resources.api.dedup import release_file_chunks
+from resources.api.download import check_download, make_download_response, make_raw_response, open_content
 from resources.api.encryption import (
     hash_key,
     generate_random_key,
-    decrypt,
 )
 from resources.api.errors import (
     BadRequest,
@@ -31,7 +31,27 @@ from resources.api.errors import (
     FileDoesNotExists,
     InvalidGroupName,
 )
+from resources.api.metadata import (
+    private_key_file_name,
+    get_file,
+    get_file_name,
+    get_group_directory,
+    get_key_directory,
+    write_hashed_private_key,
+    get_group,
+    add_group,
+    remove_group,
+    remove_file,
+    list_group_file_rows,
+    list_group_files_page,
+    list_group_files_with_storage,
+    count_download,
+    is_file_expired,
+    STORAGE_DEDUP,
+)
+from resources.api.storage import storage
 from resources.config import config
+from resources.logger import logger, LogType
 
 
 def is_group_name_valid(group_name: str) -> bool:
@@ -47,6 +67,22 @@ def is_group_name_valid(group_name: str) -> bool:
     return True
 
 
+def parse_listing_limit() -> int:
+    """Parses the 'limit' of a group listing.
+    Errors: :class:`BadRequest`.
+    :return: The maximum amount of listed files.
+    """
+    if "limit" not in request.form:
+        return config.GROUP_LISTING_PAGE_SIZE
+    try:
+        limit = int(request.form["limit"])
+    except ValueError:
+        raise BadRequest()
+    if not 1 <= limit <= config.GROUP_LISTING_MAX_PAGE_SIZE:
+        raise BadRequest()
+    return limit
+
+
 @app.flask.route("/group/<string:name>", methods=["PUT", "POST", "DELETE"])
 def group(name: str):
     """Show, Create and Delete groups.
@@ -55,10 +91,15 @@ def group(name: str):
     Show Group: (PUT)
     ==========
     Requires: private_key (the private_key of the group), key (the key of the group).
-    Errors: :class:`GroupDoesNotExists`, :class:`ActionDenied`.
+    Optional: limit (the maximum amount of files, config.GROUP_LISTING_PAGE_SIZE by default and at most
+              config.GROUP_LISTING_MAX_PAGE_SIZE), after (the 'next' of the previous page), prefix (only filenames
+              with this prefix).
+    Errors: :class:`GroupDoesNotExists`, :class:`ActionDenied`, :class:`BadRequest`.
     Returns: error or json {
                 'hashed_key': 'the key, but hashed.',
-                'files': 'List of filenames, which are saved in this group.',
+                'files': 'List of filenames of the page (ordered by the filename).',
+                'entries': 'List of the files of the page with filename, size (None if unknown) and modified.',
+                'next': 'The cursor of the next page (for after) or None if this is the last page.',
             }
 
     Create Group: (POST)
@@ -85,20 +126,23 @@ def group(name: str):
     if request.method == "PUT":
         if not is_group_name_valid(name):
             raise GroupDoesNotExists()
-        path = get_group_directory() + f"/{name}"
-        if not exists(path):
-            raise GroupDoesNotExists()
         if "private_key" not in request.form or "key" not in request.form:
             raise BadRequest()
         key = request.form["key"]
         hashed_key = hash_key(key)
         private_key = request.form["private_key"]
-        authenticate_group(name, private_key)
-        if not exists(path + "/" + hashed_key):
+        group_information = authenticate_group(name, private_key)
+        if group_information["hashed_key"] != hashed_key:
             raise GroupDoesNotExists()
+        limit = parse_listing_limit()
+        files, cursor = list_group_files_page(
+            group_information, limit, request.form.get("after", ""), request.form.get("prefix", "")
+        )
         informations = {
             "hashed_key": hashed_key,
-            "files": listdir(path + "/" + hashed_key),
+            "files": [file["filename"] for file in files],
+            "entries": files,
+            "next": cursor,
         }
         return jsonify(informations)
     elif request.method == "POST":
@@ -106,8 +150,7 @@ def group(name: str):
             run_api_with_authentication_required()
         if not is_group_name_valid(name):
             raise InvalidGroupName()
-        path = get_group_directory() + f"/{name}"
-        if exists(path):
+        if get_group(name) is not None:
             raise GroupAlreadyExists()
         if "private_key" in request.form:
             private_key = request.form["private_key"]
@@ -115,10 +158,12 @@ def group(name: str):
             private_key = generate_random_key(config.RANDOM_PRIVATE_KEY_LENGTH)
         key = generate_random_key(config.RANDOM_KEY_LENGTH)
         hashed_key = hash_key(key)
-        mkdir(path)
-        mkdir(path + "/" + hashed_key)
-        with open(path + "/private.key", "w") as private_file:
-            private_file.write(hash_key(private_key))
+        private_key_name = get_group_directory(name) + private_key_file_name
+        if storage.stat(private_key_name) is not None:
+            raise GroupAlreadyExists()
+        storage.make_directory(get_key_directory(hashed_key, name))
+        write_hashed_private_key(private_key_name, hash_key(private_key))
+        add_group(name, hashed_key, hash_key(private_key))
         return jsonify(
             {
                 "name": name,
@@ -132,8 +177,12 @@ def group(name: str):
             raise BadRequest()
         private_key = request.form["private_key"]
         authenticate_group(name, private_key)
-        path = get_group_directory() + f"/{name}"
-        shutil.rmtree(path)
+        dedup_files = list_group_files_with_storage(name, STORAGE_DEDUP)
+        for file in dedup_files:
+            release_file_chunks(get_file_name(file["hashed_key"], file["filename"], name))
+        remove_group(name)
+        storage.delete_directory(get_group_directory(name))
+        hot_object_cache.invalidate_prefix(get_group_directory(name))
         return jsonify({"status": "success"})
 
 
@@ -151,8 +200,12 @@ def download_group_file(name: str, key: str, filename: str):
     Download: (GET)
     ===========
 
-    Errors: :class:`FileDoesNotExists`.
-    Returns: error or the raw content of the file.
+    Optional: Range and If-Range headers to download a single byte range of the file.
+              If-None-Match and If-Modified-Since headers for conditional requests ('304 Not Modified').
+              ?raw=1 to download the encrypted file for client side decryption.
+    Errors: :class:`FileDoesNotExists` (also if the file has expired or all of its downloads have been used),
+            :class:`RangeNotSatisfiable`, :class:`RawDownloadsDisabled`.
+    Returns: error or the raw content of the file (or the byte range of the file).
 
     Delete: (DELETE)
     ===========
@@ -166,24 +219,109 @@ def download_group_file(name: str, key: str, filename: str):
     if ".." in filename or "/" in filename:
         raise FileDoesNotExists()
     hashed_key = hash_key(key)
-    path = f"{get_group_directory()}/{name}/{hashed_key}"
-    if not exists(path):
-        raise FileDoesNotExists()
-    file_path = f"{path}/{filename}"
-    if not exists(file_path):
+    file = get_file(hashed_key, filename, name)
+    if file is None:
         raise FileDoesNotExists()
-    if request.method == "GET":
-        with open(file_path, "rb") as file:
-            content = file.read()
-        decrypted_content = decrypt(content, key)
-        file = BytesIO()
-        file.write(decrypted_content)
-        file.seek(0)
-        return send_file(file, attachment_filename=filename)
+    file_name = get_file_name(hashed_key, filename, name)
+    if request.method in ("GET", "HEAD"):
+        check_download(file)
+        if "raw" in request.args:
+            return make_raw_response(file_name, file)
+        return make_download_response(file_name, key, filename, file)
     elif request.method == "DELETE":
         if "private_key" not in request.form:
             raise BadRequest()
         private_key = request.form["private_key"]
         authenticate_group(name, private_key)
-        remove(file_path)
+        if file["storage"] == STORAGE_DEDUP:
+            release_file_chunks(file_name)
+        remove_file(hashed_key, filename, name)
+        storage.delete(file_name)
+        hot_object_cache.invalidate(get_hot_cache_key(file_name, file))
         return jsonify({"status": "success"})
+
+
+def iter_group_archive(name: str, key: str, hashed_key: str, writer: ArchiveWriter) -> Iterator[bytes]:
+    """Streams all files of a group into an archive. The files are decrypted one after another chunk by chunk and
+    the key is derived only once for all files (as long as they have the same KDF). Expired files and files without
+    remaining downloads are left out, the files with a download limit are counted as downloaded.
+    :param name: The name of the group.
+    :param key: The key of the group.
+    :param hashed_key: The hashed key of the group.
+    :param writer: The archive writer.
+    :return: Generator of the bytes of the archive.
+    """
+    derived_key = None
+    after = ""
+    while True:
+        index_files = list_group_file_rows(name, hashed_key, after, config.GROUP_LISTING_PAGE_SIZE)
+        for index_file in index_files:
+            if is_file_expired(index_file) or not count_download(index_file):
+                continue
+            file_name = get_file_name(hashed_key, index_file["filename"], name)
+            if storage.stat(file_name) is None:
+                logger.log(LogType.WARNING, f"The group file {file_name} is missing in the storage.")
+                continue
+            file = storage.open(file_name)
+            try:
+                content = open_content(file, key, index_file, derived_key)
+                derived_key = content.derived_key
+                size = content.size
+                if size is None and writer.requires_size:  # files of a rebuilt index (e.g. compressed files)
+                    size = sum(len(chunk) for chunk in content.iter_chunks())
+                yield from writer.add(index_file["filename"], size, index_file["created"], content.iter_chunks())
+            finally:
+                file.close()
+        if len(index_files) < config.GROUP_LISTING_PAGE_SIZE:
+            break
+        after = index_files[-1]["filename"]
+    yield writer.close()
+
+
+"""The header, which contains the private_key of a group for downloading the group archive with GET."""
+PRIVATE_KEY_HEADER = "X-Private-Key"
+
+
+def parse_archive_private_key() -> str:
+    """Parses the private_key of the group of an archive download: from the form (POST), the
+    :data:`PRIVATE_KEY_HEADER` header or the query string (GET requests have no form).
+    Errors: :class:`BadRequest`.
+    :return: The private_key.
+    """
+    private_key = (
+        request.form.get("private_key") or request.headers.get(PRIVATE_KEY_HEADER) or request.args.get("private_key")
+    )
+    if not private_key:
+        raise BadRequest()
+    return private_key
+
+
+@app.flask.route("/<string:name>/<string:key>/", methods=["GET", "POST"])
+def download_group_archive(name: str, key: str):
+    """Download all files of a group as one archive, which is streamed while the files are decrypted.
+    The archive is neither saved on the disk nor kept in memory.
+    :param name: The name of the group.
+    :param key: The encrypting key of the group.
+
+    Requires: private_key (the private_key of the group, as form value like the group listing, as X-Private-Key header
+              or as ?private_key= for GET requests).
+    Optional: ?archive=zip (default) or ?archive=tar.
+    Errors: :class:`GroupDoesNotExists`, :class:`AccessDenied`, :class:`BadRequest`, :class:`ServerBusy`.
+    Returns: error or the archive.
+    """
+    if not is_group_name_valid(name):
+        raise GroupDoesNotExists()
+    private_key = parse_archive_private_key()
+    archive = request.args.get("archive", "zip").lower()
+    if archive not in archive_writers:
+        raise BadRequest()
+    hashed_key = hash_key(key)
+    group_information = authenticate_group(name, private_key)
+    if group_information["hashed_key"] != hashed_key:
+        raise GroupDoesNotExists()
+    admit()
+    writer = archive_writers[archive]()
+    response = Response(iter_group_archive(name, key, hashed_key, writer), mimetype=writer.mimetype)
+    response.headers.set("Content-Disposition", "attachment", filename=f"{name}.{writer.name}")
+    response.headers["Cache-Control"] = "no-store"  # the archive can contain files with a download limit
+    return response
@@ -0,0 +1,189 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the key derivation functions and the file header, which records them.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import hashlib
+import struct
+from functools import partial
+from typing import BinaryIO, Callable
+
+from resources.config import config
+
+"""Every file, which was written with a key derivation header, starts with these bytes."""
+FILE_HEADER_MAGIC = b"\x89OCDN\r\n\x1a"
+
+
+class KeyDerivation:
+    """The basic key derivation function (KDF).
+    Every KDF has an unique id, which is written into the file header.
+    """
+
+    id = 0
+    name = "basic"
+
+    def derive(self, password: bytes, salt: bytes, length: int) -> bytes:
+        """Derives the key material.
+        :param password: The password (the server key).
+        :param salt: The salt (the encrypting key of the file).
+        :param length: The length of the key material.
+        :return: The key material.
+        """
+        return self.get_derivation(password, salt, length)()
+
+    def get_derivation(self, password: bytes, salt: bytes, length: int) -> Callable[[], bytes]:
+        """Gets the hashlib call, which derives the key material. It only references hashlib, so it can be sent to
+        the processes of the kdf pool without importing the server modules (see :mod:`resources.api.crypto_pool`).
+        :param password: The password (the server key).
+        :param salt: The salt (the encrypting key of the file).
+        :param length: The length of the key material.
+        :return: The call without arguments.
+        """
+        raise NotImplementedError()
+
+    def pack_parameters(self) -> bytes:
+        """Packs the parameters of the KDF for the file header.
+        :return: The packed parameters.
+        """
+        return b""
+
+    def get_parameters(self) -> dict:
+        """Gets the parameters of the KDF (e.g. for clients, which derive the key themselves).
+        :return: dict of the parameters.
+        """
+        return {}
+
+    @classmethod
+    def unpack_parameters(cls, parameters: bytes):
+        """Creates the KDF from packed parameters.
+        :param parameters: The packed parameters of the file header.
+        :return: The KDF object.
+        """
+        return cls()
+
+
+class LegacyPBKDF2(KeyDerivation):
+    """The key derivation of files without header: PBKDF2 with HMAC-SHA1 and 1000 iterations.
+    This equals the defaults of the 'pbkdf2' package, which was used before the file header was introduced.
+    """
+
+    id = 0
+    name = "legacy"
+
+    def get_derivation(self, password: bytes, salt: bytes, length: int) -> Callable[[], bytes]:
+        return partial(hashlib.pbkdf2_hmac, "sha1", password, salt, 1000, length)
+
+    def get_parameters(self) -> dict:
+        return {"hash": "sha1", "iterations": 1000}
+
+
+class PBKDF2SHA256(KeyDerivation):
+    """PBKDF2 with HMAC-SHA256 and a configurable amount of iterations."""
+
+    id = 1
+    name = "pbkdf2_sha256"
+
+    def __init__(self, iterations: int):
+        self.iterations = iterations
+
+    def get_derivation(self, password: bytes, salt: bytes, length: int) -> Callable[[], bytes]:
+        return partial(hashlib.pbkdf2_hmac, "sha256", password, salt, self.iterations, length)
+
+    def pack_parameters(self) -> bytes:
+        return struct.pack(">I", self.iterations)
+
+    def get_parameters(self) -> dict:
+        return {"hash": "sha256", "iterations": self.iterations}
+
+    @classmethod
+    def unpack_parameters(cls, parameters: bytes):
+        return cls(*struct.unpack(">I", parameters))
+
+
+class Scrypt(KeyDerivation):
+    """Scrypt with a configurable cost (n = 2 ** cost), block size 8 and parallelization 1."""
+
+    id = 2
+    name = "scrypt"
+    block_size = 8
+    parallelization = 1
+
+    def __init__(self, cost: int):
+        self.cost = cost
+
+    def get_derivation(self, password: bytes, salt: bytes, length: int) -> Callable[[], bytes]:
+        n = 2 ** self.cost
+        return partial(
+            hashlib.scrypt,
+            password,
+            salt=salt,
+            n=n,
+            r=self.block_size,
+            p=self.parallelization,
+            maxmem=256 * self.block_size * n,
+            dklen=length,
+        )
+
+    def pack_parameters(self) -> bytes:
+        return struct.pack(">B", self.cost)
+
+    def get_parameters(self) -> dict:
+        return {"n": 2 ** self.cost, "r": self.block_size, "p": self.parallelization}
+
+    @classmethod
+    def unpack_parameters(cls, parameters: bytes):
+        return cls(*struct.unpack(">B", parameters))
+
+
+"""All KDFs with their ids."""
+key_derivations = {kdf.id: kdf for kdf in (LegacyPBKDF2, PBKDF2SHA256, Scrypt)}
+
+
+def get_default_key_derivation() -> KeyDerivation:
+    """Gets the KDF for new files (config.KDF_ALGORITHM).
+    :return: The KDF object.
+    """
+    algorithm = config.KDF_ALGORITHM.lower()
+    if algorithm == LegacyPBKDF2.name:
+        return LegacyPBKDF2()
+    elif algorithm == PBKDF2SHA256.name:
+        return PBKDF2SHA256(config.KDF_ITERATIONS)
+    elif algorithm == Scrypt.name:
+        return Scrypt(config.KDF_SCRYPT_COST)
+    else:
+        raise ValueError(
+            f"The KDF_ALGORITHM {config.KDF_ALGORITHM} should be 'pbkdf2_sha256', 'scrypt' or 'legacy'."
+        )
+
+
+def write_header(file: BinaryIO, kdf: KeyDerivation):
+    """Writes the file header, which records the KDF and its parameters.
+    Files of the legacy KDF are written without header.
+    :param file: The encrypted file.
+    :param kdf: The KDF of the file.
+    """
+    if isinstance(kdf, LegacyPBKDF2):
+        return
+    parameters = kdf.pack_parameters()
+    file.write(FILE_HEADER_MAGIC + struct.pack(">BB", kdf.id, len(parameters)) + parameters)
+
+
+def read_header(file: BinaryIO) -> KeyDerivation:
+    """Reads the file header. After reading, the file is positioned at the beginning of the encrypted content.
+    Files without header are legacy files.
+    :param file: The encrypted file (seekable).
+    :return: The KDF of the file.
+    """
+    start = file.tell()
+    magic = file.read(len(FILE_HEADER_MAGIC))
+    if magic != FILE_HEADER_MAGIC:
+        file.seek(start)
+        return LegacyPBKDF2()
+    kdf_id, parameters_length = struct.unpack(">BB", file.read(2))
+    if kdf_id not in key_derivations:
+        raise ValueError(f"The file was encrypted with the unknown KDF {kdf_id}.")
+    return key_derivations[kdf_id].unpack_parameters(file.read(parameters_length))
@@ -0,0 +1,471 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the metadata index of the files and groups.
+The index is a SQLite database in the data directory, so lookups and authentications do not need to probe the
+file system. It is maintained by the upload and delete paths and can be rebuilt from the storage.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import hashlib
+import re
+from sqlite3 import Row
+from time import time, time_ns
+from typing import List, Optional, Tuple
+
+from resources.api.cache import LRUCache
+from resources.api.compression import CODEC_IDENTITY, read_codec_name
+from resources.api.database import Database
+from resources.api.storage import storage
+from resources.config import config
+
+"""The name of the files, which contain the hashed private key."""
+private_key_file_name = "private.key"
+
+"""The name of the group directory in the data directory."""
+group_directory_name = "groups"
+
+"""The name of the directory of the dedup chunks."""
+chunk_directory_name = "chunks"
+
+"""Single files (files without group) are saved with this group name in the index."""
+NO_GROUP = ""
+
+"""The storage of files, which are saved as one encrypted file."""
+STORAGE_FILE = "file"
+"""The storage of files, which are saved as manifest of deduplicated chunks (see :mod:`resources.api.dedup`)."""
+STORAGE_DEDUP = "dedup"
+
+metadata_index = Database(
+    "index.db",
+    [
+        "CREATE TABLE IF NOT EXISTS files ("
+        "group_name TEXT NOT NULL, hashed_key TEXT NOT NULL, filename TEXT NOT NULL, size INTEGER, "
+        "hashed_private_key TEXT, checksum TEXT, created REAL NOT NULL, "
+        "PRIMARY KEY (group_name, hashed_key, filename))",
+        "CREATE TABLE IF NOT EXISTS groups ("
+        "name TEXT PRIMARY KEY, hashed_key TEXT NOT NULL, hashed_private_key TEXT NOT NULL, created REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL)",
+    ],
+    [
+        f"ALTER TABLE files ADD COLUMN storage TEXT NOT NULL DEFAULT '{STORAGE_FILE}'",
+        f"ALTER TABLE files ADD COLUMN codec TEXT NOT NULL DEFAULT '{CODEC_IDENTITY}'",
+        "ALTER TABLE groups ADD COLUMN revision INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE files ADD COLUMN expires REAL",
+        "ALTER TABLE files ADD COLUMN max_downloads INTEGER",
+        "ALTER TABLE files ADD COLUMN downloads INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS files_expires ON files (expires) WHERE expires IS NOT NULL",
+        "ALTER TABLE chunks ADD COLUMN deleting REAL",
+    ],
+)
+
+"""Cache of the pages of the group listings (see :func:`list_group_files_page`). The entries are identified by the
+revision of the group, which is increased by every change of the files of the group, so changed groups are never
+listed from the cache (also in other processes of the prefork mode)."""
+group_listing_cache = LRUCache(config.GROUP_LISTING_CACHE_SIZE, config.GROUP_LISTING_CACHE_TTL)
+
+
+def get_new_revision() -> int:
+    """Gets the revision of a new (or rebuilt) group: the current time in microseconds. So the revisions of a
+    removed and created again group are not used again and the listing cache does not return the old pages.
+    :return: The revision.
+    """
+    return time_ns() // 1000
+
+
+def bump_group_revision(connection, name: str):
+    """Increases the revision of a group (at least to :func:`get_new_revision`) in a transaction of the index.
+    :param connection: The connection of the transaction.
+    :param name: The name of the group.
+    """
+    connection.execute("UPDATE groups SET revision = MAX(revision + 1, ?) WHERE name = ?", (get_new_revision(), name))
+
+
+def get_key_directory(hashed_key: str, group: str = NO_GROUP) -> str:
+    """Gets the storage name of the directory of a hashed key.
+    :param hashed_key: The hashed key.
+    :param group: The name of the group of the key.
+    :return: The name of the directory with a '/' at the end.
+    """
+    if group == NO_GROUP:
+        return f"{hashed_key}/"
+    return f"{get_group_directory(group)}{hashed_key}/"
+
+
+def get_group_directory(name: str) -> str:
+    """Gets the storage name of the directory of a group.
+    :param name: The name of the group.
+    :return: The name of the directory with a '/' at the end.
+    """
+    return f"{group_directory_name}/{name}/"
+
+
+def get_file_name(hashed_key: str, filename: str, group: str = NO_GROUP) -> str:
+    """Gets the storage name of a file.
+    :param hashed_key: The hashed key of the file.
+    :param filename: The filename of the file.
+    :param group: The name of the group of the file.
+    :return: The name of the file in the storage.
+    """
+    return get_key_directory(hashed_key, group) + filename
+
+
+def add_file(
+    hashed_key: str,
+    filename: str,
+    size: Optional[int],
+    checksum: str,
+    hashed_private_key: Optional[str] = None,
+    group: str = NO_GROUP,
+    created: float = None,
+    storage: str = STORAGE_FILE,
+    codec: str = CODEC_IDENTITY,
+    expires: float = None,
+    max_downloads: int = None,
+):
+    """Adds a file to the index (or replaces it).
+    :param hashed_key: The hashed key of the file.
+    :param filename: The filename of the file.
+    :param size: The size of the (unencrypted) content or None if it is unknown.
+    :param checksum: The sha256 hex digest of the encrypted file.
+    :param hashed_private_key: The hashed private key of the file (None for group files).
+    :param group: The name of the group of the file.
+    :param created: The timestamp of the upload (now by default).
+    :param storage: The storage of the file (STORAGE_FILE or STORAGE_DEDUP).
+    :param codec: The name of the compression codec of the file.
+    :param expires: The timestamp, after which the file expires, or None if the file never expires.
+    :param max_downloads: The maximum amount of downloads of the file or None for unlimited downloads.
+    """
+    with metadata_index.transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO files "
+            "(group_name, hashed_key, filename, size, hashed_private_key, checksum, created, storage, codec, "
+            "expires, max_downloads) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                group, hashed_key, filename, size, hashed_private_key, checksum, created or time(), storage, codec,
+                expires, max_downloads,
+            ),
+        )
+        if group != NO_GROUP:
+            bump_group_revision(connection, group)
+
+
+def get_file(hashed_key: str, filename: str, group: str = NO_GROUP) -> Optional[Row]:
+    """Gets a file of the index.
+    :param hashed_key: The hashed key of the file.
+    :param filename: The filename of the file.
+    :param group: The name of the group of the file.
+    :return: The row of the file or None if the file does not exists.
+    """
+    return metadata_index.execute(
+        "SELECT * FROM files WHERE group_name = ? AND hashed_key = ? AND filename = ?",
+        (group, hashed_key, filename),
+    ).fetchone()
+
+
+def is_file_expired(file: Row) -> bool:
+    """Checks if a file has expired or all of its downloads have been used. Expired files are removed by the
+    expiration sweeper (see :mod:`resources.api.expiration`).
+    :param file: The index row of the file.
+    :return: True if the file can not be downloaded anymore.
+    """
+    if file["expires"] is not None and file["expires"] <= time():
+        return True
+    return file["max_downloads"] is not None and file["downloads"] >= file["max_downloads"]
+
+
+def count_download(file: Row) -> bool:
+    """Counts a download of a file with a download limit. After the last download, the file expires in
+    config.EXPIRATION_GRACE seconds, so running downloads can finish before the file is removed.
+    :param file: The index row of the file.
+    :return: False if all downloads of the file have been used (by other requests).
+    """
+    if file["max_downloads"] is None:
+        return True
+    grace_end = time() + config.EXPIRATION_GRACE
+    cursor = metadata_index.execute(
+        "UPDATE files SET downloads = downloads + 1, "
+        "expires = CASE WHEN downloads + 1 >= max_downloads THEN MIN(IFNULL(expires, ?), ?) ELSE expires END "
+        "WHERE group_name = ? AND hashed_key = ? AND filename = ? AND downloads < max_downloads",
+        (grace_end, grace_end, file["group_name"], file["hashed_key"], file["filename"]),
+    )
+    return cursor.rowcount > 0
+
+
+def list_expired_files(now: float, limit: int) -> List[Row]:
+    """Lists the expired files ordered by their expiration (read from the index of the expiration times, so the
+    costs depend on the amount of expired files and not on the amount of files).
+    :param now: The current timestamp.
+    :param limit: The maximum amount of files.
+    :return: List of the rows.
+    """
+    return metadata_index.execute(
+        "SELECT * FROM files WHERE expires IS NOT NULL AND expires <= ? ORDER BY expires LIMIT ?", (now, limit)
+    ).fetchall()
+
+
+def remove_expired_file(file: Row) -> bool:
+    """Removes an expired file from the index, if it has not been replaced or removed in between.
+    :param file: The index row of the file (see :func:`list_expired_files`).
+    :return: True if the file has been removed by this call.
+    """
+    with metadata_index.transaction() as connection:
+        cursor = connection.execute(
+            "DELETE FROM files WHERE group_name = ? AND hashed_key = ? AND filename = ? AND created = ? "
+            "AND expires <= ?",
+            (file["group_name"], file["hashed_key"], file["filename"], file["created"], file["expires"]),
+        )
+        if cursor.rowcount == 0:
+            return False
+        if file["group_name"] != NO_GROUP:
+            bump_group_revision(connection, file["group_name"])
+    return True
+
+
+def remove_file(hashed_key: str, filename: str, group: str = NO_GROUP):
+    """Removes a file from the index.
+    :param hashed_key: The hashed key of the file.
+    :param filename: The filename of the file.
+    :param group: The name of the group of the file.
+    """
+    with metadata_index.transaction() as connection:
+        connection.execute(
+            "DELETE FROM files WHERE group_name = ? AND hashed_key = ? AND filename = ?",
+            (group, hashed_key, filename),
+        )
+        if group != NO_GROUP:
+            bump_group_revision(connection, group)
+
+
+def add_group(name: str, hashed_key: str, hashed_private_key: str, created: float = None):
+    """Adds a group to the index (or replaces it) with a new revision (see :func:`get_new_revision`).
+    :param name: The name of the group.
+    :param hashed_key: The hashed key of the group.
+    :param hashed_private_key: The hashed private key of the group.
+    :param created: The timestamp of the creation (now by default).
+    """
+    metadata_index.execute(
+        "INSERT OR REPLACE INTO groups (name, hashed_key, hashed_private_key, created, revision) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (name, hashed_key, hashed_private_key, created or time(), get_new_revision()),
+    )
+
+
+def get_group(name: str) -> Optional[Row]:
+    """Gets a group of the index.
+    :param name: The name of the group.
+    :return: The row of the group or None if the group does not exists.
+    """
+    return metadata_index.execute("SELECT * FROM groups WHERE name = ?", (name,)).fetchone()
+
+
+def remove_group(name: str):
+    """Removes a group and all files of the group from the index. Like every change of the files of the group, the
+    removal bumps the revision.
+    :param name: The name of the group.
+    """
+    with metadata_index.transaction() as connection:
+        bump_group_revision(connection, name)
+        connection.execute("DELETE FROM files WHERE group_name = ?", (name,))
+        connection.execute("DELETE FROM groups WHERE name = ?", (name,))
+
+
+def get_prefix_end(prefix: str) -> Optional[str]:
+    """Gets the smallest string after all strings with the prefix (the exclusive upper bound of a prefix search).
+    :param prefix: The prefix.
+    :return: The upper bound or None if there is no upper bound.
+    """
+    while prefix and ord(prefix[-1]) == 0x10FFFF:
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def list_group_files_page(
+    group: Row, limit: int, after: str = "", prefix: str = ""
+) -> Tuple[List[dict], Optional[str]]:
+    """Lists a page of the files of a group ordered by the filename. The page is read from the primary key of the
+    index, so the costs depend on the size of the page and not on the size of the group.
+    The pages are cached in :data:`group_listing_cache`.
+    :param group: The index row of the group.
+    :param limit: The maximum amount of files of the page.
+    :param after: The cursor: only files after this filename are listed (the 'next' of the previous page).
+    :param prefix: Only files with this filename prefix are listed.
+    :return: List of the files (filename, size and modified) and the cursor of the next page or None if this is
+        the last page. The size is None for files, which have been added by a rebuild of the index.
+    """
+    identifier = (group["name"], group["hashed_key"], group["revision"], limit, after, prefix)
+    page = group_listing_cache.get(identifier)
+    if page is not None:
+        return page
+    statement = "SELECT filename, size, created FROM files WHERE group_name = ? AND hashed_key = ? AND filename > ?"
+    parameters = [group["name"], group["hashed_key"], after]
+    if prefix:
+        statement += " AND filename >= ?"
+        parameters.append(prefix)
+        prefix_end = get_prefix_end(prefix)
+        if prefix_end is not None:
+            statement += " AND filename < ?"
+            parameters.append(prefix_end)
+    rows = metadata_index.execute(statement + " ORDER BY filename LIMIT ?", (*parameters, limit + 1)).fetchall()
+    files = [{"filename": row["filename"], "size": row["size"], "modified": row["created"]} for row in rows[:limit]]
+    page = (files, files[-1]["filename"] if len(rows) > limit else None)
+    group_listing_cache.set(identifier, page)
+    return page
+
+
+def list_group_file_rows(name: str, hashed_key: str, after: str, limit: int) -> List[Row]:
+    """Lists the index rows of the files of a group ordered by the filename (uncached).
+    :param name: The name of the group.
+    :param hashed_key: The hashed key of the group.
+    :param after: Only files after this filename are listed.
+    :param limit: The maximum amount of files.
+    :return: List of the rows.
+    """
+    return metadata_index.execute(
+        "SELECT * FROM files WHERE group_name = ? AND hashed_key = ? AND filename > ? ORDER BY filename LIMIT ?",
+        (name, hashed_key, after, limit),
+    ).fetchall()
+
+
+def list_group_files_with_storage(name: str, storage: str) -> List[Row]:
+    """Lists the files of a group, which are saved in a storage.
+    :param name: The name of the group.
+    :param storage: The storage (STORAGE_FILE or STORAGE_DEDUP).
+    :return: List of the rows (hashed_key and filename) of the files.
+    """
+    return metadata_index.execute(
+        "SELECT hashed_key, filename FROM files WHERE group_name = ? AND storage = ?", (name, storage)
+    ).fetchall()
+
+
+class ChecksumWriter:
+    """Writes to a file and computes the sha256 hex digest of all written bytes."""
+
+    def __init__(self, file):
+        """
+        :param file: The file (opened in binary mode).
+        """
+        self.file = file
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        return self.file.write(data)
+
+    @property
+    def checksum(self) -> str:
+        """The sha256 hex digest of the written bytes."""
+        return self._hash.hexdigest()
+
+
+def read_hashed_private_key(name: str) -> Optional[str]:
+    """Reads a private key file.
+    :param name: The storage name of the private key file.
+    :return: The hashed private key or None if the file does not exists.
+    """
+    content = storage.read(name)
+    if content is None:
+        return None
+    return content.decode("utf-8").replace("\n", "")
+
+
+def write_hashed_private_key(name: str, hashed_private_key: str):
+    """Writes a private key file.
+    :param name: The storage name of the private key file.
+    :param hashed_private_key: The hashed private key.
+    """
+    storage.write(name, hashed_private_key.encode("utf-8"))
+
+
+def rebuild_index() -> int:
+    """Rebuilds the index from the files in the storage (for existing installations).
+    The size of the content and the checksum are unknown for files, which are added by a rebuild (the files are not
+    read, so the rebuild does not depend on the total size of the files). The references of the
+    deduplicated chunks are counted from the manifests and the codecs are read from the codec headers.
+    The expirations and download limits are only saved in the index, so they are kept for the files of the old index.
+    :return: The amount of indexed files.
+    """
+    from resources.api.dedup import get_chunk_name, read_chunk_ids  # the dedup module requires the index
+
+    files = []
+    groups = []
+    hashed_key_pattern = re.compile(r"^[0-9a-f]+/$")
+    for key_directory in storage.list():
+        if not hashed_key_pattern.match(key_directory):
+            continue
+        hashed_private_key = read_hashed_private_key(key_directory + private_key_file_name)
+        if hashed_private_key is None:
+            continue
+        for filename in storage.list(key_directory):
+            name = key_directory + filename
+            if filename != private_key_file_name and not filename.endswith("/"):
+                files.append(
+                    (NO_GROUP, key_directory[:-1], filename, None, hashed_private_key, None,
+                     storage.stat(name).modified, name)
+                )
+    for group_directory in storage.list(group_directory_name + "/"):
+        if not group_directory.endswith("/"):
+            continue
+        group_name = group_directory[:-1]
+        group_path = get_group_directory(group_name)
+        hashed_private_key = read_hashed_private_key(group_path + private_key_file_name)
+        if hashed_private_key is None:
+            continue
+        group_stat = storage.stat(group_path + private_key_file_name)
+        for key_directory in storage.list(group_path):
+            if not key_directory.endswith("/"):
+                continue
+            groups.append((group_name, key_directory[:-1], hashed_private_key, group_stat.modified))
+            for filename in storage.list(group_path + key_directory):
+                name = group_path + key_directory + filename
+                if not filename.endswith("/"):
+                    files.append(
+                        (group_name, key_directory[:-1], filename, None, None, None,
+                         storage.stat(name).modified, name)
+                    )
+    chunk_references = {}
+    rows = []
+    for *row, name in files:
+        chunk_ids = read_chunk_ids(name)
+        for chunk_id in chunk_ids or ():
+            chunk_references[chunk_id] = chunk_references.get(chunk_id, 0) + 1
+        if chunk_ids is None:
+            rows.append((*row, STORAGE_FILE, read_codec_name(name)))
+        else:
+            rows.append((*row, STORAGE_DEDUP, CODEC_IDENTITY))
+    chunks = []
+    for chunk_id, references in chunk_references.items():
+        chunk_stat = storage.stat(get_chunk_name(chunk_id))
+        chunks.append((chunk_id, 0 if chunk_stat is None else chunk_stat.size, references))
+    with metadata_index.transaction() as connection:
+        expirations = connection.execute(
+            "SELECT expires, max_downloads, downloads, group_name, hashed_key, filename FROM files "
+            "WHERE expires IS NOT NULL OR max_downloads IS NOT NULL"
+        ).fetchall()
+        connection.execute("DELETE FROM files")
+        connection.execute("DELETE FROM groups")
+        connection.execute("DELETE FROM chunks")
+        connection.executemany(
+            "INSERT INTO files "
+            "(group_name, hashed_key, filename, size, hashed_private_key, checksum, created, storage, codec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        revision = get_new_revision()  # the revisions are not reset, so the cached listings are not used again
+        connection.executemany(
+            "INSERT OR REPLACE INTO groups (name, hashed_key, hashed_private_key, created, revision) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(*group, revision) for group in groups],
+        )
+        connection.executemany("INSERT INTO chunks (id, size, refcount) VALUES (?, ?, ?)", chunks)
+        connection.executemany(
+            "UPDATE files SET expires = ?, max_downloads = ?, downloads = ? "
+            "WHERE group_name = ? AND hashed_key = ? AND filename = ?",
+            [tuple(row) for row in expirations],
+        )
+    group_listing_cache.clear()
+    return len(files)
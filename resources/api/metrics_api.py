@@ -0,0 +1,54 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the metrics api (see config.METRICS_ENABLED).
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from typing import List
+
+from flask import Response
+
+from resources.api.cache import hot_object_cache
+from resources.api.crypto_pool import cipher_pool, kdf_pool
+from resources.api.encryption import derived_key_cache
+from resources.api.errors import MetricsDisabled
+from resources.api.metadata import group_listing_cache
+from resources.app import app
+from resources.config import config
+from resources.logger import logger
+from resources.metrics import request_duration, stage_duration, received_bytes, sent_bytes, errors
+
+
+def render_cache_stats(name: str, stats: dict) -> List[str]:
+    """Renders the stats of a cache as gauges in the Prometheus text format.
+    :param name: The name of the cache.
+    :param stats: The stats of the cache.
+    :return: List of the lines.
+    """
+    lines = []
+    for key, value in stats.items():
+        metric = f"opencdn_{name}_{key}"
+        lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return lines
+
+
+@app.flask.route("/metrics")
+def metrics_endpoint():
+    """Returns the metrics and the stats of the caches of this process in the Prometheus text format.
+    Errors: :class:`MetricsDisabled`.
+    """
+    if not config.METRICS_ENABLED:
+        raise MetricsDisabled()
+    lines = []
+    for metric in (request_duration, stage_duration, received_bytes, sent_bytes, errors):
+        lines += metric.render()
+    lines += render_cache_stats("derived_key_cache", derived_key_cache.stats())
+    lines += render_cache_stats("hot_cache", hot_object_cache.stats())
+    lines += render_cache_stats("group_listing_cache", group_listing_cache.stats())
+    lines += render_cache_stats("crypto_kdf_pool", kdf_pool.stats())
+    lines += render_cache_stats("crypto_cipher_pool", cipher_pool.stats())
+    lines += render_cache_stats("logger", logger.stats())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,47 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the profiler api (see config.PROFILER_ENABLED).
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from os.path import basename
+
+from flask import request, jsonify
+
+from resources.api.authentication import run_api_with_authentication_required
+from resources.api.errors import BadRequest, ProfilerDisabled
+from resources.app import app
+from resources.config import config
+from resources.profiler import profiler
+
+
+@app.flask.route("/profiler", methods=["POST"])
+def profiler_api():
+    """The flask profiler method for starting the profiler of the process, which handles the request.
+    Requires: authentication form values.
+            mode: 'sample' (samples the stacks of the request threads) or 'requests' (profiles the next requests).
+    Optional: duration: The duration of the sampling in seconds (default: 10).
+            requests: The amount of profiled requests (default: 100).
+    Errors: :class:`ActionNeedsAuthenticationToken`, :class:`InvalidAuthenticationToken`,
+            :class:`ProfilerDisabled`, :class:`ProfilerBusy`.
+    Return: error or json {
+                'status': 'success',
+                'output': 'The name of the output file in the log directory.'
+            }
+    """
+    run_api_with_authentication_required()
+    if not config.PROFILER_ENABLED:
+        raise ProfilerDisabled()
+    try:
+        if request.form.get("mode") == "sample":
+            path = profiler.start_sampling(float(request.form.get("duration", 10)))
+        elif request.form.get("mode") == "requests":
+            path = profiler.start_request_profiling(max(int(request.form.get("requests", 100)), 1))
+        else:
+            raise BadRequest()
+    except ValueError:
+        raise BadRequest()
+    return jsonify({"status": "success", "output": basename(path)})
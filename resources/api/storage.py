@@ -0,0 +1,491 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the storage backends of the encrypted files (see config.STORAGE_BACKEND).
+Objects are identified by names with '/' separated parts (e.g. '<hashed_key>/<filename>'), which the backends map
+to their layout. The databases and the temporary files of uploads always stay in the local data directory.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import re
+import shutil
+from os import getpid, listdir, makedirs, remove, rename, replace, scandir, stat
+from os.path import exists, isdir, join
+from tempfile import mkstemp
+from threading import Lock, Thread
+from time import sleep
+from typing import BinaryIO, List, Optional
+
+from resources.api.encryption import get_data_directory
+from resources.config import config
+from resources.logger import logger, LogType
+
+"""The first part of names, which are sharded by the 'sharded' backend (hashed keys)."""
+SHARDED_NAME_PATTERN = re.compile(r"^[0-9a-f]{8,}$")
+
+"""The shard directories of the 'sharded' backend (e.g. 'ab/')."""
+SHARD_DIRECTORY_PATTERN = re.compile(r"^[0-9a-f]+/$")
+
+
+class StorageStat:
+    """The size and the modification time of a stored object."""
+
+    def __init__(self, size: int, modified: float):
+        """
+        :param size: The size in bytes.
+        :param modified: The timestamp of the last modification.
+        """
+        self.size = size
+        self.modified = modified
+
+
+class StorageBackend:
+    """The basic storage backend. Directories are name prefixes, which end with '/' in listings."""
+
+    def put(self, name: str, source_path: str):
+        """Moves a local file (e.g. the temporary file of an upload) into the storage.
+        :param name: The name of the object.
+        :param source_path: The path of the local file, which is removed afterwards.
+        """
+        raise NotImplementedError()
+
+    def write(self, name: str, data: bytes):
+        """Saves an object.
+        :param name: The name of the object.
+        :param data: The content of the object.
+        """
+        raise NotImplementedError()
+
+    def open(self, name: str) -> BinaryIO:
+        """Opens an object for reading.
+        Errors: FileNotFoundError.
+        :param name: The name of the object.
+        :return: The seekable binary stream of the object.
+        """
+        raise NotImplementedError()
+
+    def read(self, name: str) -> Optional[bytes]:
+        """Reads a whole (small) object.
+        :param name: The name of the object.
+        :return: The content or None if the object does not exists.
+        """
+        try:
+            with self.open(name) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def stat(self, name: str) -> Optional[StorageStat]:
+        """Gets the size and the modification time of an object.
+        :param name: The name of the object.
+        :return: The stat or None if the object does not exists.
+        """
+        raise NotImplementedError()
+
+    def delete(self, name: str):
+        """Deletes an object, if it exists.
+        :param name: The name of the object.
+        """
+        raise NotImplementedError()
+
+    def list(self, prefix: str = "") -> List[str]:
+        """Lists the entries of a directory (not recursive).
+        :param prefix: The directory ('' for the root).
+        :return: List of the names of the entries in the directory. The names of directories end with '/'.
+        """
+        raise NotImplementedError()
+
+    def make_directory(self, name: str):
+        """Creates a directory (e.g. for groups without files), if it does not exists.
+        :param name: The name of the directory.
+        """
+        raise NotImplementedError()
+
+    def delete_directory(self, name: str):
+        """Deletes a directory with all objects in it, if it exists.
+        :param name: The name of the directory.
+        """
+        raise NotImplementedError()
+
+
+class LocalStorage(StorageBackend):
+    """Saves the objects in the data directory (the flat layout: one directory per hashed key)."""
+
+    def get_path(self, name: str) -> str:
+        """Gets the path of an object.
+        :param name: The name of the object.
+        :return: The path in the data directory.
+        """
+        return get_data_directory() + name
+
+    def put(self, name: str, source_path: str):
+        path = self.get_path(name)
+        makedirs(path[: path.rindex("/")], exist_ok=True)
+        replace(source_path, path)
+
+    def write(self, name: str, data: bytes):
+        path = self.get_path(name)
+        makedirs(path[: path.rindex("/")], exist_ok=True)
+        descriptor, temp_path = mkstemp(prefix=".write_", dir=path[: path.rindex("/")])
+        try:
+            with open(descriptor, "wb") as file:
+                file.write(data)
+            replace(temp_path, path)
+        except BaseException:
+            remove(temp_path)
+            raise
+
+    def open(self, name: str) -> BinaryIO:
+        return open(self.get_path(name), "rb")
+
+    def stat(self, name: str) -> Optional[StorageStat]:
+        try:
+            result = stat(self.get_path(name))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return StorageStat(result.st_size, result.st_mtime)
+
+    def delete(self, name: str):
+        try:
+            remove(self.get_path(name))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str = "") -> List[str]:
+        path = self.get_path(prefix)
+        if not isdir(path):
+            return []
+        return [entry + "/" if isdir(join(path, entry)) else entry for entry in listdir(path)]
+
+    def make_directory(self, name: str):
+        makedirs(self.get_path(name), exist_ok=True)
+
+    def delete_directory(self, name: str):
+        shutil.rmtree(self.get_path(name), ignore_errors=True)
+
+
+class ShardedLocalStorage(LocalStorage):
+    """Saves the objects in the data directory, but the directories of the hashed keys are distributed in
+    config.SHARD_LEVELS levels of subdirectories, which are named after the next config.SHARD_WIDTH characters of the
+    hashed key (e.g. 'ab/cd/abcd...'), so no directory gets too many entries and lookups stay fast. Other names
+    (e.g. groups) are saved like in :class:`LocalStorage`.
+    Key directories of the flat layout (of the 'local' backend) are still found, until they are moved by the
+    migrator (see :meth:`start_migrator`).
+    """
+
+    def __init__(self):
+        self._migrator_started = False
+        self._migrator_lock = Lock()
+
+    @staticmethod
+    def get_shard_directory(hashed_key: str) -> str:
+        """Gets the shard directories of a hashed key.
+        :param hashed_key: The hashed key.
+        :return: The shard directories with a '/' at the end (e.g. 'ab/cd/').
+        """
+        width = config.SHARD_WIDTH
+        return "".join(hashed_key[i * width:(i + 1) * width] + "/" for i in range(config.SHARD_LEVELS))
+
+    def get_paths(self, name: str) -> List[str]:
+        """Gets the possible paths of an object: the path of the flat layout and the path of the sharded layout.
+        :param name: The name of the object.
+        :return: List of the paths (only one path for names, which are not sharded).
+        """
+        hashed_key = name.split("/", 1)[0]
+        if not SHARDED_NAME_PATTERN.match(hashed_key):
+            return [get_data_directory() + name]
+        return [get_data_directory() + name, get_data_directory() + self.get_shard_directory(hashed_key) + name]
+
+    def get_path(self, name: str) -> str:
+        hashed_key = name.split("/", 1)[0]
+        if not SHARDED_NAME_PATTERN.match(hashed_key):
+            return get_data_directory() + name
+        shard_directory = get_data_directory() + self.get_shard_directory(hashed_key)
+        if not exists(shard_directory + hashed_key) and exists(get_data_directory() + hashed_key):
+            return get_data_directory() + name  # not migrated yet
+        return shard_directory + name
+
+    def open(self, name: str) -> BinaryIO:
+        try:
+            return super().open(name)
+        except FileNotFoundError:
+            return super().open(name)  # the key directory may have been migrated in between
+
+    def stat(self, name: str) -> Optional[StorageStat]:
+        result = super().stat(name)
+        if result is None:
+            result = super().stat(name)  # the key directory may have been migrated in between
+        return result
+
+    def delete(self, name: str):
+        for path in self.get_paths(name):  # the flat path first, so a migration in between is not missed
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+
+    def delete_directory(self, name: str):
+        for path in self.get_paths(name):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def list(self, prefix: str = "") -> List[str]:
+        if prefix != "":
+            return super().list(prefix)
+        shard_directories = [""]
+        for _ in range(config.SHARD_LEVELS):
+            shard_directories = [
+                directory + entry for directory in shard_directories for entry in LocalStorage.list(self, directory)
+                if self.is_shard_directory(entry)
+            ]
+        entries = [entry for entry in super().list() if not self.is_shard_directory(entry)]  # and the flat layout
+        for directory in shard_directories:
+            entries.extend(entry for entry in super().list(directory) if entry.endswith("/"))
+        return entries
+
+    @staticmethod
+    def is_shard_directory(entry: str) -> bool:
+        """Checks if an entry of a listing is a shard directory.
+        :param entry: The entry.
+        :return: True if the entry is a shard directory.
+        """
+        return len(entry) == config.SHARD_WIDTH + 1 and SHARD_DIRECTORY_PATTERN.match(entry) is not None
+
+    def migrate_key_directory(self, hashed_key: str) -> bool:
+        """Moves a key directory of the flat layout to the sharded layout. The directory is renamed in one step,
+        so it is always found in one of the layouts.
+        :param hashed_key: The hashed key.
+        :return: True if the directory has been moved.
+        """
+        flat_path = get_data_directory() + hashed_key
+        sharded_path = get_data_directory() + self.get_shard_directory(hashed_key) + hashed_key
+        makedirs(sharded_path[: sharded_path.rindex("/")], exist_ok=True)
+        try:
+            rename(flat_path, sharded_path)
+        except FileNotFoundError:  # deleted in between
+            return False
+        except OSError:
+            logger.log(LogType.WARNING, f"The key directory {hashed_key} exists in both layouts and was not moved.")
+            return False
+        return True
+
+    def migrate(self) -> int:
+        """Moves all key directories of the flat layout to the sharded layout. After every
+        config.SHARD_MIGRATION_BATCH moved directories, the migration pauses for config.SHARD_MIGRATION_INTERVAL
+        seconds, so the requests are not slowed down.
+        :return: The amount of moved directories.
+        """
+        moved = 0
+        with scandir(get_data_directory()) as entries:
+            for entry in entries:
+                if SHARDED_NAME_PATTERN.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                    if self.migrate_key_directory(entry.name):
+                        moved += 1
+                        if moved % config.SHARD_MIGRATION_BATCH == 0:
+                            sleep(config.SHARD_MIGRATION_INTERVAL)
+        return moved
+
+    def start_migrator(self):
+        """Starts the background thread, which moves the key directories of the flat layout to the sharded
+        layout (if config.SHARD_MIGRATION is enabled). The thread should only run in one process.
+        """
+        if not config.SHARD_MIGRATION:
+            return
+        with self._migrator_lock:
+            if self._migrator_started:
+                return
+            self._migrator_started = True
+        Thread(target=self._run_migrator, name="storage-migrator", daemon=True).start()
+
+    def _run_migrator(self):
+        """The loop of the migrator thread (runs until a pass moves nothing)."""
+        total = 0
+        while True:
+            moved = self.migrate()
+            if moved == 0:
+                break
+            total += moved
+        if total > 0:
+            logger.log(LogType.HIGH, f"Moved {total} key directories to the sharded layout.")
+
+
+class S3Object:
+    """Seekable read access to an object of a S3 bucket. Sequential reads are served by one streamed GET request,
+    which is only restarted (with a Range header) after a seek.
+    """
+
+    def __init__(self, client, bucket: str, key: str, size: int):
+        """
+        :param client: The boto3 S3 client.
+        :param bucket: The name of the bucket.
+        :param key: The key of the object.
+        :param size: The size of the object.
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self._position = 0
+        self._body = None
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self.size
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads like a file: exactly size bytes are returned, unless the end of the object is reached
+        (a streamed body can return less bytes per read).
+        """
+        if self._position >= self.size or size == 0:
+            return b""
+        if self._body is None:
+            self._body = self.client.get_object(
+                Bucket=self.bucket, Key=self.key, Range=f"bytes={self._position}-"
+            )["Body"]
+        if size < 0:
+            data = self._body.read()
+        else:
+            parts = []
+            remaining = size
+            while remaining > 0:
+                part = self._body.read(remaining)
+                if not part:
+                    break
+                parts.append(part)
+                remaining -= len(part)
+            data = b"".join(parts)
+        self._position += len(data)
+        return data
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class S3Storage(StorageBackend):
+    """Saves the objects in a bucket of a S3 compatible object storage (config.S3_*).
+    The backend requires boto3, which is only imported, if the backend is used.
+    Directories are saved as empty objects, whose key ends with '/'.
+    """
+
+    def __init__(self):
+        import boto3  # optional dependency of the s3 backend
+        from botocore.exceptions import ClientError
+
+        self._boto3 = boto3
+        self._client_error = ClientError
+        self._client = None
+        self._client_pid = None
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        """The S3 client of the process (clients can be shared by threads, but not by forked processes)."""
+        if self._client is None or self._client_pid != getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != getpid():
+                    self._client = self._boto3.client(
+                        "s3",
+                        endpoint_url=config.S3_ENDPOINT_URL or None,
+                        region_name=config.S3_REGION or None,
+                        aws_access_key_id=config.S3_ACCESS_KEY_ID or None,
+                        aws_secret_access_key=config.S3_SECRET_ACCESS_KEY or None,
+                    )
+                    self._client_pid = getpid()
+        return self._client
+
+    @staticmethod
+    def get_key(name: str) -> str:
+        """Gets the key of an object.
+        :param name: The name of the object.
+        :return: The key in the bucket (with config.S3_PREFIX).
+        """
+        return config.S3_PREFIX + name
+
+    def _is_not_found(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, name: str, source_path: str):
+        self.client.upload_file(source_path, config.S3_BUCKET, self.get_key(name))
+        remove(source_path)
+
+    def write(self, name: str, data: bytes):
+        self.client.put_object(Bucket=config.S3_BUCKET, Key=self.get_key(name), Body=data)
+
+    def open(self, name: str) -> BinaryIO:
+        result = self.stat(name)
+        if result is None:
+            raise FileNotFoundError(name)
+        return S3Object(self.client, config.S3_BUCKET, self.get_key(name), result.size)
+
+    def stat(self, name: str) -> Optional[StorageStat]:
+        try:
+            head = self.client.head_object(Bucket=config.S3_BUCKET, Key=self.get_key(name))
+        except self._client_error as e:
+            if self._is_not_found(e):
+                return None
+            raise
+        return StorageStat(head["ContentLength"], head["LastModified"].timestamp())
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=config.S3_BUCKET, Key=self.get_key(name))
+
+    def list(self, prefix: str = "") -> List[str]:
+        key_prefix = self.get_key(prefix)
+        entries = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=config.S3_BUCKET, Prefix=key_prefix, Delimiter="/"):
+            entries.extend(entry["Prefix"][len(key_prefix):] for entry in page.get("CommonPrefixes", ()))
+            entries.extend(
+                entry["Key"][len(key_prefix):] for entry in page.get("Contents", ()) if entry["Key"] != key_prefix
+            )
+        return entries
+
+    def make_directory(self, name: str):
+        self.client.put_object(Bucket=config.S3_BUCKET, Key=self.get_key(name.rstrip("/") + "/"), Body=b"")
+
+    def delete_directory(self, name: str):
+        key_prefix = self.get_key(name.rstrip("/") + "/")
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=config.S3_BUCKET, Prefix=key_prefix):
+            keys = [{"Key": entry["Key"]} for entry in page.get("Contents", ())]
+            if keys:  # a page has at most 1000 keys, the limit of delete_objects
+                self.client.delete_objects(Bucket=config.S3_BUCKET, Delete={"Objects": keys, "Quiet": True})
+
+
+def create_storage() -> StorageBackend:
+    """Creates the storage backend of config.STORAGE_BACKEND.
+    :return: The storage backend.
+    """
+    if config.STORAGE_BACKEND.lower() == "local":
+        return LocalStorage()
+    elif config.STORAGE_BACKEND.lower() == "sharded":
+        return ShardedLocalStorage()
+    elif config.STORAGE_BACKEND.lower() == "s3":
+        return S3Storage()
+    else:
+        raise ValueError(f"The STORAGE_BACKEND {config.STORAGE_BACKEND} should be 'local', 'sharded' or 's3'.")
+
+
+"""The storage of all encrypted files, private keys and chunks."""
+storage = create_storage()
@@ -0,0 +1,178 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the stores of the (hashed) authentication tokens.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from collections import OrderedDict
+from os import getpid
+from threading import Lock, Thread
+from time import time, sleep
+
+from resources.api.database import Database
+from resources.config import config
+
+
+class TokenStore:
+    """The basic store of hashed authentication tokens.
+    Tokens expire after config.AUTHENTICATION_TOKEN_TTL seconds and at most config.MAX_AUTHENTICATION_TOKENS
+    tokens are stored (the oldest tokens are removed first). Expired tokens are removed by a background thread
+    every config.TOKEN_SWEEP_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._sweeper_pid = None
+        self._sweeper_lock = Lock()
+
+    def add(self, hashed_token: str):
+        """Adds a token.
+        :param hashed_token: The hashed authentication token.
+        """
+        raise NotImplementedError()
+
+    def contains(self, hashed_token: str) -> bool:
+        """Checks if a token is stored and not expired.
+        :param hashed_token: The hashed authentication token.
+        :return: True if the token is valid.
+        """
+        raise NotImplementedError()
+
+    def remove(self, hashed_token: str):
+        """Removes a token, if it exists.
+        :param hashed_token: The hashed authentication token.
+        """
+        raise NotImplementedError()
+
+    def remove_expired(self) -> int:
+        """Removes all expired tokens.
+        :return: The amount of removed tokens.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_expiration():
+        """Gets the expiration time of a new token.
+        :return: The timestamp or None if tokens never expire.
+        """
+        if config.AUTHENTICATION_TOKEN_TTL > 0:
+            return time() + config.AUTHENTICATION_TOKEN_TTL
+        return None
+
+    def start_sweeper(self):
+        """Starts the background thread, which removes expired tokens (once per process)."""
+        if self._sweeper_pid == getpid() or config.AUTHENTICATION_TOKEN_TTL <= 0:
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == getpid():
+                return
+            self._sweeper_pid = getpid()
+            Thread(target=self._run_sweeper, name="token-sweeper", daemon=True).start()
+
+    def _run_sweeper(self):
+        """The loop of the sweeper thread."""
+        while True:
+            sleep(config.TOKEN_SWEEP_INTERVAL)
+            self.remove_expired()
+
+
+class MemoryTokenStore(TokenStore):
+    """Stores the tokens in a dict of the process. The tokens are not shared with other worker processes."""
+
+    def __init__(self):
+        super().__init__()
+        self._tokens = OrderedDict()  # hashed token: expiration
+        self._lock = Lock()
+
+    def add(self, hashed_token: str):
+        self.start_sweeper()
+        with self._lock:
+            self._tokens[hashed_token] = self.get_expiration()
+            self._tokens.move_to_end(hashed_token)
+            while len(self._tokens) > config.MAX_AUTHENTICATION_TOKENS:
+                self._tokens.popitem(last=False)
+
+    def contains(self, hashed_token: str) -> bool:
+        with self._lock:
+            expiration = self._tokens.get(hashed_token, 0)
+            if expiration is None:
+                return True
+            if expiration > time():
+                return True
+            self._tokens.pop(hashed_token, None)
+            return False
+
+    def remove(self, hashed_token: str):
+        with self._lock:
+            self._tokens.pop(hashed_token, None)
+
+    def remove_expired(self) -> int:
+        now = time()
+        with self._lock:
+            expired = [
+                token for token, expiration in self._tokens.items() if expiration is not None and expiration <= now
+            ]
+            for token in expired:
+                del self._tokens[token]
+        return len(expired)
+
+
+class SQLiteTokenStore(TokenStore):
+    """Stores the tokens in a SQLite database in the data directory, which is shared by all worker processes."""
+
+    def __init__(self):
+        super().__init__()
+        self.database = Database(
+            "tokens.db",
+            [
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(hashed_token TEXT PRIMARY KEY, created REAL NOT NULL, expiration REAL)",
+                "CREATE INDEX IF NOT EXISTS tokens_created ON tokens (created)",
+                "CREATE INDEX IF NOT EXISTS tokens_expiration ON tokens (expiration)",
+            ],
+        )
+
+    def add(self, hashed_token: str):
+        self.start_sweeper()
+        with self.database.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO tokens (hashed_token, created, expiration) VALUES (?, ?, ?)",
+                (hashed_token, time(), self.get_expiration()),
+            )
+            count = connection.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+            if count > config.MAX_AUTHENTICATION_TOKENS:
+                connection.execute(
+                    "DELETE FROM tokens WHERE hashed_token IN "
+                    "(SELECT hashed_token FROM tokens ORDER BY created LIMIT ?)",
+                    (count - config.MAX_AUTHENTICATION_TOKENS,),
+                )
+
+    def contains(self, hashed_token: str) -> bool:
+        self.start_sweeper()
+        row = self.database.execute(
+            "SELECT 1 FROM tokens WHERE hashed_token = ? AND (expiration IS NULL OR expiration > ?)",
+            (hashed_token, time()),
+        ).fetchone()
+        return row is not None
+
+    def remove(self, hashed_token: str):
+        self.database.execute("DELETE FROM tokens WHERE hashed_token = ?", (hashed_token,))
+
+    def remove_expired(self) -> int:
+        return self.database.execute(
+            "DELETE FROM tokens WHERE expiration IS NOT NULL AND expiration <= ?", (time(),)
+        ).rowcount
+
+
+def create_token_store() -> TokenStore:
+    """Creates the token store of config.TOKEN_STORE.
+    :return: The token store.
+    """
+    if config.TOKEN_STORE.lower() == "memory":
+        return MemoryTokenStore()
+    elif config.TOKEN_STORE.lower() == "sqlite":
+        return SQLiteTokenStore()
+    else:
+        raise ValueError(f"The TOKEN_STORE {config.TOKEN_STORE} should be 'memory' or 'sqlite'.")
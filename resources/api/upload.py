@@ -7,33 +7,60 @@ This module implements the api uploading.
 :license: GNU General Public License v3.0
 """
 
-from os import mkdir
-from os.path import exists
+from concurrent.futures import ThreadPoolExecutor
+from os import remove
+from tempfile import mkstemp
+from time import time
+from typing import BinaryIO, Optional, Tuple
 
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-from resources.api.authentication import (
-    private_key_file_name,
-    run_api_with_authentication_required, authenticate_group, get_group_directory,
-)
+from resources.api.authentication import run_api_with_authentication_required, authenticate_group
 from resources.api.encryption import (
+    DerivedKey,
+    derive_upload_key,
     generate_random_key,
     hash_key,
     get_data_directory,
-    encrypt,
+    encrypt_stream,
 )
+from resources.api.crypto_pool import admit
+from resources.api.compression import CODEC_IDENTITY, CompressingReader, get_upload_codec, write_codec_header
+from resources.api.dedup import encrypt_dedup_stream, read_manifest_chunk_ids, release_chunks
 from resources.api.groups import is_group_name_valid
+from resources.api.metadata import (
+    ChecksumWriter,
+    add_file,
+    get_file,
+    get_file_name,
+    get_key_directory,
+    private_key_file_name,
+    write_hashed_private_key,
+    STORAGE_FILE,
+    STORAGE_DEDUP,
+)
+from resources.api.storage import storage
 from resources.app import app
 from flask import request, jsonify
 from resources.api.errors import (
+    BasicError,
     NoFileInRequest,
     InvalidFileName,
     InvalidFileSuffix,
-    FileTooBig, BadRequest, GroupDoesNotExists, AccessDenied, FileAlreadyExists,
+    FileTooBig, BadRequest, GroupDoesNotExists, AccessDenied, FileAlreadyExists, InternalServerError, TooManyFiles,
 )
 from resources.config import config
-from resources.flask_event_handlers import get_real_ip
+from resources.flask_event_handlers import count_error, get_real_ip
 from resources.logger import logger, LogType
+from resources.metrics import get_route, route_of
+
+"""Allowance for the multipart overhead (boundaries, part headers and form values) of an upload request."""
+MULTIPART_OVERHEAD_BYTES = 1024 * 64
+
+"""The maximum amount of form values (besides the files) of a batch upload request."""
+BATCH_FORM_VALUES = 16
 
 
 def is_file_suffix_valid(filename: str) -> bool:
@@ -67,6 +94,302 @@ def is_filename_valid(filename: str) -> bool:
     return True
 
 
+class LimitedRequestStream:
+    """Reads the body of a request up to a maximum size. If the body is bigger, :class:`FileTooBig` is raised, so a
+    body without Content-Length (chunked transfer encoding) is not read further than an upload can be.
+    """
+
+    def __init__(self, stream: BinaryIO, max_bytes: int):
+        """
+        :param stream: The stream of the request body.
+        :param max_bytes: The maximum size of the body.
+        """
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.position = 0
+
+    def _limit(self, size: Optional[int]) -> int:
+        """Gets the size of the next read: at most one byte more than allowed, so a too big body is noticed.
+        :param size: The requested size (None or negative for the whole body).
+        :return: The size of the read.
+        """
+        remaining = self.max_bytes - self.position + 1
+        return remaining if size is None or size < 0 else min(size, remaining)
+
+    def _count(self, data: bytes) -> bytes:
+        """Counts read bytes.
+        Errors: :class:`FileTooBig`.
+        :param data: The read bytes.
+        :return: The read bytes.
+        """
+        self.position += len(data)
+        if self.position > self.max_bytes:
+            raise FileTooBig()
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        return self._count(self.stream.read(self._limit(size)))
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._count(self.stream.readline(self._limit(size)))
+
+    def readable(self) -> bool:
+        return True
+
+
+def check_content_length(max_bytes: int):
+    """Rejects the request before the body is read, if the Content-Length is bigger than an upload can be.
+    The body of the request is limited to the same size (see :class:`LimitedRequestStream`), so the limit also
+    applies to bodies without Content-Length. It must be called before the form is read.
+    Errors: :class:`FileTooBig`.
+    :param max_bytes: The maximum size of the uploaded files of the request.
+    """
+    max_content_length = max_bytes + MULTIPART_OVERHEAD_BYTES
+    if (
+        request.content_length is not None
+        and request.content_length > max_content_length
+    ):
+        raise FileTooBig()
+    request.stream = LimitedRequestStream(request.stream, max_content_length)
+
+
+def check_upload_filename(filename: str) -> str:
+    """Checks the filename of an uploaded file.
+    Errors: :class:`InvalidFileName`, :class:`InvalidFileSuffix`.
+    :param filename: The filename of the uploaded file.
+    :return: The secured filename.
+    """
+    if filename == "" or "/" in filename or "\\" in filename:  # PTA protection
+        raise InvalidFileName()
+    if not is_file_suffix_valid(filename):
+        raise InvalidFileSuffix()
+    if not is_filename_valid(filename):
+        raise InvalidFileName()
+    return secure_filename(filename)
+
+
+def parse_upload_group() -> Tuple[Optional[str], Optional[str]]:
+    """Parses and authenticates the group of an upload request ('group', 'key' and 'private_key').
+    Errors: :class:`BadRequest`, :class:`GroupDoesNotExists`, :class:`AccessDenied`.
+    :return: The name and the key of the group or (None, None) if the files are not uploaded into a group.
+    """
+    if "group" not in request.form:
+        return None, None
+    if "key" not in request.form or "private_key" not in request.form:
+        raise BadRequest()
+    group = request.form["group"]
+    key = request.form["key"]
+    if not is_group_name_valid(group):
+        raise GroupDoesNotExists()
+    group_information = authenticate_group(group, request.form["private_key"])
+    if group_information["hashed_key"] != hash_key(key):
+        raise GroupDoesNotExists()
+    return group, key
+
+
+def parse_upload_expiration() -> Tuple[Optional[float], Optional[int]]:
+    """Parses the expiration of an upload request ('expires_in' in seconds and 'max_downloads').
+    Uploads without 'expires_in' expire after config.UPLOAD_DEFAULT_EXPIRES_IN seconds and no upload expires later
+    than config.UPLOAD_MAX_EXPIRES_IN seconds (if they are enabled).
+    Errors: :class:`BadRequest`.
+    :return: The expiration timestamp (or None if the files never expire) and the maximum amount of downloads
+        (or None for unlimited downloads).
+    """
+    try:
+        expires_in = int(request.form.get("expires_in", config.UPLOAD_DEFAULT_EXPIRES_IN))
+        max_downloads = request.form.get("max_downloads")
+        max_downloads = None if max_downloads is None else int(max_downloads)
+    except ValueError:
+        raise BadRequest()
+    if expires_in < 0 or (max_downloads is not None and max_downloads < 1):
+        raise BadRequest()
+    if config.UPLOAD_MAX_EXPIRES_IN > 0 and (expires_in == 0 or expires_in > config.UPLOAD_MAX_EXPIRES_IN):
+        expires_in = config.UPLOAD_MAX_EXPIRES_IN
+    return (time() + expires_in if expires_in > 0 else None), max_downloads
+
+
+def get_storage_mode() -> str:
+    """Gets the storage of new uploads (config.STORAGE_MODE).
+    :return: STORAGE_FILE or STORAGE_DEDUP.
+    """
+    if config.STORAGE_MODE.lower() == STORAGE_FILE:
+        return STORAGE_FILE
+    elif config.STORAGE_MODE.lower() == STORAGE_DEDUP:
+        return STORAGE_DEDUP
+    else:
+        raise ValueError(f"The STORAGE_MODE {config.STORAGE_MODE} should be '{STORAGE_FILE}' or '{STORAGE_DEDUP}'.")
+
+
+class EncryptedUpload:
+    """An encrypted upload in a temporary file of the data directory, which should be moved into the storage
+    with :func:`move_upload` or removed with :func:`discard_upload`.
+    """
+
+    def __init__(self, temp_path: str, content_size: int, checksum: str, storage: str, codec: str):
+        """
+        :param temp_path: The path of the temporary file.
+        :param content_size: The size of the uploaded content.
+        :param checksum: The checksum of the encrypted file.
+        :param storage: The storage of the file (STORAGE_FILE or STORAGE_DEDUP).
+        :param codec: The name of the compression codec of the file.
+        """
+        self.temp_path = temp_path
+        self.content_size = content_size
+        self.checksum = checksum
+        self.storage = storage
+        self.codec = codec
+
+
+def write_encrypted_upload(file: FileStorage, key: str, derived_key: DerivedKey = None) -> EncryptedUpload:
+    """Encrypts the uploaded file chunk by chunk into a temporary file in the data directory. In the dedup
+    storage, the chunks are saved and the temporary file is the manifest of the chunks. Otherwise the file is
+    compressed before the encryption, if a codec is configured for it (see :func:`get_upload_codec`).
+    Attention: The uploaded file has already been parsed from the request by werkzeug, which spools the
+    unencrypted content of bigger files into a temporary file of the system (not of the data directory) until the
+    request has ended. Only the encrypted content is written into the data directory.
+    Errors: :class:`FileTooBig`.
+    :param file: The uploaded file.
+    :param key: The encrypting key.
+    :param derived_key: The already derived key of the encrypting key (e.g. of a group in a batch upload).
+    :return: The encrypted upload.
+    """
+    storage = get_storage_mode()
+    codec = get_upload_codec(file.filename) if storage == STORAGE_FILE else None
+    descriptor, temp_path = mkstemp(prefix=".upload_", dir=get_data_directory())
+    try:
+        with open(descriptor, "wb") as temp_file:
+            writer = ChecksumWriter(temp_file)
+            if storage == STORAGE_DEDUP:
+                content_size = encrypt_dedup_stream(file.stream, writer, key, config.MAX_FILE_BYTES, derived_key)
+            elif codec is not None:
+                write_codec_header(writer, codec)
+                reader = CompressingReader(file.stream, codec, config.MAX_FILE_BYTES)
+                encrypt_stream(reader, writer, key, None, derived_key)
+                content_size = reader.size
+            else:
+                content_size = encrypt_stream(file.stream, writer, key, config.MAX_FILE_BYTES, derived_key)
+    except BaseException:
+        remove(temp_path)
+        raise
+    return EncryptedUpload(
+        temp_path, content_size, writer.checksum, storage, CODEC_IDENTITY if codec is None else codec.name
+    )
+
+
+def discard_upload(upload: EncryptedUpload):
+    """Removes the temporary file of an upload (and the references to its chunks in the dedup storage).
+    :param upload: The encrypted upload.
+    """
+    if upload.storage == STORAGE_DEDUP:
+        with open(upload.temp_path, "rb") as file:
+            release_chunks(read_manifest_chunk_ids(file) or [])
+    remove(upload.temp_path)
+
+
+def move_upload(upload: EncryptedUpload, name: str):
+    """Moves the temporary file of an upload into the storage.
+    The upload will be discarded, if the move fails.
+    :param upload: The encrypted upload.
+    :param name: The storage name of the file.
+    """
+    try:
+        storage.put(name, upload.temp_path)
+    except BaseException:
+        discard_upload(upload)
+        raise
+
+
+def save_upload(
+    file: FileStorage,
+    filename: str,
+    key: Optional[str],
+    private_key: Optional[str],
+    group: Optional[str],
+    ip: str,
+    derived_key: DerivedKey = None,
+    expires: float = None,
+    max_downloads: int = None,
+) -> dict:
+    """Encrypts an uploaded file and saves it into the storage and the index.
+    The request is not used, so the files of a batch upload can be saved in other threads.
+    Errors: :class:`FileAlreadyExists`, :class:`FileTooBig`.
+    :param file: The uploaded file.
+    :param filename: The checked filename (see :func:`check_upload_filename`).
+    :param key: The encrypting key (the key of the group) or None for a random key.
+    :param private_key: The private key or None for a random private key.
+    :param group: The name of the authenticated group (see :func:`parse_upload_group`) or None.
+    :param ip: The ip of the client (for the log).
+    :param derived_key: The already derived key of the encrypting key.
+    :param expires: The expiration timestamp of the file (see :func:`parse_upload_expiration`).
+    :param max_downloads: The maximum amount of downloads of the file.
+    :return: The json result of the upload.
+    """
+    if key is None:
+        key = generate_random_key(config.RANDOM_KEY_LENGTH) # The encrypting key
+    if private_key is None:
+        private_key = generate_random_key(config.RANDOM_PRIVATE_KEY_LENGTH)
+    hashed_key = hash_key(key)
+    hashed_private_key = hash_key(private_key)
+    if group is None:
+        private_key_name = get_key_directory(hashed_key) + private_key_file_name
+        if storage.stat(private_key_name) is not None:
+            raise FileAlreadyExists()
+        upload = write_encrypted_upload(file, key, derived_key)
+        move_upload(upload, get_file_name(hashed_key, filename))
+        write_hashed_private_key(private_key_name, hashed_private_key)
+        add_file(
+            hashed_key, filename, upload.content_size, upload.checksum, hashed_private_key,
+            storage=upload.storage, codec=upload.codec, expires=expires, max_downloads=max_downloads,
+        )
+        logger.log(
+            LogType.INFO,
+            f"New upload from {ip} to {hashed_key}/{filename} with filesize {upload.content_size}.",
+        )
+        return {
+            "key": key,
+            "hashed_key": hashed_key,
+            "filename": filename,
+            "private_key": private_key,
+            "expires": expires,
+            "max_downloads": max_downloads,
+        }
+    else:
+        if get_file(hashed_key, filename, group) is not None:
+            raise FileAlreadyExists()
+        upload = write_encrypted_upload(file, key, derived_key)
+        move_upload(upload, get_file_name(hashed_key, filename, group))
+        add_file(
+            hashed_key, filename, upload.content_size, upload.checksum, group=group,
+            storage=upload.storage, codec=upload.codec, expires=expires, max_downloads=max_downloads,
+        )
+
+        logger.log(
+            LogType.INFO,
+            f"New upload from {ip} to (group) {group}/{hashed_key}/{filename} with filesize {upload.content_size}.",
+        )
+        return {
+            "key": key,
+            "hashed_key": hashed_key,
+            "filename": filename,
+            "private_key": private_key,
+            "group": group,
+            "expires": expires,
+            "max_downloads": max_downloads,
+        }
+
+
+def get_batch_error(filename: str, e: BasicError, ip: str) -> dict:
+    """Logs and counts the error of a file of a batch upload.
+    :param filename: The filename of the uploaded file.
+    :param e: The error.
+    :param ip: The ip of the client.
+    :return: The json result of the file.
+    """
+    logger.log(LogType.INFO, f"Batch upload from {ip} with error {e.id}:{e.name} for a file.")
+    count_error(e)
+    return {"filename": filename, **e.to_json()}
+
+
 @app.flask.route("/upload", methods=["POST"])
 def upload_method():
     """The flask upload method for uploading.
@@ -78,87 +401,109 @@ def upload_method():
               If you would like to update a file in a group you must hand over the 'group', 'private_key' and the 'key'
               of the group. The 'group' parameter is the group name. If you use group uploading following errors
               can be thrown: :class:`GroupDoesNotExists`, :class:`AccessDenied`.
+              Expiration:
+              'expires_in' sets the time in seconds, after which the file expires and is removed (0 means never).
+              'max_downloads' sets the amount of downloads, after which the file is removed.
+              Invalid values are answered with :class:`BadRequest`.
     Errors: :class:`ActionNeedsAuthenticationToken`, :class:`InvalidAuthenticationToken`, :class:`NoFileInRequest`,
-            :class:`InvalidFileName`, :class:`InvalidFileSuffix`, :class:`InvalidFileName`, :class:`FileTooBig`.
+            :class:`InvalidFileName`, :class:`InvalidFileSuffix`, :class:`InvalidFileName`, :class:`FileTooBig`,
+            :class:`ServerBusy`.
     Return: errors or json {
                 'key': 'the_encrypting_key (string).',
                 'hashed_key': 'the encrypting_key hashed (string).',
                 'filename': 'the name of the file (string).',
                 'private_key': 'the private_key of the file (string).',
+                'expires': 'the expiration timestamp of the file (float or null).',
+                'max_downloads': 'the maximum amount of downloads of the file (int or null).',
             ]
     """
+    check_content_length(config.MAX_FILE_BYTES)
     if config.AUTHENTICATION_FOR_UPLOADING_REQUIRED:
         run_api_with_authentication_required()
     if "file" not in request.files:
         raise NoFileInRequest()
     file = request.files["file"]
-    if file.filename == "" or "/" in file.filename or "\\" in file.filename: # PTA protection
-        raise InvalidFileName()
-    if not is_file_suffix_valid(file.filename):
-        raise InvalidFileSuffix()
-    if not is_filename_valid(file.filename):
-        raise InvalidFileName()
-    group = None
-    key = None
-    if "group" in request.form:
-        if "key" not in request.form or "private_key" not in request.form:
-            raise BadRequest()
-        group = request.form["group"]
-        key = request.form["key"]
-        if not is_group_name_valid(group):
-            raise GroupDoesNotExists()
-        authenticate_group(group, request.form["private_key"])
-    filename = secure_filename(file.filename)
-    if key is None:
-        key = generate_random_key(config.RANDOM_KEY_LENGTH) # The encrypting key
-    if "private_key" in request.form:
-        private_key = request.form["private_key"]
-    else:
-        private_key = generate_random_key(config.RANDOM_PRIVATE_KEY_LENGTH)
-    hashed_key = hash_key(key)
-    hashed_private_key = hash_key(private_key)
-    content = file.read()
-    if len(content) > config.MAX_FILE_BYTES:
-        raise FileTooBig()
-    if group is None:
-        out_directory = get_data_directory() + hashed_key
-        mkdir(out_directory)
-        with open(out_directory + "/" + filename, "wb") as file:
-            file.write(encrypt(content, key))
-        with open(out_directory + "/" + private_key_file_name, "w") as file:
-            file.write(hashed_private_key)
-        logger.log(
-            LogType.INFO,
-            f"New upload from {get_real_ip()} to {hashed_key}/{filename} with filesize {len(content)}.",
-        )
-        return jsonify(
-            {
-                "key": key,
-                "hashed_key": hashed_key,
-                "filename": filename,
-                "private_key": private_key,
-            }
+    filename = check_upload_filename(file.filename)
+    group, key = parse_upload_group()
+    expires, max_downloads = parse_upload_expiration()
+    admit()
+    return jsonify(
+        save_upload(
+            file, filename, key, request.form.get("private_key"), group, get_real_ip(),
+            expires=expires, max_downloads=max_downloads,
         )
-    else:
-        files_directory = f"{get_group_directory()}/{group}/{hashed_key}"
-        if not exists(files_directory):
-            raise GroupDoesNotExists()
-        if exists(files_directory + "/" + filename):
-            raise FileAlreadyExists()
-        with open(files_directory + "/" + filename, "wb") as file:
-            file.write(encrypt(content, key))
+    )
 
-        logger.log(
-            LogType.INFO,
-            f"New upload from {get_real_ip()} to (group) {group}/{hashed_key}/{filename} with filesize {len(content)}.",
-        )
-        return jsonify(
-            {
-                "key": key,
-                "hashed_key": hashed_key,
-                "filename": filename,
-                "private_key": private_key,
-                "group": group
+
+@app.flask.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """The flask upload method for uploading many files in one request.
+    The filenames of all files are checked before the first file is saved. The files are saved in parallel by
+    config.BATCH_UPLOAD_WORKERS threads. If the files are uploaded into a group, the key of the group is derived
+    only once for the whole batch.
+    Requires: 'file' files (at most config.BATCH_UPLOAD_MAX_FILES) which contain the files to be uploaded.
+    Optional: The same form values as :func:`upload_method`. A 'private_key' is the private_key of all files and
+              'expires_in' and 'max_downloads' apply to every file.
+    Errors: :class:`ActionNeedsAuthenticationToken`, :class:`InvalidAuthenticationToken`, :class:`NoFileInRequest`,
+            :class:`TooManyFiles`, :class:`FileTooBig`, :class:`GroupDoesNotExists`, :class:`AccessDenied`,
+            :class:`ServerBusy`.
+    Return: errors or json {
+                'status': 'success',
+                'files': [the result of every file in the order of the request: the json of :func:`upload_method`
+                          or the error json with the 'filename' of the file (e.g. :class:`InvalidFileSuffix`,
+                          :class:`FileAlreadyExists` or :class:`FileTooBig`)]
             }
-        )
+    """
+    check_content_length(config.BATCH_UPLOAD_MAX_BYTES)
+    # The parts limit is only enforced by werkzeug 2.2.3 and newer, the amount of files is checked on all versions.
+    request.max_form_parts = config.BATCH_UPLOAD_MAX_FILES + BATCH_FORM_VALUES
+    try:
+        files = request.files.getlist("file")  # parses the form with the limits
+    except RequestEntityTooLarge:
+        raise TooManyFiles()
+    if len(files) > config.BATCH_UPLOAD_MAX_FILES:
+        raise TooManyFiles()
+    if config.AUTHENTICATION_FOR_UPLOADING_REQUIRED:
+        run_api_with_authentication_required()
+    if not files:
+        raise NoFileInRequest()
+    group, key = parse_upload_group()
+    expires, max_downloads = parse_upload_expiration()
+    admit()
+    derived_key = None if key is None else derive_upload_key(key)
+    private_key = request.form.get("private_key")
+    ip = get_real_ip()
+    route = get_route()
+
+    results = [None] * len(files)
+    accepted = []
+    group_filenames = set()
+    for index, file in enumerate(files):
+        try:
+            filename = check_upload_filename(file.filename)
+            if group is not None:
+                if filename in group_filenames:
+                    raise FileAlreadyExists()
+                group_filenames.add(filename)
+            accepted.append((index, file, filename))
+        except BasicError as e:
+            results[index] = get_batch_error(file.filename, e, ip)
+
+    def save(file: FileStorage, filename: str) -> dict:
+        try:
+            with route_of(route):
+                return save_upload(file, filename, key, private_key, group, ip, derived_key, expires, max_downloads)
+        except BasicError as e:
+            return get_batch_error(file.filename, e, ip)
+        except Exception as e:
+            logger.log(LogType.ERROR, f"Batch upload from {ip} failed for a file: {e!r}")
+            return get_batch_error(file.filename, InternalServerError(), ip)
 
+    with ThreadPoolExecutor(max_workers=config.BATCH_UPLOAD_WORKERS) as executor:
+        futures = [
+            (index, executor.submit(save, file, filename))
+            for index, file, filename in accepted
+        ]
+        for index, future in futures:
+            results[index] = future.result()
+    return jsonify({"status": "success", "files": results})
@@ -11,8 +11,14 @@ from os import mkdir
 from os.path import exists
 
 from flask import Flask
+from resources.api.crypto_pool import start_crypto_pools
+from resources.api.expiration import expiration_sweeper
+from resources.api.metadata import metadata_index, rebuild_index
+from resources.api.storage import storage, ShardedLocalStorage
+from resources.argument_parser import args
 from resources.config import config
 from resources.logger import logger, LogType
+from resources.profiler import profiler
 
 
 class App:
@@ -24,21 +30,36 @@ class App:
         """Runs the app.
         :return:
         """
+        if config.SERVER_MODE.lower() != "prefork":  # the worker processes of the prefork mode start their own pools
+            start_crypto_pools()  # before the background threads are started, because the kdf processes are forked
         if not exists(config.DATA_DIRECTORY):
             mkdir(config.DATA_DIRECTORY)
+        if args.rebuild_index or not exists(metadata_index.path):
+            logger.log(LogType.HIGH, f"Rebuilt the metadata index with {rebuild_index()} files.")
+        if isinstance(storage, ShardedLocalStorage):
+            storage.start_migrator()  # in the prefork mode, the migrator runs in the master process
+        expiration_sweeper.start()  # like the migrator, the sweeper runs in the master process
 
         # log the running information
         logger.log(
-            LogType.HIGH, f"Server running on 'http://{config.HOST}:{config.PORT}'!"
+            LogType.HIGH, f"Server running on 'http://{config.HOST}:{config.PORT}' ({config.SERVER_MODE} mode)!"
         )
         try:
             self.flask.config["PROPAGATE_EXCEPTIONS"] = True
-            self.flask.run(
-                host=config.HOST,
-                port=config.PORT,
-                threaded=config.THREADED,
-                debug=config.DEBUG,
-            )
+            if config.SERVER_MODE.lower() == "prefork":
+                self.run_prefork()
+            elif config.SERVER_MODE.lower() == "asgi":
+                self.run_asgi()
+            elif config.SERVER_MODE.lower() == "builtin":
+                profiler.start_from_config()
+                self.flask.run(
+                    host=config.HOST,
+                    port=config.PORT,
+                    threaded=config.THREADED,
+                    debug=config.DEBUG,
+                )
+            else:
+                raise ValueError(f"The SERVER_MODE {config.SERVER_MODE} should be 'builtin', 'prefork' or 'asgi'.")
         except PermissionError:
             logger.log(
                 LogType.CRITICAL,
@@ -49,12 +70,47 @@ class App:
             print("Bye!")
             exit(0)
 
+    def run_prefork(self):
+        """Runs the app in the pre-forking multi-process server (requires gunicorn)."""
+        try:
+            from resources.server import PreforkServer
+        except ImportError:
+            logger.log(
+                LogType.CRITICAL,
+                "The SERVER_MODE 'prefork' requires gunicorn: Install it with 'pip install gunicorn'.",
+            )
+            return
+        if config.TOKEN_STORE.lower() == "memory":
+            logger.log(
+                LogType.WARNING,
+                "The authentication tokens of the 'memory' TOKEN_STORE are only valid in the worker process, "
+                "which created them: Use the 'sqlite' TOKEN_STORE in the prefork mode.",
+            )
+        PreforkServer(self.flask).run()
+
+    def run_asgi(self):
+        """Runs the app in the asyncio server (requires uvicorn)."""
+        from resources.asgi import run_asgi_server
+
+        try:
+            run_asgi_server(self.flask)
+        except ImportError:
+            logger.log(
+                LogType.CRITICAL,
+                "The SERVER_MODE 'asgi' requires uvicorn: Install it with 'pip install uvicorn'.",
+            )
+
 
 app = App()
 
 # import api definition files.
 
 from resources import flask_event_handlers
-from resources.api import upload, download, authentication_api, version, groups
+from resources.api import upload, download, authentication_api, version, groups, metrics_api, profiler_api
+
+if args.benchmark:
+    from resources.benchmark import run_benchmark
 
-app.run_app()
+    run_benchmark(app.flask)
+else:
+    app.run_app()
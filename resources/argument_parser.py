@@ -18,5 +18,26 @@ parser.add_argument("--configuration-file", type=str, default="opencdn.conf")
 parser.add_argument("-v", "--verbose", action="store_true", help="stdout info logs")
 parser.add_argument("--clear-all-logs", action="store_true", help="Delete all files in the log directory")
 parser.add_argument("--clear-today-log", action="store_true", help="Clear the today log file")
+parser.add_argument(
+    "--rebuild-index", action="store_true", help="Rebuild the metadata index from the storage"
+)
+parser.add_argument(
+    "--benchmark", action="store_true", help="Run the load benchmark against a temporary data directory"
+)
+parser.add_argument("--benchmark-requests", type=int, default=200, help="Requests per size and concurrency level")
+parser.add_argument(
+    "--benchmark-concurrency", type=str, default="1,8", help="Comma separated concurrency levels"
+)
+parser.add_argument(
+    "--benchmark-sizes", type=str, default="1024,65536,1048576", help="Comma separated file sizes in bytes"
+)
+parser.add_argument(
+    "--benchmark-mix",
+    type=str,
+    default="upload:1,download:4,group_listing:1,group_download:2,authentication:1",
+    help="Comma separated operations with weights",
+)
+parser.add_argument("--benchmark-seed", type=int, default=0, help="Seed of the random payloads and operations")
+parser.add_argument("--benchmark-output", type=str, default=None, help="Write the json results to this file")
 
 args = parser.parse_args(sys.argv[1:])
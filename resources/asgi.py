@@ -0,0 +1,254 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the asyncio server (SERVER_MODE 'asgi').
+The flask app is served by an ASGI adapter: the sockets are read and written by the event loop, so slow clients
+only hold a coroutine and no thread. The request body is received into a spooled temporary file before the app is
+called. The app and every chunk of the response (key derivation, decryption and encryption) run in a bounded pool of
+config.ASGI_THREADS threads, so a few threads serve many concurrent transfers.
+The server requires uvicorn, which is only imported, if the asgi mode is used.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from typing import Iterable, List, Optional, Tuple
+
+from flask import Flask, jsonify
+
+from resources.api.errors import FileTooBig
+from resources.config import config
+from resources.profiler import profiler
+
+"""Request bodies, which are bigger than this size in bytes, are received into a temporary file on the disk."""
+SPOOL_MEMORY_BYTES = 1024 * 1024
+
+"""Allowance for the multipart overhead of the request bodies (see resources.api.upload.MULTIPART_OVERHEAD_BYTES)."""
+BODY_OVERHEAD_BYTES = 1024 * 64
+
+"""The path of the batch upload, which accepts bigger request bodies (config.BATCH_UPLOAD_MAX_BYTES)."""
+BATCH_UPLOAD_PATH = "/upload/batch"
+
+
+def get_max_body_bytes(path: str) -> int:
+    """Gets the maximum size of a request body (the biggest upload of the route).
+    :param path: The path of the request.
+    :return: The size in bytes.
+    """
+    if path == BATCH_UPLOAD_PATH:
+        return config.BATCH_UPLOAD_MAX_BYTES + BODY_OVERHEAD_BYTES
+    return config.MAX_FILE_BYTES + BODY_OVERHEAD_BYTES
+
+
+def get_content_length(scope: dict) -> Optional[int]:
+    """Gets the Content-Length of an ASGI http request.
+    :param scope: The ASGI scope of the request.
+    :return: The Content-Length or None if it is missing or invalid (e.g. chunked requests).
+    """
+    for name, value in scope.get("headers", []):
+        if name.lower() == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def make_environ(scope: dict, body) -> dict:
+    """Creates the wsgi environ of an ASGI http request.
+    :param scope: The ASGI scope of the request.
+    :param body: The received request body (file).
+    :return: The environ.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,  # the whole body has been received (also of chunked requests)
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI adapter of the (wsgi) flask app."""
+
+    def __init__(self, flask: Flask, threads: int):
+        """
+        :param flask: The flask app.
+        :param threads: The amount of threads, which run the app and generate the responses.
+        """
+        self.flask = flask
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi-worker")
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        """Answers the startup and shutdown events of the server."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                profiler.start_from_config()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def receive_body(self, receive, max_body_bytes: int) -> Optional[SpooledTemporaryFile]:
+        """Receives the request body.
+        Errors: :class:`FileTooBig`.
+        :param receive: The ASGI receive function.
+        :param max_body_bytes: The maximum size of the body (see :func:`get_max_body_bytes`).
+        :return: The body (positioned at the start) or None if the client disconnected.
+        """
+        body = SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > max_body_bytes:
+                body.close()
+                raise FileTooBig()
+            body.write(chunk)
+            if not message.get("more_body", False):
+                body.seek(0)
+                return body
+
+    def start_app(self, environ: dict) -> Tuple[str, List[Tuple[str, str]], Iterable[bytes]]:
+        """Calls the app (in a thread of the executor).
+        :param environ: The wsgi environ.
+        :return: The status, the headers and the body of the response.
+        """
+        response = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            response[:] = [status, headers]
+            return lambda data: written.append(data)
+
+        written = []
+        iterable = self.flask(environ, start_response)
+        if written:  # the legacy write function of start_response
+            iterable = [*written, *iterable]
+        return response[0], response[1], iterable
+
+    async def handle_http(self, scope: dict, receive, send):
+        """Answers a http request with the app. Too big request bodies are rejected before they are received, if
+        the request has a Content-Length.
+        """
+        loop = asyncio.get_running_loop()
+        max_body_bytes = get_max_body_bytes(scope["path"])
+        content_length = get_content_length(scope)
+        if content_length is not None and content_length > max_body_bytes:
+            await self.send_error(send, FileTooBig())
+            return
+        try:
+            body = await self.receive_body(receive, max_body_bytes)
+        except FileTooBig as e:
+            await self.send_error(send, e)
+            return
+        if body is None:
+            return
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        iterable = None
+        try:
+            status, headers, iterable = await loop.run_in_executor(
+                self.executor, self.start_app, make_environ(scope, body)
+            )
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+                }
+            )
+            iterator = iter(iterable)
+            while not disconnected.is_set():
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+            if hasattr(iterable, "close"):
+                await loop.run_in_executor(self.executor, iterable.close)
+            body.close()
+
+    async def send_error(self, send, error):
+        """Sends an error response without calling the app (e.g. a too big request body).
+        :param send: The ASGI send function.
+        :param error: The error (:class:`resources.api.errors.BasicError`).
+        """
+        with self.flask.app_context():
+            data = jsonify(error.to_json()).get_data()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": error.http_return,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": data})
+
+
+def run_asgi_server(flask: Flask):
+    """Runs the flask app with the ASGI adapter in uvicorn.
+    Errors: ImportError, if uvicorn is not installed.
+    :param flask: The flask app.
+    """
+    import uvicorn
+
+    uvicorn.run(
+        AsgiApp(flask, config.ASGI_THREADS),
+        host=config.HOST,
+        port=config.PORT,
+        lifespan="on",
+        access_log=False,  # the requests are logged by the app
+        log_level="warning",
+        timeout_keep_alive=config.KEEP_ALIVE,
+        timeout_graceful_shutdown=config.GRACEFUL_TIMEOUT,
+    )
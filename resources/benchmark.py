@@ -0,0 +1,227 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the load benchmark (run.py --benchmark).
+The benchmark runs the app against a temporary data directory with the flask test client and drives a mix of
+uploads, downloads, group listings, group downloads and authentications with different file sizes and concurrency
+levels. The results (requests/sec, latency percentiles and peak RSS) are written as json.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import json
+import random
+import resource
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import local
+from time import perf_counter
+from typing import Dict, List
+
+from resources.argument_parser import args
+from resources.config import config
+from resources.logger import logger, LogType
+
+"""The operations of the benchmark."""
+OPERATIONS = ("upload", "download", "group_listing", "group_download", "authentication")
+
+
+def parse_int_list(input: str) -> List[int]:
+    """Parses a comma separated list of integers (e.g. '1,8,32').
+    :param input: The input string.
+    :return: The list of integers.
+    """
+    return [int(x) for x in input.split(",") if x.strip()]
+
+
+def parse_mix(input: str) -> Dict[str, int]:
+    """Parses the operation mix (e.g. 'upload:1,download:4').
+    :param input: The input string.
+    :return: dict of the operations with their weights.
+    """
+    mix = {}
+    for part in input.split(","):
+        if not part.strip():
+            continue
+        operation, _, weight = part.partition(":")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError(f"The benchmark operation {operation} should be one of {', '.join(OPERATIONS)}.")
+        mix[operation] = int(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Gets the percentile of values (nearest rank).
+    :param values: The sorted values.
+    :param percent: The percentile (0 - 100).
+    :return: The value of the percentile or 0.0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def get_peak_rss() -> int:
+    """Gets the peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Benchmark:
+    """Runs the operations against the flask app for one file size and concurrency level."""
+
+    def __init__(self, flask, size: int, seed: int):
+        """
+        :param flask: The flask app.
+        :param size: The size of the uploaded files in bytes.
+        :param seed: The seed of the random payloads and operations.
+        """
+        self.flask = flask
+        self.size = size
+        self.random = random.Random(seed)
+        self.payload = self.random.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+        self._local = local()
+        self.files = []
+        self.group = None
+        self.key_identifier = next(iter(config.KEYS), None) if hasattr(config, "KEYS") else None
+
+    @property
+    def client(self):
+        """The test client of the current thread."""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.flask.test_client()
+        return client
+
+    def setup(self):
+        """Uploads the files and creates the group, which are used by the download and group operations."""
+        for _ in range(8):
+            self.files.append(self.upload().get_json())
+        name = f"benchmark{self.size}_{self.random.getrandbits(32)}"
+        self.group = self.client.post(f"/group/{name}").get_json()
+        for i in range(8):
+            self.client.post(
+                "/upload",
+                data={
+                    "file": (BytesIO(self.payload), f"file{i}.bin"),
+                    "group": name,
+                    "key": self.group["key"],
+                    "private_key": self.group["private_key"],
+                },
+                content_type="multipart/form-data",
+            )
+
+    def upload(self):
+        """Uploads a file."""
+        return self.client.post(
+            "/upload",
+            data={"file": (BytesIO(self.payload), "benchmark.bin")},
+            content_type="multipart/form-data",
+        )
+
+    def download(self):
+        """Downloads one of the uploaded files."""
+        file = self.random.choice(self.files)
+        return self.client.get(f"/{file['key']}/{file['filename']}")
+
+    def group_listing(self):
+        """Lists the files of the group."""
+        return self.client.put(
+            f"/group/{self.group['name']}",
+            data={"key": self.group["key"], "private_key": self.group["private_key"]},
+        )
+
+    def group_download(self):
+        """Downloads one of the files of the group."""
+        return self.client.get(f"/{self.group['name']}/{self.group['key']}/file{self.random.randrange(8)}.bin")
+
+    def authentication(self):
+        """Creates an authentication token."""
+        return self.client.post("/authentication", data={"key_identifier": self.key_identifier})
+
+    def run_operation(self, operation: str):
+        """Runs an operation and measures the latency.
+        :param operation: The name of the operation.
+        :return: The operation, the latency in seconds and True if the request failed.
+        """
+        start = perf_counter()
+        response = getattr(self, operation)()
+        response.get_data()  # consume streamed responses
+        latency = perf_counter() - start
+        response.close()
+        return operation, latency, response.status_code >= 400
+
+    def run(self, mix: Dict[str, int], requests: int, concurrency: int) -> dict:
+        """Runs the requests with the concurrency.
+        :param mix: The operations with their weights.
+        :param requests: The amount of requests.
+        :param concurrency: The amount of concurrent clients.
+        :return: dict with the results.
+        """
+        operations = self.random.choices(list(mix), weights=list(mix.values()), k=requests)
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            measurements = list(executor.map(self.run_operation, operations))
+        duration = perf_counter() - start
+        result = {
+            "size": self.size,
+            "concurrency": concurrency,
+            "requests": requests,
+            "duration": duration,
+            "requests_per_second": requests / duration if duration else 0.0,
+            "errors": sum(1 for _, _, error in measurements if error),
+            "operations": {},
+        }
+        for operation in mix:
+            latencies = sorted(latency for op, latency, _ in measurements if op == operation)
+            result["operations"][operation] = {
+                "requests": len(latencies),
+                "errors": sum(1 for op, _, error in measurements if op == operation and error),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+        return result
+
+
+def run_benchmark(flask):
+    """Runs the benchmark against a temporary data directory and writes the json results.
+    :param flask: The flask app.
+    """
+    mix = parse_mix(args.benchmark_mix)
+    if "authentication" in mix and not getattr(config, "KEYS", None):
+        del mix["authentication"]  # authentication tokens require a key in the configuration
+    data_directory = tempfile.mkdtemp(prefix="opencdn_benchmark_")
+    config.DATA_DIRECTORY = data_directory + "/"
+    config.AUTHENTICATION_FOR_UPLOADING_REQUIRED = False
+    config.MAX_FILE_BYTES = max(config.MAX_FILE_BYTES, *parse_int_list(args.benchmark_sizes))
+    results = []
+    try:
+        for size in parse_int_list(args.benchmark_sizes):
+            benchmark = Benchmark(flask, size, args.benchmark_seed)
+            benchmark.setup()
+            for concurrency in parse_int_list(args.benchmark_concurrency):
+                results.append(benchmark.run(mix, args.benchmark_requests, concurrency))
+    finally:
+        shutil.rmtree(data_directory, ignore_errors=True)
+    output = json.dumps(
+        {
+            "mix": mix,
+            "kdf_algorithm": config.KDF_ALGORITHM,
+            "results": results,
+            "peak_rss_bytes": get_peak_rss(),
+        },
+        indent=2,
+    )
+    if args.benchmark_output:
+        with open(args.benchmark_output, "w") as file:
+            file.write(output)
+        logger.log(LogType.HIGH, f"The benchmark results have been written to {args.benchmark_output}.")
+    else:
+        print(output)
@@ -24,12 +24,34 @@ class Config:
     PORT = 80
     """If THREADED enabled, the flask server will be started with threaded=True."""
     THREADED = True  # recommend
+    """The server mode: 'builtin' (the flask server in one process), 'prefork' (a pre-forking multi-process
+    server, which requires gunicorn) or 'asgi' (an asyncio server in one process, which requires uvicorn)."""
+    SERVER_MODE = "builtin"
+    """The amount of threads, which run the app and the key derivation, encryption and decryption in the asgi mode.
+    The connections are handled by the event loop, so the threads are not blocked by slow clients."""
+    ASGI_THREADS = 8
+    """The amount of worker processes in the prefork mode (0 means the amount of cpus)."""
+    WORKERS = 0
+    """The amount of threads of every worker process in the prefork mode."""
+    WORKER_THREADS = 4
+    """The time in seconds, which a connection is kept alive for the next request in the prefork mode."""
+    KEEP_ALIVE = 5
+    """The time in seconds, which the workers have to finish their requests on reload or shutdown (prefork mode)."""
+    GRACEFUL_TIMEOUT = 30
+    """Workers, which are silent for this time in seconds, are restarted in the prefork mode."""
+    WORKER_TIMEOUT = 120
     """Debug is not recommend, because the server have own error management."""
     DEBUG = False  # do not use debug in production
     """In this directory all logs will be written."""
     LOG_DIRECTORY = "logs/"
     """The filename of the log file."""
     LOG_FILENAME = "log_%m_%d_%y.log"
+    """The log records are written in the background at the latest after this time in seconds."""
+    LOG_FLUSH_INTERVAL = 1.0
+    """The log records are written in the background at the latest, if this amount of records is waiting."""
+    LOG_FLUSH_RECORDS = 1000
+    """The maximum amount of log records waiting for the writer. Further records are dropped (and counted)."""
+    LOG_QUEUE_SIZE = 100000
     """The whitelist of file suffixes (Only enabled, if FILE_SUFFIX_TYPE is 'whitelist')."""
     WHITELIST_FILE_SUFFIX = ["png", "jpg", "jpeg", "zip", "gz", "tar"]
     """The blacklist of file suffixes (Only enabled, if FILE_SUFFIX_TYPE is 'blacklist')."""
@@ -43,12 +65,109 @@ class Config:
     SERVER_KEY = "[RANDOM]"
     """The directory where the files would be saved."""
     DATA_DIRECTORY = "data/"
+    """The storage backend of the encrypted files: 'local' (one directory per key in the DATA_DIRECTORY), 'sharded'
+    (the key directories are distributed in subdirectories of the DATA_DIRECTORY) or 's3' (a bucket of a S3 compatible
+    object storage, requires boto3). The index and the temporary files of uploads are always in the DATA_DIRECTORY."""
+    STORAGE_BACKEND = "local"
+    """The levels of subdirectories of the 'sharded' STORAGE_BACKEND (e.g. 2: 'ab/cd/<hashed_key>')."""
+    SHARD_LEVELS = 2
+    """The length of the names of the subdirectories of the 'sharded' STORAGE_BACKEND (1 - 4 hex characters, e.g.
+    2: 256 subdirectories per level)."""
+    SHARD_WIDTH = 2
+    """If this attribute is enabled, the 'sharded' STORAGE_BACKEND moves the key directories of the flat layout (of
+    the 'local' STORAGE_BACKEND) in the background to the sharded layout. Until then they are served from the flat
+    layout."""
+    SHARD_MIGRATION = True
+    """The migration pauses after this amount of moved key directories."""
+    SHARD_MIGRATION_BATCH = 100
+    """The pause in seconds of the migration after every batch."""
+    SHARD_MIGRATION_INTERVAL = 0.1
+    """The bucket of the 's3' STORAGE_BACKEND."""
+    S3_BUCKET = ""
+    """The endpoint url of the S3 compatible object storage (e.g. 'http://127.0.0.1:9000' for MinIO), empty for AWS."""
+    S3_ENDPOINT_URL = ""
+    """The region of the bucket (empty for the default region)."""
+    S3_REGION = ""
+    """The access key id of the object storage (empty for the default credentials of boto3)."""
+    S3_ACCESS_KEY_ID = ""
+    """The secret access key of the object storage (empty for the default credentials of boto3)."""
+    S3_SECRET_ACCESS_KEY = ""
+    """The prefix of all keys in the bucket (e.g. 'opencdn/')."""
+    S3_PREFIX = ""
     """The length of the random encrypting key."""
     RANDOM_KEY_LENGTH = 15
+    """The key derivation function for new files: 'pbkdf2_sha256', 'scrypt' or 'legacy' (the PBKDF2 of files without
+    header). The KDF is recorded in the header of every file, so files with other KDFs remain decryptable."""
+    KDF_ALGORITHM = "pbkdf2_sha256"
+    """The iterations of the 'pbkdf2_sha256' key derivation function."""
+    KDF_ITERATIONS = 10000
+    """The cost of the 'scrypt' key derivation function (n = 2 ** KDF_SCRYPT_COST)."""
+    KDF_SCRYPT_COST = 14
     """The hash algo for the encrypting keys. The hashed key is the identifier of any file."""
     HASH_ALGO = "sha3_256"
+    """The maximum amount of cached derived keys. The key derivation is skipped for cached keys (0 disables the cache).
+    Only the hashed keys are used as identifiers in the cache."""
+    DERIVED_KEY_CACHE_SIZE = 1024
+    """The time in seconds, after which a cached derived key expires (0 means never)."""
+    DERIVED_KEY_CACHE_TTL = 600
+    """The default amount of files of a page of a group listing."""
+    GROUP_LISTING_PAGE_SIZE = 1000
+    """The maximum amount of files of a page of a group listing."""
+    GROUP_LISTING_MAX_PAGE_SIZE = 10000
+    """The maximum amount of cached pages of group listings (0 disables the cache)."""
+    GROUP_LISTING_CACHE_SIZE = 1024
+    """The time in seconds, after which a cached page of a group listing expires (0 means never)."""
+    GROUP_LISTING_CACHE_TTL = 600
+    """The amount of worker processes of the key derivations (0 derives the keys in the request threads)."""
+    CRYPTO_KDF_PROCESSES = 0
+    """The amount of worker threads of the encryption and decryption of chunks (0 encrypts and decrypts in the
+    request threads)."""
+    CRYPTO_CIPHER_THREADS = 0
+    """The maximum amount of admitted requests of every crypto pool besides its workers. If a pool is full, new
+    uploads and downloads are answered with '503 Service Unavailable'."""
+    CRYPTO_QUEUE_SIZE = 64
+    """The Retry-After header in seconds of the '503 Service Unavailable' responses of full crypto pools."""
+    CRYPTO_RETRY_AFTER = 1
+    """The memory budget in bytes of the cache of decrypted files (0 disables the cache). Cached files are served
+    without reading, key derivation and decryption."""
+    HOT_CACHE_BYTES = 0
+    """Files, which are bigger than this size in bytes, are not cached."""
+    HOT_CACHE_MAX_OBJECT_BYTES = 1024 * 1024
+    """The eviction policy of the cache of decrypted files: 'lru' (least recently used) or 'lfu' (least frequently
+    used)."""
+    HOT_CACHE_POLICY = "lru"
+    """The size of the chunks in bytes, in which files are read, encrypted and decrypted while streaming."""
+    STREAM_CHUNK_BYTES = 1024 * 64
+    """The Cache-Control header of the downloads (empty for no header). Every download has an ETag and a
+    Last-Modified header, so clients and proxies can revalidate files cheaply (e.g. 'no-cache' or 'max-age=3600')."""
+    CACHE_CONTROL = "no-cache"
+    """If this attribute is enabled, the encrypted files can be downloaded with '?raw=1' for client side decryption.
+    The stored file is sent without decryption (with sendfile, if the wsgi server supports it). The clients need the
+    SERVER_KEY to derive the keys: Only enable it for trusted clients."""
+    RAW_DOWNLOADS_ENABLED = False
+    """The maximum amount of files of a batch upload (/upload/batch)."""
+    BATCH_UPLOAD_MAX_FILES = 100
+    """The maximum size of all files of a batch upload together."""
+    BATCH_UPLOAD_MAX_BYTES = 1024 * 1024 * 200
+    """The amount of threads, which save the files of a batch upload in parallel."""
+    BATCH_UPLOAD_WORKERS = 4
     """Maximum of size of the file to be uploaded."""
     MAX_FILE_BYTES = 1024 * 1024 * 50  # 5 mb
+    """The storage of new uploads: 'file' (every file is saved as one encrypted file) or 'dedup' (the content is
+    split in chunks, which are encrypted with a key derived from their content and saved only once)."""
+    STORAGE_MODE = "file"
+    """The size in bytes of the chunks of the 'dedup' STORAGE_MODE."""
+    DEDUP_CHUNK_BYTES = 1024 * 1024
+    """The compression codec of new uploads: 'none', 'gzip', 'lzma' or 'bz2'. The files are compressed before the
+    encryption. gzip compressed files are sent compressed to clients, which accept 'Content-Encoding: gzip'.
+    The 'dedup' STORAGE_MODE does not compress files."""
+    COMPRESSION_CODEC = "none"
+    """The compression level (1 - 9, the lzma preset 0 - 9)."""
+    COMPRESSION_LEVEL = 6
+    """Files with these suffixes are already compressed and are not compressed again."""
+    COMPRESSION_SKIP_SUFFIXES = [
+        "png", "jpg", "jpeg", "gif", "webp", "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "mp3", "mp4", "webm",
+    ]
     """The length of the random private key.
     The client needs the private key to do actions with the file: For example delete it."""
     RANDOM_PRIVATE_KEY_LENGTH = 15
@@ -67,6 +186,41 @@ class Config:
     RANDOM_AUTHENTICATION_TOKEN_LENGTH = 20
     """If this attribute is enabled, the client needs a valid authentication token to upload files."""
     AUTHENTICATION_FOR_UPLOADING_REQUIRED = False
+    """The store of the authentication tokens: 'memory' (only valid in the process, which created the token) or
+    'sqlite' (shared by all worker processes, recommend for the prefork mode)."""
+    TOKEN_STORE = "memory"
+    """The time in seconds, after which an authentication token expires (0 means never)."""
+    AUTHENTICATION_TOKEN_TTL = 60 * 60 * 24
+    """The maximum amount of authentication tokens. If there are more tokens, the oldest tokens are removed."""
+    MAX_AUTHENTICATION_TOKENS = 100000
+    """The interval in seconds, in which expired authentication tokens are removed."""
+    TOKEN_SWEEP_INTERVAL = 60
+    """The time in seconds, after which uploads without 'expires_in' expire (0 means never)."""
+    UPLOAD_DEFAULT_EXPIRES_IN = 0
+    """The maximum 'expires_in' of uploads in seconds (0 means no limit). Longer expirations are shortened."""
+    UPLOAD_MAX_EXPIRES_IN = 0
+    """The time in seconds, after which a file is removed, when all of its downloads have been used (running
+    downloads can finish in this time)."""
+    EXPIRATION_GRACE = 60 * 10
+    """The interval in seconds, in which expired files are removed (0 disables the removal, expired files can not
+    be downloaded anyway)."""
+    EXPIRATION_SWEEP_INTERVAL = 60
+    """The amount of expired files, which are removed in one batch. The removal pauses after every batch."""
+    EXPIRATION_SWEEP_BATCH = 100
+    """If this attribute is enabled, the durations of the requests and their stages (key derivation, encryption,
+    decryption, disk access and authentication) are measured and exported on /metrics (Prometheus text format)."""
+    METRICS_ENABLED = False
+    """If this attribute is enabled, the profiler can be started with the /profiler api (requires an authentication
+    token) and with the PROFILER_*_ON_START attributes. The profiles are written to the log directory."""
+    PROFILER_ENABLED = False
+    """The interval in seconds, in which the sampling profiler samples the stacks of the request threads."""
+    PROFILER_SAMPLE_INTERVAL = 0.005
+    """The maximum duration in seconds of a sampling."""
+    PROFILER_MAX_DURATION = 300
+    """The duration in seconds of a sampling, which is started with the server (0 means no sampling)."""
+    PROFILER_SAMPLE_ON_START = 0
+    """The amount of requests, which are profiled with cProfile after the start of the server (0 means none)."""
+    PROFILER_REQUESTS_ON_START = 0
 
 
 config = Config()
@@ -81,5 +235,19 @@ if args.reset_configuration:
 config = run_config(config, args.configuration_file)
 
 
+if not 1 <= config.SHARD_WIDTH <= 4 or config.SHARD_LEVELS < 1:
+    raise ValueError("SHARD_WIDTH should be between 1 and 4 and SHARD_LEVELS should be at least 1.")
 if "/" in config.ALLOWED_FILENAME_CHARACTERS or "/" in config.ALLOWED_GROUPNAME_CHARACTERS:
     raise ValueError("'/' can not be a part of ALLOWED_FILENAME_CHARACTERS or ALLOWED_GROUPNAME_CHARACTERS.")
+if config.BATCH_UPLOAD_WORKERS < 1:
+    raise ValueError("BATCH_UPLOAD_WORKERS should be at least 1.")
+if config.ASGI_THREADS < 1:
+    raise ValueError("ASGI_THREADS should be at least 1.")
+if min(config.CRYPTO_KDF_PROCESSES, config.CRYPTO_CIPHER_THREADS, config.CRYPTO_QUEUE_SIZE) < 0:
+    raise ValueError("CRYPTO_KDF_PROCESSES, CRYPTO_CIPHER_THREADS and CRYPTO_QUEUE_SIZE can not be negative.")
+if min(config.UPLOAD_DEFAULT_EXPIRES_IN, config.UPLOAD_MAX_EXPIRES_IN, config.EXPIRATION_GRACE) < 0:
+    raise ValueError("UPLOAD_DEFAULT_EXPIRES_IN, UPLOAD_MAX_EXPIRES_IN and EXPIRATION_GRACE can not be negative.")
+if config.EXPIRATION_SWEEP_BATCH < 1:
+    raise ValueError("EXPIRATION_SWEEP_BATCH should be at least 1.")
+if config.LOG_QUEUE_SIZE < 1:
+    raise ValueError("LOG_QUEUE_SIZE should be at least 1.")
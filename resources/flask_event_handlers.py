@@ -7,16 +7,20 @@ This module implements the flask events.
 :license: GNU General Public License v3.0
 """
 
+from time import perf_counter
 from typing import List
 
-from flask import Response, jsonify
+from flask import Response, g, jsonify
 from werkzeug import exceptions
 
+from resources.api.crypto_pool import release_admission
 from resources.api.encryption import hash_key
-from resources.api.errors import BasicError, BadRequest, InternalServerError
+from resources.api.errors import BasicError, BadRequest, FileTooBig, InternalServerError
 from resources.app import app
 from resources.config import config
 from resources.logger import logger, LogType
+from resources.metrics import errors, get_route, received_bytes, request_duration, sent_bytes
+from resources.profiler import profiler
 from flask import request
 import re
 
@@ -53,6 +57,26 @@ def handle_request_path(path):
     return path
 
 
+def count_error(e: BasicError):
+    """Counts the returned error, if the metrics are enabled.
+    :param e: The error.
+    """
+    if config.METRICS_ENABLED:
+        errors.inc(1, e.id, e.name)
+
+
+@app.flask.before_request
+def before_request_timing():
+    """Saves the start time of the request (see config.METRICS_ENABLED)."""
+    g.request_start = perf_counter()
+
+
+@app.flask.before_request
+def before_request_profiling():
+    """Starts the profiling of the request, if the profiler profiles the next requests."""
+    g.profile = profiler.begin_request()
+
+
 @app.flask.after_request
 def after_request_logging(response: Response) -> Response:
     """Logs the after request."""
@@ -63,6 +87,42 @@ def after_request_logging(response: Response) -> Response:
     return response
 
 
+@app.flask.after_request
+def after_request_metrics(response: Response) -> Response:
+    """Counts the received and sent bytes and measures the duration of the request, after the response
+    has been sent (streamed responses are sent after this handler).
+    """
+    if not config.METRICS_ENABLED or "request_start" not in g:
+        return response
+    route = get_route()
+    received_bytes.inc(request.content_length or 0, route)
+    sent_bytes.inc(response.content_length or 0, route)
+    start = g.request_start
+    labels = (route, request.method, response.status_code)
+    if response.direct_passthrough:  # sent by the wsgi server (file wrapper), which does not call the close callbacks
+        request_duration.observe(perf_counter() - start, *labels)
+    else:
+        response.call_on_close(lambda: request_duration.observe(perf_counter() - start, *labels))
+    return response
+
+
+@app.flask.after_request
+def after_request_profiling(response: Response) -> Response:
+    """Stops the profiling of the request, after the response has been sent."""
+    profile = g.get("profile")
+    if profile is not None and response.direct_passthrough:
+        profiler.end_request(profile)
+    elif profile is not None:
+        response.call_on_close(lambda: profiler.end_request(profile))
+    return response
+
+
+@app.flask.teardown_request
+def teardown_request_admission(_):
+    """Releases the places in the crypto pools of a request, which failed without a response."""
+    release_admission()
+
+
 @app.flask.errorhandler(BasicError)
 def basic_error_handler(e: BasicError):
     """Logs the error and return the error."""
@@ -70,16 +130,26 @@ def basic_error_handler(e: BasicError):
         LogType.INFO,
         f"Request with error from {get_real_ip()} with error {e.id}:{e.name}.",
     )
-    return jsonify(e.to_json()), e.http_return
+    count_error(e)
+    return jsonify(e.to_json()), e.http_return, e.get_headers()
 
 
 @app.flask.errorhandler(exceptions.BadRequest)
 def bad_request_handling(_):
     """Return own bad request error."""
+    count_error(BadRequest())
     return jsonify(BadRequest().to_json()), BadRequest.http_return
 
 
+@app.flask.errorhandler(exceptions.RequestEntityTooLarge)
+def request_entity_too_large_handling(_):
+    """Return own file too big error (the request body exceeded the maximum content length of the request)."""
+    count_error(FileTooBig())
+    return jsonify(FileTooBig().to_json()), FileTooBig.http_return
+
+
 @app.flask.errorhandler(exceptions.InternalServerError)
 def internal_server_error_handling(_):
     """Return own internal server error."""
+    count_error(InternalServerError())
     return jsonify(InternalServerError().to_json()), InternalServerError.http_return
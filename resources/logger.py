@@ -8,10 +8,15 @@ This module implements the logger.
 """
 
 
+import atexit
 from datetime import datetime
 from enum import Enum
 from os.path import exists
-from os import mkdir, listdir, remove
+from os import mkdir, listdir, remove, register_at_fork
+from queue import Queue, Empty, Full
+from sys import stderr
+from threading import Lock, Thread
+from time import monotonic
 
 from resources.config import config
 from resources.argument_parser import args
@@ -86,25 +91,134 @@ class LogType(Enum):
 
 
 class Logger:
-    """Logger with log file."""
+    """Logger with log file.
+    The request threads only enqueue the log records. A background writer thread writes them in batches to the
+    log file, which is kept open and rotated, when the date in config.LOG_FILENAME changes.
+    At most config.LOG_QUEUE_SIZE records wait for the writer thread, further records are dropped and counted
+    (see :meth:`stats`), so a slow disk does not block the requests or fill the memory.
+    """
+
+    """Enqueued to stop the writer thread."""
+    _STOP = object()
 
     def write_log(self, content: str):
-        """Write raw log content
+        """Write raw log content (enqueues the content for the writer thread).
         :param content: The content to be written.
         """
         if not content.endswith("\n"):
             content += "\n"
-        with open(self.log_file, "a") as file:
-            file.write(content)
+        try:
+            self._queue.put_nowait((datetime.now(), content))
+        except Full:
+            with self._lock:
+                self.dropped += 1
 
     def __init__(self):
         parse_log_actions()
-        d = datetime.now()
         self.verbose = args.verbose
         self.log_dir = get_log_directory()
-        self.log_file = self.log_dir + d.strftime(config.LOG_FILENAME)
+        self.log_file = None
+        self._start_writer()
+        atexit.register(self.close)
+        register_at_fork(after_in_child=self._start_writer)
         self.write_log("--- Start of log ---")
 
+    def _start_writer(self):
+        """Creates the lock and the queue and starts the writer thread.
+        It is called again in forked processes, because threads are not copied by fork. Records, which were
+        enqueued before the fork, are written by the parent process. The lock is created again, because it can be
+        held by another thread of the parent process while forking, which would never release it in the child.
+        """
+        self._lock = Lock()
+        self._file = None
+        self._queue = Queue(config.LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.write_errors = 0
+        self._reported_dropped = 0
+        self._writer = Thread(target=self._run_writer, name="log-writer", daemon=True)
+        self._writer.start()
+
+    def _run_writer(self):
+        """The loop of the writer thread. The records are written, if config.LOG_FLUSH_RECORDS records are
+        waiting or the oldest waiting record is older than config.LOG_FLUSH_INTERVAL seconds.
+        """
+        batch = []
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(deadline - monotonic(), 0)
+                record = self._queue.get(timeout=timeout)
+            except Empty:
+                record = None
+            if record is self._STOP:
+                self._flush(batch)
+                self._close_file()
+                return
+            if record is not None:
+                if not batch:
+                    deadline = monotonic() + config.LOG_FLUSH_INTERVAL
+                batch.append(record)
+                if len(batch) < config.LOG_FLUSH_RECORDS and monotonic() < deadline:
+                    continue
+            self._flush(batch)
+            batch = []
+            deadline = None
+
+    def _flush(self, batch: list):
+        """Writes records with a record about the dropped records. If the writing fails, the error is printed
+        to stderr and the records are dropped (the dropped records are reported by the next write), so the writer
+        thread keeps running.
+        :param batch: List of (datetime, content) records.
+        """
+        dropped = self.dropped
+        if dropped > self._reported_dropped:
+            batch.append((datetime.now(), f"W: Dropped {dropped - self._reported_dropped} log records, because "
+                                          f"the log queue was full.\n"))
+        try:
+            self._write_batch(batch)
+            self._reported_dropped = dropped
+        except Exception as e:
+            self.write_errors += 1
+            print(f"{TerminalColors.FAIL}E: Writing {len(batch)} log records to {self.log_dir} failed: "
+                  f"{e!r}{TerminalColors.ENDC}", file=stderr)
+            self._close_file()
+
+    def _close_file(self):
+        """Closes the log file (it is opened again by the next write)."""
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _write_batch(self, batch: list):
+        """Writes records to the log file of their date and flushes the file.
+        :param batch: List of (datetime, content) records.
+        """
+        for d, content in batch:
+            log_file = self.log_dir + d.strftime(config.LOG_FILENAME)
+            if log_file != self.log_file or self._file is None:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(log_file, "a")
+                self.log_file = log_file
+            self._file.write(content)
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """Writes all enqueued records and stops the writer thread."""
+        if self._writer.is_alive():
+            self._queue.put(self._STOP)
+            self._writer.join()
+
+    def stats(self) -> dict:
+        """Gets the counters of the logger.
+        :return: dict with the waiting, dropped records and the failed writes.
+        """
+        return {"queued": self._queue.qsize(), "dropped": self.dropped, "write_errors": self.write_errors}
+
     def log(self, log_type: LogType, content: str, no_stdout=False):
         """Log something.
         :param log_type: The type of the log message.
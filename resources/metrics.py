@@ -0,0 +1,223 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the metrics (histograms of durations and counters), which are exported on /metrics in the
+Prometheus text format (see config.METRICS_ENABLED).
+The metrics are kept in the memory of the process, so every worker process of the prefork mode has its own metrics.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from flask import has_request_context, request
+
+from resources.config import config
+
+"""The upper bounds (in seconds) of the buckets of the duration histograms."""
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""The route label of measurements outside of a request or of requests without matching route."""
+NO_ROUTE = "none"
+
+
+def escape_label_value(value) -> str:
+    """Escapes a label value for the Prometheus text format.
+    :param value: The label value.
+    :return: The escaped value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    """Formats the labels of a sample.
+    :param names: The label names.
+    :param values: The label values.
+    :param extra: Additional formatted label (e.g. 'le="0.1"').
+    :return: The labels with braces or an empty string if there are no labels.
+    """
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """A thread-safe counter with labels."""
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        """
+        :param name: The name of the metric.
+        :param description: The description (HELP) of the metric.
+        :param labels: The label names.
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        """Increments the counter.
+        :param amount: The amount.
+        :param label_values: The values of the labels.
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        """Renders the counter in the Prometheus text format.
+        :return: List of the lines.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """A thread-safe histogram with labels."""
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets=DURATION_BUCKETS):
+        """
+        :param name: The name of the metric.
+        :param description: The description (HELP) of the metric.
+        :param labels: The label names.
+        :param buckets: The sorted upper bounds of the buckets.
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple, list] = {}  # label values: [bucket counts, sum, count]
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        """Observes a value.
+        :param value: The value (e.g. a duration in seconds).
+        :param label_values: The values of the labels.
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        """Renders the histogram (with cumulative buckets) in the Prometheus text format.
+        :return: List of the lines.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+"""The total duration of the requests (including streaming of the response)."""
+request_duration = Histogram(
+    "opencdn_request_duration_seconds", "The total duration of the requests.", ("route", "method", "status")
+)
+"""The duration of the stages (kdf, encryption, decryption, disk_read, disk_write, authentication) per request."""
+stage_duration = Histogram(
+    "opencdn_stage_duration_seconds", "The duration of the stages of the requests.", ("stage", "route")
+)
+"""The received bytes (request bodies)."""
+received_bytes = Counter("opencdn_received_bytes_total", "The received bytes of request bodies.", ("route",))
+"""The sent bytes (response bodies)."""
+sent_bytes = Counter("opencdn_sent_bytes_total", "The sent bytes of response bodies.", ("route",))
+"""The returned errors (see :class:`resources.api.errors.BasicError`)."""
+errors = Counter("opencdn_errors_total", "The returned errors.", ("id", "name"))
+
+
+"""The route of the request, which a thread works for (see :func:`route_of`)."""
+_thread_route = local()
+
+
+def get_route() -> str:
+    """Gets the route of the current request (e.g. '/<key>/<filename>'), so keys are never part of a label.
+    :return: The route or NO_ROUTE.
+    """
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return getattr(_thread_route, "route", NO_ROUTE)
+
+
+@contextmanager
+def route_of(route: str):
+    """Context manager, which measures the stages of another thread (without request context) for the route of a
+    request (e.g. the threads of a batch upload).
+    :param route: The route (see :func:`get_route`).
+    """
+    _thread_route.route = route
+    try:
+        yield
+    finally:
+        _thread_route.route = NO_ROUTE
+
+
+def observe_stage(stage: str, duration: float, route: str = None):
+    """Observes the duration of a stage, if the metrics are enabled.
+    :param stage: The name of the stage.
+    :param duration: The duration in seconds.
+    :param route: The route of the request (the route of the current request by default).
+    """
+    if config.METRICS_ENABLED:
+        stage_duration.observe(duration, stage, route or get_route())
+
+
+@contextmanager
+def measure(stage: str):
+    """Context manager, which observes the duration of the stage in it, if the metrics are enabled.
+    :param stage: The name of the stage.
+    """
+    if not config.METRICS_ENABLED:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(perf_counter() - start, stage, get_route())
+
+
+class StageTimings:
+    """Sums the durations of stages, which are measured in many small steps (e.g. per chunk of a stream), and
+    observes them once. The route is taken, when the timings are created, because streamed responses are generated
+    after the request context is gone.
+    """
+
+    def __init__(self):
+        self.route = get_route()
+        self.durations: Dict[str, float] = {}
+
+    def add(self, stage: str, duration: float):
+        """Adds a duration to a stage.
+        :param stage: The name of the stage.
+        :param duration: The duration in seconds.
+        """
+        self.durations[stage] = self.durations.get(stage, 0.0) + duration
+
+    def observe(self):
+        """Observes the summed durations of all stages (see :func:`observe_stage`) and resets them."""
+        for stage, duration in self.durations.items():
+            observe_stage(stage, duration, self.route)
+        self.durations = {}
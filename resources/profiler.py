@@ -0,0 +1,177 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the profiler (see config.PROFILER_ENABLED).
+The profiler can sample the stacks of the request threads for a duration (written as collapsed stacks, which can be
+rendered with flamegraph.pl or speedscope) or profile the next requests with cProfile (written as pstats file).
+The output files are written to the log directory. The profiler only profiles the process, which started it, so in
+the prefork mode only one worker process is profiled.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import cProfile
+import pstats
+import sys
+from collections import Counter
+from datetime import datetime
+from os import getpid
+from os.path import basename
+from threading import Lock, Thread, enumerate as enumerate_threads, get_ident
+from time import monotonic, sleep
+from typing import Optional
+
+from resources.api.errors import ProfilerBusy
+from resources.config import config
+from resources.logger import logger, LogType, get_log_directory
+
+"""The names of the background threads, which are not sampled."""
+BACKGROUND_THREAD_NAMES = ("log-writer", "token-sweeper", "profiler-sampler", "storage-migrator", "expiration-sweeper")
+
+
+def format_frame(frame) -> str:
+    """Formats a frame of a collapsed stack.
+    :param frame: The frame.
+    :return: The function name with the file and the first line of the function.
+    """
+    code = frame.f_code
+    return f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame) -> str:
+    """Collapses the stack of a frame.
+    :param frame: The innermost frame.
+    :return: The frames from the outermost to the innermost frame separated by ';'.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(format_frame(frame))
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def get_output_path(kind: str, suffix: str) -> str:
+    """Gets the path of a new profile in the log directory.
+    :param kind: The kind of the profile ('sample' or 'requests').
+    :param suffix: The file suffix.
+    :return: The path.
+    """
+    return get_log_directory() + f"profile_{datetime.now():%Y%m%d_%H%M%S}_{getpid()}_{kind}.{suffix}"
+
+
+class Profiler:
+    """The sampling and request profiler of the process. Only one sampling and one request profiling can
+    run at the same time.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sampling = False
+        self._remaining_requests = 0
+        self._profiling_request = False
+        self._requests_path = None
+        self._stats: Optional[pstats.Stats] = None
+
+    def start_sampling(self, duration: float) -> str:
+        """Starts a background thread, which samples the stacks of the request threads every
+        config.PROFILER_SAMPLE_INTERVAL seconds.
+        Errors: :class:`ProfilerBusy`.
+        :param duration: The duration of the sampling in seconds (at most config.PROFILER_MAX_DURATION).
+        :return: The path of the output file.
+        """
+        with self._lock:
+            if self._sampling:
+                raise ProfilerBusy()
+            self._sampling = True
+        path = get_output_path("sample", "collapsed")
+        duration = min(duration, config.PROFILER_MAX_DURATION)
+        Thread(target=self._run_sampler, args=(duration, path), name="profiler-sampler", daemon=True).start()
+        return path
+
+    def _run_sampler(self, duration: float, path: str):
+        """The loop of the sampler thread.
+        :param duration: The duration of the sampling in seconds.
+        :param path: The path of the output file.
+        """
+        try:
+            stacks = Counter()
+            sampler_ident = get_ident()
+            deadline = monotonic() + duration
+            while monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in enumerate_threads()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != sampler_ident and names.get(ident) not in BACKGROUND_THREAD_NAMES:
+                        stacks[collapse_stack(frame)] += 1
+                sleep(config.PROFILER_SAMPLE_INTERVAL)
+            with open(path, "w") as file:
+                for stack, count in stacks.most_common():
+                    file.write(f"{stack} {count}\n")
+            logger.log(LogType.HIGH, f"The sampled stacks have been written to {path}.")
+        finally:
+            self._sampling = False
+
+    def start_request_profiling(self, requests: int) -> str:
+        """Profiles the next requests with cProfile. Requests, which arrive while another request is profiled,
+        are not profiled.
+        Errors: :class:`ProfilerBusy`.
+        :param requests: The amount of requests.
+        :return: The path of the output file.
+        """
+        with self._lock:
+            if self._remaining_requests > 0:
+                raise ProfilerBusy()
+            self._requests_path = get_output_path("requests", "pstats")
+            self._stats = None
+            self._remaining_requests = requests
+            return self._requests_path
+
+    def begin_request(self) -> Optional[cProfile.Profile]:
+        """Starts the profiling of a request, if requests should be profiled (before_request).
+        :return: The profile or None if the request is not profiled.
+        """
+        if self._remaining_requests <= 0:
+            return None
+        with self._lock:
+            if self._remaining_requests <= 0 or self._profiling_request:
+                return None
+            self._profiling_request = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active
+            self._profiling_request = False
+            return None
+        return profile
+
+    def end_request(self, profile: cProfile.Profile):
+        """Stops the profiling of a request (after the response has been sent). After the last request, the
+        profiles of the requests are written to the output file.
+        :param profile: The profile of :meth:`begin_request`.
+        """
+        profile.disable()
+        with self._lock:
+            self._profiling_request = False
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._remaining_requests -= 1
+            if self._remaining_requests > 0:
+                return
+            path = self._requests_path
+            self._stats.dump_stats(path)
+            self._stats = None
+        logger.log(LogType.HIGH, f"The request profiles have been written to {path}.")
+
+    def start_from_config(self):
+        """Starts the profiling of config.PROFILER_SAMPLE_ON_START and config.PROFILER_REQUESTS_ON_START."""
+        if not config.PROFILER_ENABLED:
+            return
+        if config.PROFILER_SAMPLE_ON_START > 0:
+            self.start_sampling(config.PROFILER_SAMPLE_ON_START)
+        if config.PROFILER_REQUESTS_ON_START > 0:
+            self.start_request_profiling(config.PROFILER_REQUESTS_ON_START)
+
+
+profiler = Profiler()
@@ -0,0 +1,65 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+This module implements the pre-forking multi-process server (SERVER_MODE 'prefork').
+The server requires gunicorn, which is only imported, if the prefork mode is used.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from os import cpu_count
+
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+
+from resources.api.crypto_pool import start_crypto_pools
+from resources.config import config
+from resources.profiler import profiler
+
+
+def get_worker_count() -> int:
+    """Gets the amount of worker processes.
+    :return: config.WORKERS or the amount of cpus, if config.WORKERS is 0.
+    """
+    if config.WORKERS > 0:
+        return config.WORKERS
+    return cpu_count() or 1
+
+
+def post_worker_init(worker):
+    """Starts the crypto pools (before the threads of the worker are started) and the profiler of a worker process.
+    :param worker: The gunicorn worker.
+    """
+    start_crypto_pools()
+    profiler.start_from_config()
+
+
+class PreforkServer(BaseApplication):
+    """Runs the flask app in a pre-forking gunicorn server.
+    The master process forks config.WORKERS worker processes with config.WORKER_THREADS threads each.
+    SIGHUP reloads the workers gracefully and SIGTERM shuts the server down gracefully.
+    """
+
+    def __init__(self, flask: Flask):
+        self.flask = flask
+        super().__init__()
+
+    def load_config(self):
+        """Sets the gunicorn settings from the config."""
+        settings = {
+            "bind": f"{config.HOST}:{config.PORT}",
+            "workers": get_worker_count(),
+            "threads": config.WORKER_THREADS,
+            "worker_class": "gthread",  # the sync worker does not support keep-alive
+            "keepalive": config.KEEP_ALIVE,
+            "graceful_timeout": config.GRACEFUL_TIMEOUT,
+            "timeout": config.WORKER_TIMEOUT,
+            "post_worker_init": post_worker_init,
+        }
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Flask:
+        """Gets the flask app (the app is loaded before the workers are forked)."""
+        return self.flask
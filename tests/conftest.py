@@ -0,0 +1,53 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The fixtures of the tests. The app is imported with a configuration, which keeps the index, the storage and the
+logs in a temporary directory (the other settings are the defaults). The server is not started, the requests are
+sent with the flask test client.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+import sys
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIRECTORY = tempfile.mkdtemp(prefix="opencdn_tests_")
+CONFIGURATION_FILE = os.path.join(TEST_DIRECTORY, "opencdn.conf")
+
+with open(CONFIGURATION_FILE, "w") as file:
+    file.write(
+        "[ServerConfiguration]\n"
+        f"data_directory = {os.path.join(TEST_DIRECTORY, 'data')}/\n"
+        f"log_directory = {os.path.join(TEST_DIRECTORY, 'logs')}/\n"
+        "\n[Keys]\n"
+    )
+
+sys.path.insert(0, ROOT_DIRECTORY)
+with mock.patch.object(sys, "argv", [sys.argv[0], "--configuration-file", CONFIGURATION_FILE]), \
+        mock.patch.object(Flask, "run"):
+    from resources.app import app  # imports the api and runs the app (without the server)
+
+
+@pytest.fixture
+def client():
+    """The flask test client."""
+    return app.flask.test_client()
+
+
+@pytest.fixture
+def upload(client):
+    """Uploads a file: upload(content, filename, **form) returns the json of the upload."""
+
+    def upload_file(content: bytes, filename: str = "file.txt", **form) -> dict:
+        form["file"] = (BytesIO(content), filename)
+        return client.post("/upload", data=form, content_type="multipart/form-data").get_json()
+
+    return upload_file
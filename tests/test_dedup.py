@@ -0,0 +1,106 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the references of the deduplicated chunks and their garbage collection.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+from threading import Thread
+
+import pytest
+
+from resources.api import dedup
+from resources.api.dedup import acquire_chunk, get_chunk_name, read_chunk_ids, release_chunks
+from resources.api.encryption import hash_key
+from resources.api.metadata import get_file_name, metadata_index
+from resources.api.storage import storage
+from resources.config import config
+from resources.metrics import StageTimings
+
+
+@pytest.fixture(autouse=True)
+def dedup_storage(monkeypatch):
+    monkeypatch.setattr(config, "STORAGE_MODE", "dedup")
+    monkeypatch.setattr(config, "DEDUP_CHUNK_BYTES", 1000)
+
+
+def get_refcounts(chunk_ids: list) -> dict:
+    """The refcounts of the chunks in the index (missing chunks are not contained)."""
+    refcounts = {}
+    for chunk_id in set(chunk_ids):
+        row = metadata_index.execute("SELECT refcount FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+        if row is not None:
+            refcounts[chunk_id] = row["refcount"]
+    return refcounts
+
+
+def get_stored_chunks(chunk_ids: list) -> set:
+    return {chunk_id for chunk_id in chunk_ids if storage.stat(get_chunk_name(chunk_id)) is not None}
+
+
+def delete(client, result: dict):
+    url = f"/{result['key']}/{result['filename']}"
+    return client.delete(url, data={"private_key": result["private_key"]}).get_json()
+
+
+def test_upload_twice_delete_once_delete_twice(client, upload):
+    content = os.urandom(2500)
+    first, second = upload(content, "first.bin"), upload(content, "second.bin")
+    chunk_ids = read_chunk_ids(get_file_name(hash_key(first["key"]), first["filename"]))
+    assert len(chunk_ids) == 3
+    assert chunk_ids == read_chunk_ids(get_file_name(hash_key(second["key"]), second["filename"]))
+    assert get_refcounts(chunk_ids) == {chunk_id: 2 for chunk_id in chunk_ids}
+
+    assert delete(client, first)["status"] == "success"
+    assert get_refcounts(chunk_ids) == {chunk_id: 1 for chunk_id in chunk_ids}
+    assert get_stored_chunks(chunk_ids) == set(chunk_ids)
+    assert client.get(f"/{second['key']}/{second['filename']}").data == content
+
+    assert delete(client, second)["status"] == "success"
+    assert get_refcounts(chunk_ids) == {}
+    assert get_stored_chunks(chunk_ids) == set()
+
+
+def test_failed_deletion_keeps_the_chunk(monkeypatch):
+    chunk_id, _ = acquire_chunk(os.urandom(100), StageTimings())
+    delete_chunk = storage.delete
+
+    def fail(name: str):
+        raise OSError("storage not available")
+
+    monkeypatch.setattr(storage, "delete", fail)
+    release_chunks([chunk_id])
+    assert get_refcounts([chunk_id]) == {chunk_id: 0}
+    assert get_stored_chunks([chunk_id]) == {chunk_id}
+
+    monkeypatch.setattr(storage, "delete", delete_chunk)
+    release_chunks([acquire_chunk(os.urandom(100), StageTimings())[0]])  # collects the remaining chunk, too
+    assert get_refcounts([chunk_id]) == {}
+    assert get_stored_chunks([chunk_id]) == set()
+
+
+def test_chunk_acquired_during_the_deletion_is_saved_again(monkeypatch):
+    monkeypatch.setattr(dedup, "CHUNK_DELETION_POLL_INTERVAL", 0.01)
+    chunk = os.urandom(100)
+    chunk_id, _ = acquire_chunk(chunk, StageTimings())
+    delete_chunk = storage.delete
+    threads, waited = [], []
+
+    def delete_after_acquiring(name: str):
+        # The chunk is referenced again after the transaction, before it is deleted from the storage.
+        thread = Thread(target=acquire_chunk, args=(chunk, StageTimings()))
+        thread.start()
+        threads.append(thread)
+        thread.join(0.1)
+        waited.append(thread.is_alive())  # waits for the deletion
+        delete_chunk(name)
+
+    monkeypatch.setattr(storage, "delete", delete_after_acquiring)
+    release_chunks([chunk_id])
+    threads[0].join()
+    assert waited == [True]
+    assert get_refcounts([chunk_id]) == {chunk_id: 1}
+    assert get_stored_chunks([chunk_id]) == {chunk_id}
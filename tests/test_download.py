@@ -0,0 +1,157 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the downloads and their byte ranges (of encrypted and of deduplicated files).
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+
+import pytest
+
+from resources.api.cache import hot_object_cache
+from resources.api.encryption import hash_key
+from resources.api.errors import RangeNotSatisfiable
+from resources.api.metadata import get_file, get_file_name, rebuild_index
+from resources.api.storage import storage
+from resources.config import config
+
+"""The size of the uploaded content (several dedup and stream chunks, not a multiple of the AES block size)."""
+CONTENT_BYTES = 5003
+
+
+@pytest.fixture(params=["file", "dedup"])
+def stored_file(request, monkeypatch, upload):
+    """An uploaded file: (url, content)."""
+    monkeypatch.setattr(config, "STORAGE_MODE", request.param)
+    monkeypatch.setattr(config, "DEDUP_CHUNK_BYTES", 1000)
+    monkeypatch.setattr(config, "STREAM_CHUNK_BYTES", 512)
+    content = os.urandom(CONTENT_BYTES)
+    result = upload(content, "content.bin")
+    return f"/{result['key']}/{result['filename']}", content
+
+
+def get_range(client, url: str, byte_range: str, **headers):
+    return client.get(url, headers={"Range": byte_range, **headers})
+
+
+def test_download(client, stored_file):
+    url, content = stored_file
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == content
+    assert response.content_length == CONTENT_BYTES
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] and response.headers["Last-Modified"]
+
+
+@pytest.mark.parametrize(
+    "byte_range,start,stop",
+    [
+        ("bytes=0-0", 0, 1),
+        ("bytes=100-2499", 100, 2500),
+        ("bytes=15-16", 15, 17),  # across an AES block boundary
+        ("bytes=999-1000", 999, 1001),  # across a dedup chunk boundary
+        ("bytes=4000-", 4000, CONTENT_BYTES),
+        ("bytes=4990-9999", 4990, CONTENT_BYTES),
+        ("bytes=-300", CONTENT_BYTES - 300, CONTENT_BYTES),
+        ("bytes=-9999", 0, CONTENT_BYTES),
+    ],
+)
+def test_range(client, stored_file, byte_range, start, stop):
+    url, content = stored_file
+    response = get_range(client, url, byte_range)
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes {start}-{stop - 1}/{CONTENT_BYTES}"
+    assert response.content_length == stop - start
+    assert response.data == content[start:stop]
+
+
+@pytest.mark.parametrize("byte_range", [f"bytes={CONTENT_BYTES}-", f"bytes={CONTENT_BYTES + 10}-{CONTENT_BYTES + 20}"])
+def test_range_not_satisfiable(client, stored_file, byte_range):
+    url, _ = stored_file
+    response = get_range(client, url, byte_range)
+    assert response.status_code == RangeNotSatisfiable.http_return
+    assert response.headers["Content-Range"] == f"bytes */{CONTENT_BYTES}"
+    assert response.get_json()["name"] == RangeNotSatisfiable.name
+
+
+@pytest.mark.parametrize("byte_range", ["bytes=0-1,5-6", "items=0-1"])
+def test_unsupported_ranges_return_the_whole_file(client, stored_file, byte_range):
+    url, content = stored_file
+    response = get_range(client, url, byte_range)
+    assert response.status_code == 200 and response.data == content
+
+
+def test_if_range(client, stored_file):
+    url, content = stored_file
+    validators = client.get(url).headers
+    etag, last_modified = validators["ETag"], validators["Last-Modified"]
+
+    response = get_range(client, url, "bytes=10-19", **{"If-Range": etag})
+    assert response.status_code == 206 and response.data == content[10:20]
+    response = get_range(client, url, "bytes=10-19", **{"If-Range": last_modified})
+    assert response.status_code == 206 and response.data == content[10:20]
+
+    for outdated in ('"outdated"', "W/" + etag, "Mon, 01 Jan 2001 00:00:00 GMT"):
+        response = get_range(client, url, "bytes=10-19", **{"If-Range": outdated})
+        assert response.status_code == 200 and response.data == content
+
+
+def test_range_from_the_hot_cache(client, stored_file, monkeypatch):
+    monkeypatch.setattr(hot_object_cache, "max_bytes", 1024 * 1024)
+    url, content = stored_file
+    assert client.get(url).data == content  # stored in the cache
+    hits = hot_object_cache.hits
+    response = get_range(client, url, "bytes=-300")
+    assert hot_object_cache.hits == hits + 1
+    assert response.status_code == 206 and response.data == content[-300:]
+    assert response.headers["Content-Range"] == f"bytes {CONTENT_BYTES - 300}-{CONTENT_BYTES - 1}/{CONTENT_BYTES}"
+    assert get_range(client, url, f"bytes={CONTENT_BYTES}-").status_code == RangeNotSatisfiable.http_return
+
+
+class CountingFile:
+    """Counts the bytes, which are read from a file."""
+
+    def __init__(self, file, read_sizes: list):
+        self.file = file
+        self.read_sizes = read_sizes
+
+    def read(self, *args) -> bytes:
+        data = self.file.read(*args)
+        self.read_sizes.append(len(data))
+        return data
+
+    def __getattr__(self, name: str):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+def test_weak_etag_after_rebuilding_the_index(client, stored_file, monkeypatch):
+    url, content = stored_file
+    key, filename = url.strip("/").split("/")
+    name = get_file_name(hash_key(key), filename)
+    open_file, read_sizes = storage.open, []
+
+    def open_counting(opened_name: str):
+        file = open_file(opened_name)
+        return CountingFile(file, read_sizes) if opened_name == name else file
+
+    monkeypatch.setattr(storage, "open", open_counting)
+    rebuild_index()
+    monkeypatch.setattr(storage, "open", open_file)
+    assert get_file(hash_key(key), filename)["checksum"] is None
+    assert sum(read_sizes) < CONTENT_BYTES  # only the headers are read
+
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert response.data == content and etag.startswith('W/"')
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    response = get_range(client, url, "bytes=10-19", **{"If-Range": etag})
+    assert response.status_code == 200 and response.data == content
@@ -0,0 +1,79 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the encryption and of the decryption of byte ranges (files with and without KDF header).
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+from io import BytesIO
+
+import pytest
+
+from resources.api.encryption import EncryptedFile, decrypt, encrypt, encrypt_stream, make_aes
+from resources.api.kdf import FILE_HEADER_MAGIC
+from resources.config import config
+
+KEY = "EncryptingKey12"
+
+
+def encrypt_legacy(content: bytes, key: str) -> bytes:
+    """Encrypts like the versions before the KDF header: legacy KDF, no header."""
+    padding_length = 16 - (len(content) % 16)
+    return make_aes(key.encode("utf-8")).encrypt(content + bytes([padding_length]) * padding_length)
+
+
+def encrypt_with_header(content: bytes, key: str) -> bytes:
+    destination = BytesIO()
+    encrypt_stream(BytesIO(content), destination, key, None)
+    return destination.getvalue()
+
+
+@pytest.fixture(params=["legacy", "pbkdf2_sha256", "scrypt"])
+def encrypt_file(request, monkeypatch):
+    """Encrypts content into a file: without header (legacy) or with the header of the KDF."""
+    if request.param == "legacy":
+        return encrypt_legacy
+    monkeypatch.setattr(config, "KDF_ALGORITHM", request.param)
+    monkeypatch.setattr(config, "KDF_SCRYPT_COST", 10)
+    return encrypt_with_header
+
+
+def get_positions(size: int) -> list:
+    """The positions around the AES blocks at the start and at the end of the content."""
+    positions = {0, 1, 15, 16, 17, 31, 32, 33, 47, 48, size // 2, size - 17, size - 16, size - 15, size - 1, size}
+    return sorted(position for position in positions if 0 <= position <= size)
+
+
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 100, 1000])
+def test_ranges_match_the_sequential_decryption(encrypt_file, monkeypatch, size):
+    monkeypatch.setattr(config, "STREAM_CHUNK_BYTES", 7)  # the windows cross the chunks, too
+    content = os.urandom(size)
+    encrypted = encrypt_file(content, KEY)
+    assert decrypt(encrypted, KEY) == content
+    file = EncryptedFile(BytesIO(encrypted), KEY)
+    assert file.size == size
+    assert b"".join(file.iter_chunks()) == content
+    for start in get_positions(size):
+        for stop in get_positions(size):
+            assert b"".join(file.iter_chunks(start, stop)) == content[start:stop], (start, stop)
+
+
+def test_the_stop_is_limited_by_the_size(encrypt_file):
+    content = os.urandom(50)
+    file = EncryptedFile(BytesIO(encrypt_file(content, KEY)), KEY)
+    assert b"".join(file.iter_chunks(40, 1000)) == content[40:]
+    assert b"".join(file.iter_chunks(60, 70)) == b""
+
+
+def test_header():
+    assert encrypt(b"content", KEY).startswith(FILE_HEADER_MAGIC)
+    assert encrypt_with_header(b"content", KEY).startswith(FILE_HEADER_MAGIC)
+    assert not encrypt_legacy(b"content", KEY).startswith(FILE_HEADER_MAGIC)
+
+
+def test_wrong_key_does_not_decrypt():
+    encrypted = encrypt(b"secret content", KEY)
+    assert b"".join(EncryptedFile(BytesIO(encrypted), "OtherKey").iter_chunks(0, 14)) != b"secret content"
@@ -0,0 +1,61 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the group archives and of the ways to send the private_key of the group.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import io
+import zipfile
+from uuid import uuid4
+
+import pytest
+
+from resources.api.errors import AccessDenied, BadRequest
+from resources.api.groups import PRIVATE_KEY_HEADER
+
+PRIVATE_KEY = "GroupPrivateKey"
+
+FILES = {"a.txt": b"first file", "b.txt": b"second file"}
+
+
+@pytest.fixture
+def group(client, upload) -> str:
+    """A group with the :data:`FILES`: the url of its archive."""
+    name = "group" + uuid4().hex[:16]
+    key = client.post(f"/group/{name}", data={"private_key": PRIVATE_KEY}).get_json()["key"]
+    for filename, content in FILES.items():
+        upload(content, filename, group=name, key=key, private_key=PRIVATE_KEY)
+    return f"/{name}/{key}/"
+
+
+def read_archive(response) -> dict:
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        return {filename: archive.read(filename) for filename in archive.namelist()}
+
+
+def test_archive_with_the_private_key_as_header(client, group):
+    assert read_archive(client.get(group, headers={PRIVATE_KEY_HEADER: PRIVATE_KEY})) == FILES
+
+
+def test_archive_with_the_private_key_as_query(client, group):
+    assert read_archive(client.get(group, query_string={"private_key": PRIVATE_KEY})) == FILES
+
+
+def test_archive_with_the_private_key_as_form(client, group):
+    assert read_archive(client.post(group, data={"private_key": PRIVATE_KEY})) == FILES
+
+
+def test_archive_without_private_key(client, group):
+    response = client.get(group)
+    assert response.status_code == BadRequest.http_return
+    assert response.get_json()["name"] == BadRequest.name
+
+
+def test_archive_with_a_wrong_private_key(client, group):
+    response = client.get(group, headers={PRIVATE_KEY_HEADER: "WrongPrivateKey"})
+    assert response.status_code == AccessDenied.http_return
+    assert response.get_json()["name"] == AccessDenied.name
@@ -0,0 +1,27 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the logger in forked processes (the prefork mode).
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+
+import pytest
+
+from resources.logger import logger
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_forked_process_does_not_inherit_the_held_lock():
+    with logger._lock:  # held by another thread of the parent while forking
+        pid = os.fork()
+        if pid == 0:
+            acquired = logger._lock.acquire(timeout=5)
+            logger._queue.put(logger._STOP)
+            logger._writer.join(5)
+            os._exit(0 if acquired and not logger._writer.is_alive() else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
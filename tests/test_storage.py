@@ -0,0 +1,210 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the storage backends. The s3 backend runs against an in-memory stand-in of the S3 client.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+import os
+from datetime import datetime, timezone
+from os import getpid
+from tempfile import mkstemp
+from uuid import uuid4
+
+import pytest
+
+from resources.api.storage import LocalStorage, S3Object, S3Storage, ShardedLocalStorage
+from resources.config import config
+
+"""The stand-in bodies return at most this amount of bytes per read (like a network stream)."""
+SHORT_READ = 7
+
+"""The stand-in listings return at most this amount of entries per page."""
+PAGE_SIZE = 2
+
+
+class StubBody:
+    """A streamed body of the stand-in."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.closed = False
+
+    def read(self, size=None):
+        size = len(self.data) if size is None else min(size, SHORT_READ)
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class StubPaginator:
+    """The list_objects_v2 paginator of the stand-in."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket: str, Prefix: str, Delimiter: str = None):
+        entries = set()
+        for key in self.client.buckets.get(Bucket, {}):
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                entries.add(("CommonPrefixes", Prefix + rest[: rest.index(Delimiter) + 1]))
+            else:
+                entries.add(("Contents", key))
+        entries = sorted(entries, key=lambda entry: entry[1])
+        for start in range(0, max(len(entries), 1), PAGE_SIZE):
+            page = {}
+            for kind, name in entries[start:start + PAGE_SIZE]:
+                page.setdefault(kind, []).append({"Prefix": name} if kind == "CommonPrefixes" else {"Key": name})
+            yield page
+
+
+class StubS3Client:
+    """An in-memory stand-in of the boto3 S3 client with the calls of :class:`S3Storage`."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.get_requests = 0
+        self.bodies = []
+
+    def _objects(self, bucket: str) -> dict:
+        return self.buckets.setdefault(bucket, {})
+
+    def _not_found(self, operation: str):
+        from botocore.exceptions import ClientError
+
+        return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+    def upload_file(self, path: str, bucket: str, key: str):
+        with open(path, "rb") as file:
+            self.put_object(Bucket=bucket, Key=key, Body=file.read())
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        self._objects(Bucket)[Key] = (bytes(Body), datetime.now(timezone.utc))
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        if Key not in self._objects(Bucket):
+            raise self._not_found("HeadObject")
+        data, modified = self._objects(Bucket)[Key]
+        return {"ContentLength": len(data), "LastModified": modified}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> dict:
+        if Key not in self._objects(Bucket):
+            raise self._not_found("GetObject")
+        self.get_requests += 1
+        data = self._objects(Bucket)[Key][0]
+        if Range is not None:
+            data = data[int(Range[len("bytes="):].rstrip("-")):]
+        body = StubBody(data)
+        self.bodies.append(body)
+        return {"Body": body}
+
+    def delete_object(self, Bucket: str, Key: str):
+        self._objects(Bucket).pop(Key, None)
+
+    def delete_objects(self, Bucket: str, Delete: dict):
+        assert len(Delete["Objects"]) <= 1000
+        for entry in Delete["Objects"]:
+            self._objects(Bucket).pop(entry["Key"], None)
+
+    def get_paginator(self, operation: str) -> StubPaginator:
+        assert operation == "list_objects_v2"
+        return StubPaginator(self)
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    pytest.importorskip("boto3")
+    monkeypatch.setattr(config, "S3_BUCKET", "opencdn")
+    monkeypatch.setattr(config, "S3_PREFIX", "prefix/")
+    return StubS3Client()
+
+
+def create_s3_storage(client: StubS3Client) -> S3Storage:
+    backend = S3Storage()
+    backend._client = client
+    backend._client_pid = getpid()
+    return backend
+
+
+@pytest.fixture(params=["local", "sharded", "s3"])
+def backend(request):
+    if request.param == "local":
+        return LocalStorage()
+    if request.param == "sharded":
+        return ShardedLocalStorage()
+    return create_s3_storage(request.getfixturevalue("s3_client"))
+
+
+@pytest.fixture
+def directory() -> str:
+    """A new directory name (a hashed key, which is sharded by the 'sharded' backend)."""
+    return uuid4().hex + "/"
+
+
+def test_write_read_stat_delete(backend, directory):
+    name = directory + "file.txt"
+    assert backend.stat(name) is None and backend.read(name) is None
+    backend.write(name, b"content")
+    assert backend.read(name) == b"content"
+    assert backend.stat(name).size == len(b"content")
+    backend.delete(name)
+    backend.delete(name)  # deleting a missing object is no error
+    assert backend.stat(name) is None
+    with pytest.raises(FileNotFoundError):
+        backend.open(name)
+
+
+def test_put_moves_the_file(backend, directory):
+    descriptor, path = mkstemp()
+    with open(descriptor, "wb") as file:
+        file.write(b"uploaded")
+    backend.put(directory + "file.bin", path)
+    assert not os.path.exists(path)
+    assert backend.read(directory + "file.bin") == b"uploaded"
+
+
+def test_list_and_delete_directory(backend, directory):
+    backend.make_directory(directory)
+    assert backend.list(directory) == []
+    for i in range(5):
+        backend.write(f"{directory}file{i}", b"x")
+    backend.write(directory + "sub/file", b"x")
+    assert sorted(backend.list(directory)) == [f"file{i}" for i in range(5)] + ["sub/"]
+    backend.delete_directory(directory)
+    assert backend.list(directory) == []
+    assert backend.stat(directory + "sub/file") is None
+
+
+def test_s3_keys_have_the_prefix(s3_client, directory):
+    create_s3_storage(s3_client).write(directory + "file", b"x")
+    assert list(s3_client.buckets["opencdn"]) == ["prefix/" + directory + "file"]
+
+
+def test_s3_object_reads_exact_sizes(s3_client):
+    data = os.urandom(1000)
+    s3_client.put_object(Bucket="opencdn", Key="object", Body=data)
+    with S3Object(s3_client, "opencdn", "object", len(data)) as file:
+        assert file.read(16) == data[:16]  # more than one short read of the body
+        assert file.read(100) == data[16:116]
+        assert file.tell() == 116
+        assert s3_client.get_requests == 1  # sequential reads use one request
+
+
+def test_s3_object_seek(s3_client):
+    data = os.urandom(1000)
+    s3_client.put_object(Bucket="opencdn", Key="object", Body=data)
+    file = S3Object(s3_client, "opencdn", "object", len(data))
+    assert file.seek(500) == 500 and file.read(32) == data[500:532]
+    assert file.seek(-10, 2) == 990 and file.read(100) == data[990:]
+    assert file.read(5) == b""
+    assert file.seek(100) == 100 and file.seek(-50, 1) == 50 and file.read() == data[50:]
+    assert s3_client.get_requests == 3  # every seek to another position restarts the request
+    file.close()
+    assert all(body.closed for body in s3_client.bodies)
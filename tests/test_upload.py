@@ -0,0 +1,117 @@
+"""
+open_cdn.server
+~~~~~~~~~~~~
+
+The tests of the uploads and their size limits.
+:copyright: (c) 2020 by AdriBloober.
+:license: GNU General Public License v3.0
+"""
+
+from io import BytesIO
+
+import pytest
+from werkzeug.test import create_environ, run_wsgi_app
+
+from resources.api.errors import FileTooBig
+from resources.api.upload import LimitedRequestStream, MULTIPART_OVERHEAD_BYTES
+from resources.app import app
+from resources.config import config
+
+BOUNDARY = "OpenCDNTestBoundary"
+
+
+def make_multipart_body(content: bytes, filename: str = "file.bin") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: application/octet-stream\r\n\r\n".encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+    )
+
+
+class CountingStream(BytesIO):
+    """A request body, which counts the read bytes."""
+
+    read_bytes = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.read_bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = super().readline(size)
+        self.read_bytes += len(data)
+        return data
+
+
+def post_chunked(body: CountingStream):
+    """Posts an upload without Content-Length (like a request with chunked transfer encoding)."""
+    environ = create_environ("/upload", method="POST")
+    environ.pop("CONTENT_LENGTH", None)
+    environ["CONTENT_TYPE"] = f"multipart/form-data; boundary={BOUNDARY}"
+    environ["wsgi.input"] = body
+    environ["wsgi.input_terminated"] = True
+    response, status, _ = run_wsgi_app(app.flask.wsgi_app, environ, buffered=True)
+    return int(status.split()[0]), b"".join(response)
+
+
+def test_limited_request_stream():
+    stream = LimitedRequestStream(BytesIO(b"x" * 10), 10)
+    assert stream.readline(4) == b"xxxx"
+    assert stream.read() == b"x" * 6
+    with pytest.raises(FileTooBig):
+        LimitedRequestStream(BytesIO(b"x" * 11), 10).read()
+
+
+def test_upload_without_content_length(client, monkeypatch):
+    monkeypatch.setattr(config, "MAX_FILE_BYTES", 100000)
+    status, data = post_chunked(CountingStream(make_multipart_body(b"small")))
+    assert status == 200 and b'"filename":"file.bin"' in data
+
+
+def test_too_big_upload_without_content_length_is_not_read(monkeypatch):
+    monkeypatch.setattr(config, "MAX_FILE_BYTES", 100000)
+    body = CountingStream(make_multipart_body(b"x" * 1000000))
+    status, data = post_chunked(body)
+    assert status == FileTooBig.http_return and FileTooBig.name.encode() in data
+    assert body.read_bytes <= 100000 + MULTIPART_OVERHEAD_BYTES + 1
+
+
+def test_too_big_content_length(client, monkeypatch):
+    monkeypatch.setattr(config, "MAX_FILE_BYTES", 100000)
+    response = client.post(
+        "/upload", data=make_multipart_body(b"x" * 200000), content_type=f"multipart/form-data; boundary={BOUNDARY}"
+    )
+    assert response.status_code == FileTooBig.http_return and response.get_json()["name"] == FileTooBig.name
+
+
+def test_upload_and_download(client, upload):
+    result = upload(b"hello", "hello.txt")
+    assert result["filename"] == "hello.txt"
+    assert client.get(f"/{result['key']}/hello.txt").data == b"hello"
+
+
+def post_batch(client, files, **form):
+    form["file"] = [(BytesIO(content), filename) for content, filename in files]
+    return client.post("/upload/batch", data=form, content_type="multipart/form-data").get_json()
+
+
+def test_batch_upload(client):
+    files = [(f"content {i}".encode(), f"file{i}.txt") for i in range(5)] + [(b"x", "invalid.exe")]
+    results = post_batch(client, files)["files"]
+    for (content, filename), result in zip(files[:5], results):
+        assert client.get(f"/{result['key']}/{filename}").data == content
+    assert results[5]["name"] == "invalid_file_suffix"
+
+
+def test_batch_upload_with_too_many_files(client, monkeypatch):
+    monkeypatch.setattr(config, "BATCH_UPLOAD_MAX_FILES", 3)
+    assert post_batch(client, [(b"x", f"{i}.txt") for i in range(4)])["name"] == "too_many_files"
+    # the form parts limit (werkzeug 2.2.3 and newer) is answered with the same error
+    assert post_batch(client, [(b"x", f"{i}.txt") for i in range(40)])["name"] == "too_many_files"
+
+
+def test_batch_upload_checks_the_files_before_the_authentication(client, monkeypatch):
+    monkeypatch.setattr(config, "AUTHENTICATION_FOR_UPLOADING_REQUIRED", True)
+    monkeypatch.setattr(config, "BATCH_UPLOAD_MAX_FILES", 3)
+    files = [(b"x", f"{i}.txt") for i in range(40)]
+    assert post_batch(client, files, authentication_token="invalid")["name"] == "too_many_files"